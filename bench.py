@@ -0,0 +1,292 @@
+import argparse
+import json
+import statistics
+import sys
+import time
+
+import torch
+
+try:
+    from extensions.BrainHackingChip import standins
+except ImportError: # running bench.py from this directory
+    import standins
+
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
+
+# Benchmark for the hijacked forward passes, runs on the CPU (or a GPU) without oobabooga, exllamav2 or a real model
+# A tiny stand-in model with the same shape as an exllamav2 model (modules, head_layer_idx, last_kv_layer_idx, build_attn_mask,
+# attention modules with q_handle, caches with get_kv_state/store_kv_state) is driven through hijack_model_forward and hijack_attn_forward
+# The exllamav2 and oobabooga modules chip.py imports are replaced by the stand-ins from standins.py before chip.py is imported,
+# even if the real ones are installed, so numbers from different machines are always measuring the same thing
+#
+# From the oobabooga directory: python -m extensions.BrainHackingChip.bench --output bench.json
+# Or from this directory: python bench.py --output bench.json
+# A previous result file can be passed with --compare to fail (exit code 1) when decoding got slower than --tolerance allows
+
+CFG_LAYER_SETS = ['subtract', 'repulsor', 'clamp_radius', 'project', 'rescale'] # the default chip's layers with a built-in cfg_func
+LAYER_SETS = ['default', 'layers_all', 'head', 'attn_last', 'attn_all'] + CFG_LAYER_SETS
+
+def import_chip():
+    shared = standins.install_standins()
+    from extensions.BrainHackingChip import chip
+    return shared, chip
+
+# Benchmark
+
+def make_settings(chip, model, layer_set, weight, negative_cache):
+    from extensions.BrainHackingChip.settings_classes import HackingchipSettings, LayerSettings, AttnSettings, VectorSettings
+    from extensions.BrainHackingChip.cfg_functions import CFG_FUNCTIONS
+
+    layers_count, attn_layers, last_kv_layer, head_layer = chip.get_model_layout(model)
+    settings = HackingchipSettings(layers_count, list(attn_layers))
+    settings.negative_cache = negative_cache
+    settings.attention_backend = chip.default_attention_backend
+
+    def vectors():
+        return AttnSettings(*[VectorSettings(weight = weight) for _ in range(5)])
+
+    if layer_set == 'default': # same layers as the default chip
+        settings.layer_settings[last_kv_layer - 1] = LayerSettings(weight = weight)
+        settings.layer_settings[last_kv_layer + 1] = LayerSettings(weight = weight)
+    elif layer_set in CFG_LAYER_SETS:
+        cfg_func = CFG_FUNCTIONS[layer_set]
+        settings.layer_settings[last_kv_layer - 1] = LayerSettings(weight = weight, cfg_func = cfg_func)
+        settings.layer_settings[last_kv_layer + 1] = LayerSettings(weight = weight, cfg_func = cfg_func)
+    elif layer_set == 'layers_all':
+        for idx in range(head_layer): settings.layer_settings[idx] = LayerSettings(weight = weight)
+    elif layer_set == 'head':
+        settings.layer_settings[head_layer] = LayerSettings(weight = weight)
+    elif layer_set == 'attn_last':
+        settings.attn_settings[-1] = vectors()
+    elif layer_set == 'attn_all':
+        settings.attn_settings = [vectors() for _ in settings.attn_settings]
+    else:
+        raise ValueError("Unknown layer set " + layer_set)
+
+    return settings
+
+def count_steered(settings):
+    # Steered layers: every layer with layer settings plus every attention layer with any vector settings
+    layers = set(idx for idx, layer_settings in enumerate(settings.layer_settings) if layer_settings is not None)
+    for attn_idx, attn_settings in enumerate(settings.attn_settings):
+        if attn_settings is not None and (attn_settings.h or attn_settings.q or attn_settings.k or attn_settings.v or attn_settings.a):
+            layers.add(settings.attn_to_layers[attn_idx])
+    return len(layers)
+
+def make_run(chip, model, ui_settings, layer_set, numpos, numneg, weight, negative_cache, baseline = False):
+    # Gives make_run() for measure, with baseline every op of the chip is swapped for one that doesn't change anything,
+    # so the same rows run through the same layers (same exit layer) and only the steering itself is missing
+    from extensions.BrainHackingChip.kv_cache import make_cache
+
+    settings = make_settings(chip, model, layer_set, weight, negative_cache)
+    prompts = chip.HackingchipPrompts([''] * (numpos + numneg), numpos, numneg)
+
+    def run():
+        hackingchip = chip.Hackingchip(ui_settings, settings, prompts)
+        if baseline: hackingchip.program = hackingchip.program.passthrough()
+        return hackingchip, make_cache(model, numpos, numneg, False, settings.negative_cache)
+
+    return run
+
+def synchronize(device):
+    if device.startswith('cuda'): torch.cuda.synchronize(device)
+
+def reset_peak_memory(device):
+    if device.startswith('cuda'): torch.cuda.reset_peak_memory_stats(device)
+
+def peak_memory_mb(device):
+    # GPU: peak allocated by torch during the run, CPU: the process high water mark (only ever goes up, so only the largest case is exact)
+    if device.startswith('cuda'): return torch.cuda.max_memory_allocated(device) / (1024 * 1024), 'cuda_allocated'
+    if resource is None: return None, None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024), 'process_peak_rss'
+
+def run_generation(chip, model, hackingchip, cache, ids, decode_tokens, device):
+    # Prefill every prompt token but the last, then decode like the streaming generator (every row gets row 0's token)
+    batch_size = ids.shape[0]
+    model.hackingchip = hackingchip
+
+    synchronize(device)
+    start = time.perf_counter()
+    chip.hijack_model_forward(model, ids[:, :-1], cache, preprocess_only = True)
+    synchronize(device)
+    prefill_time = time.perf_counter() - start
+
+    next_ids = ids[:, -1:]
+    start = time.perf_counter()
+    for _ in range(decode_tokens):
+        logits = chip.hijack_model_forward(model, next_ids, cache)[0]
+        next_ids = logits[:1, -1].argmax(-1, keepdim = True).expand(batch_size, 1)
+    synchronize(device)
+    decode_time = time.perf_counter() - start
+
+    return prefill_time, decode_time
+
+def measure(chip, model, make_run, ids, args):
+    # make_run() gives a fresh (hackingchip, cache) for each repeat, the first run is a warmup
+    prefill_times = []
+    decode_times = []
+    reset_peak_memory(args.device)
+
+    for repeat in range(args.repeat + 1):
+        hackingchip, cache = make_run()
+        prefill_time, decode_time = run_generation(chip, model, hackingchip, cache, ids, args.decode_tokens, args.device)
+        if repeat > 0:
+            prefill_times.append(prefill_time)
+            decode_times.append(decode_time)
+        hackingchip = None
+        cache = None
+
+    memory, memory_kind = peak_memory_mb(args.device)
+    prefill_time = statistics.median(prefill_times)
+    decode_time = statistics.median(decode_times)
+
+    return {
+        'prefill_ms': prefill_time * 1000,
+        'prefill_tokens_per_s': (ids.shape[1] - 1) / prefill_time,
+        'decode_ms_per_token': decode_time * 1000 / args.decode_tokens,
+        'decode_tokens_per_s': args.decode_tokens / decode_time,
+        'peak_memory_mb': memory,
+        'memory_kind': memory_kind,
+    }
+
+def run_benchmark(args):
+    chip = import_chip()[1]
+    chip.default_attention_backend = args.attention_backend
+    from extensions.BrainHackingChip.kv_cache import make_cache
+
+    torch.manual_seed(args.seed)
+    if args.threads: torch.set_num_threads(args.threads)
+    standins.module_device = 'cpu:0' if args.device == 'cpu' else args.device
+
+    config = standins.StandinConfig(hidden_size = args.hidden_size, num_attention_heads = args.heads, num_key_value_heads = args.kv_heads,
+                           num_hidden_layers = args.layers, intermediate_size = args.intermediate_size, vocab_size = args.vocab_size,
+                           max_seq_len = max(args.seq_len) + args.decode_tokens + 1)
+    model = standins.StandinModel(config, args.device)
+
+    for module in model.modules:
+        if isinstance(module, standins.StandinAttention): module.forward = chip.hijack_attn_forward.__get__(module, standins.StandinAttention)
+
+    ui_settings = {'sample_other_prompts': False}
+    results = []
+
+    def report(record):
+        results.append(record)
+        print('{layer_set:>10} pos={numpos} neg={numneg} seq={seq_len:<5} prefill {prefill_tokens_per_s:9.1f} tok/s  decode {decode_tokens_per_s:7.2f} tok/s'.format(**record)
+              + ('  {:+.3f} ms/layer'.format(record['per_layer_overhead_ms']) if record.get('per_layer_overhead_ms') is not None else ''), file = sys.stderr)
+
+    for numpos in args.numpos:
+        for seq_len in args.seq_len:
+            ids = torch.randint(config.vocab_size, (numpos + max(args.numneg), seq_len))
+
+            # Chip switched off, only the positive rows
+            unsteered = measure(chip, model, lambda: (None, make_cache(model, numpos, 0)), ids[:numpos], args)
+            unsteered.update({'layer_set': 'none', 'numpos': numpos, 'numneg': 0, 'batch_size': numpos, 'seq_len': seq_len, 'steered_layers': 0})
+            report(unsteered)
+
+            for numneg in args.numneg:
+                batch_ids = ids[:numpos + numneg]
+
+                for layer_set in args.layer_sets:
+                    run_args = (chip, model, ui_settings, layer_set, numpos, numneg, args.weight, args.negative_cache)
+
+                    # The same chip with ops that don't change anything, same rows through the same layers without steering
+                    batch_baseline = measure(chip, model, make_run(*run_args, baseline = True), batch_ids, args)
+                    record = measure(chip, model, make_run(*run_args), batch_ids, args)
+
+                    steered_layers = count_steered(make_settings(chip, model, layer_set, args.weight, args.negative_cache))
+                    steering_ms = record['decode_ms_per_token'] - batch_baseline['decode_ms_per_token']
+
+                    record.update({
+                        'layer_set': layer_set, 'numpos': numpos, 'numneg': numneg, 'batch_size': numpos + numneg, 'seq_len': seq_len,
+                        'steered_layers': steered_layers,
+                        'unsteered_decode_ms_per_token': unsteered['decode_ms_per_token'],
+                        'overhead_ms_per_token': record['decode_ms_per_token'] - unsteered['decode_ms_per_token'], # everything the chip costs
+                        'batch_baseline_decode_ms_per_token': batch_baseline['decode_ms_per_token'],
+                        'steering_ms_per_token': steering_ms, # only the steering itself
+                        'per_layer_overhead_ms': steering_ms / steered_layers if steered_layers else None,
+                    })
+                    report(record)
+
+    return {
+        'config': {
+            'device': args.device, 'threads': torch.get_num_threads(), 'torch': torch.__version__,
+            'hidden_size': config.hidden_size, 'heads': config.num_attention_heads, 'kv_heads': config.num_key_value_heads,
+            'layers': config.num_hidden_layers, 'intermediate_size': config.intermediate_size, 'vocab_size': config.vocab_size,
+            'decode_tokens': args.decode_tokens, 'repeat': args.repeat, 'weight': args.weight, 'negative_cache': args.negative_cache, 'attention_backend': args.attention_backend,
+        },
+        'results': results,
+    }
+
+def result_key(record):
+    return (record['layer_set'], record['numpos'], record['numneg'], record['seq_len'])
+
+def compare(previous, current, tolerance):
+    # Returns a line for every case that decodes or prefills slower than the previous results by more than tolerance (a fraction)
+    previous_results = {result_key(record): record for record in previous['results']}
+    regressions = []
+
+    for record in current['results']:
+        old = previous_results.get(result_key(record))
+        if old is None: continue
+        for metric in ('decode_tokens_per_s', 'prefill_tokens_per_s'):
+            if record[metric] < old[metric] * (1.0 - tolerance):
+                regressions.append('{} pos={} neg={} seq={}: {} {:.2f} -> {:.2f}'.format(*result_key(record), metric, old[metric], record[metric]))
+
+    return regressions
+
+def int_list(text):
+    return [int(value) for value in text.split(',') if value]
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the Brain-Hacking Chip forward passes on a stand-in model")
+    parser.add_argument('--device', default = 'cpu')
+    parser.add_argument('--threads', type = int, default = 0, help = "torch CPU threads, 0 leaves torch's default")
+    parser.add_argument('--numpos', type = int_list, default = [1], help = "comma separated grid of positive prompt counts")
+    parser.add_argument('--numneg', type = int_list, default = [1, 2, 4], help = "comma separated grid of negative prompt counts")
+    parser.add_argument('--seq-len', type = int_list, default = [128, 512], help = "comma separated grid of prompt lengths")
+    parser.add_argument('--layer-sets', type = lambda text: text.split(','), default = ['default', 'repulsor', 'attn_last', 'attn_all'], help = "comma separated, any of " + ', '.join(LAYER_SETS))
+    parser.add_argument('--decode-tokens', type = int, default = 32)
+    parser.add_argument('--repeat', type = int, default = 3, help = "timed runs per case (the median is reported), after one warmup run")
+    parser.add_argument('--weight', type = float, default = 0.2)
+    parser.add_argument('--negative-cache', default = 'fp16', choices = ['fp16', '8bit'])
+    parser.add_argument('--attention-backend', default = 'auto', choices = ['auto', 'sdpa', 'matmul'])
+    parser.add_argument('--hidden-size', type = int, default = 512)
+    parser.add_argument('--heads', type = int, default = 8)
+    parser.add_argument('--kv-heads', type = int, default = 2)
+    parser.add_argument('--layers', type = int, default = 8)
+    parser.add_argument('--intermediate-size', type = int, default = 1024)
+    parser.add_argument('--vocab-size', type = int, default = 4096)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', help = "write the results as JSON here instead of stdout")
+    parser.add_argument('--compare', help = "previous JSON results, exits with 1 if anything got slower than --tolerance")
+    parser.add_argument('--tolerance', type = float, default = 0.1)
+    args = parser.parse_args(argv)
+
+    for layer_set in args.layer_sets:
+        if layer_set not in LAYER_SETS: parser.error("unknown layer set " + layer_set)
+
+    return args
+
+def main(argv = None):
+    args = parse_args(argv)
+    results = run_benchmark(args)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent = 2)
+    else:
+        json.dump(results, sys.stdout, indent = 2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), results, args.tolerance)
+        for line in regressions: print("Regression: " + line, file = sys.stderr)
+        if regressions: sys.exit(1)
+
+if __name__ == '__main__':
+    main()
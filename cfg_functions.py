@@ -0,0 +1,78 @@
+import torch
+
+# Built-in cfg_funcs, use them in chip_settings.py like LayerSettings(weight=0.2, cfg_func=cfg_repulsor) or VectorSettings(...)
+# Every function has the usual signature: new_tensors = cfg_func(tensor, settings, hackingchip), tensor is the full block of positive and negative rows
+#
+# These are written only with tensor ops, any "if" on a value is a torch.where, so nothing ever waits on the GPU
+# Calling .item() (or float(), or an if on a tensor) inside a cfg_func makes the CPU wait for the GPU to catch up, on every steered layer of every token
+#
+# "The negative" is whatever the chip's steering_mode combines the negative rows into (weighted mean by default), the same one the default CFG uses
+
+eps = 1e-6
+
+def negative_difference(tensor, hackingchip):
+    # neg - pos for every vector of the positive row
+    # This is a buffer of the hackingchip's workspace, reused by the next call: use it (or copy it) before calling this again
+    return hackingchip.steering.delta(tensor, hackingchip.workspace if hasattr(hackingchip, 'workspace') else None)
+
+def vector_norm(tensor, dim=-1):
+    # Norms are taken in FP32, the sum of squares of a hidden state can overflow FP16
+    return torch.linalg.vector_norm(tensor, dim=dim, keepdim=dim is not None, dtype=torch.float32)
+
+# The default CFG: every row moves away from the negative by weight * (neg - pos)
+def cfg_subtract(tensor, settings, hackingchip):
+    tensor.sub_(negative_difference(tensor, hackingchip), alpha=settings.weight)
+    return tensor
+
+# Repels positive from negative, up to a distance determined by negative's magnitude * settings.weight
+# If positive is already that far away or more, it isn't modified
+def cfg_repulsor(tensor, settings, hackingchip):
+    difference = negative_difference(tensor, hackingchip)
+
+    strength = vector_norm(difference + tensor[0], dim=None) * settings.weight
+    distance = vector_norm(difference, dim=None)
+
+    scale = torch.where(strength > distance, strength / distance.clamp_min(eps) - 1.0, torch.zeros_like(distance))
+
+    tensor[0].sub_(difference * scale.to(tensor.dtype)) # There's no accelerating issues with this cfg func, so only need to modify positive
+    return tensor
+
+# Moves every row away from the negative by the whole difference, but never farther than weight * the length of the positive vector
+# Steering can't blow up a vector that's close to its negative, weight is a fraction of each vector's own length
+def cfg_clamp_radius(tensor, settings, hackingchip):
+    difference = negative_difference(tensor, hackingchip)
+
+    radius = vector_norm(tensor[0]) * settings.weight
+    length = vector_norm(difference)
+
+    scale = torch.where(length > radius, radius / length.clamp_min(eps), torch.ones_like(length))
+
+    tensor.sub_(difference * scale.to(tensor.dtype))
+    return tensor
+
+# Removes weight * the part of each positive vector that points in the negative's direction, weight 1.0 leaves it orthogonal to the negative
+# The same change is made to every row
+def cfg_project(tensor, settings, hackingchip):
+    negative = (negative_difference(tensor, hackingchip) + tensor[0]).float()
+    direction = negative / vector_norm(negative).clamp_min(eps)
+
+    component = (tensor[0].float() * direction).sum(dim=-1, keepdim=True) * direction
+
+    tensor.sub_(component.to(tensor.dtype), alpha=settings.weight)
+    return tensor
+
+# The default CFG, then every vector is scaled back to the length it had before, so only its direction changes
+def cfg_rescale(tensor, settings, hackingchip):
+    lengths = vector_norm(tensor)
+
+    tensor.sub_(negative_difference(tensor, hackingchip), alpha=settings.weight)
+    tensor.mul_((lengths / vector_norm(tensor).clamp_min(eps)).to(tensor.dtype))
+    return tensor
+
+CFG_FUNCTIONS = {
+    'subtract': cfg_subtract,
+    'repulsor': cfg_repulsor,
+    'clamp_radius': cfg_clamp_radius,
+    'project': cfg_project,
+    'rescale': cfg_rescale,
+}
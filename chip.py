@@ -24,11 +24,16 @@ from exllamav2.attn import ExLlamaV2Attention
 
 from jinja2.sandbox import ImmutableSandboxedEnvironment
 jinja_env = ImmutableSandboxedEnvironment(trim_blocks=True, lstrip_blocks=True)
-from functools import partial
+from functools import partial, lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
 
 from exllamav2 import ext
 from exllamav2.ext import exllamav2_ext as ext_c
 import math
+import time
 from torch import nn
 
 # Detect flash-attn
@@ -45,13 +50,51 @@ try:
 except ModuleNotFoundError:
     pass
 
+# Torch SDP attention, enable_gqa (torch 2.5+) lets it take fewer K/V heads than Q heads without copying them
+
+has_sdpa = hasattr(nn.functional, 'scaled_dot_product_attention')
+torch_ver = [int(t) for t in torch.__version__.split('+')[0].split('.')[:2] if t.isdigit()]
+has_sdpa_gqa = has_sdpa and torch_ver >= [2, 5]
+
+default_attention_backend = 'auto' # used when there's no hackingchip, see attention_backend in settings_classes.py
+
 from extensions.BrainHackingChip.settings_classes import HackingchipSettings
+from extensions.BrainHackingChip.steering_program import get_program, AttnProgram
+from extensions.BrainHackingChip.steering import Workspace
+from extensions.BrainHackingChip.chip_cache import chip_cache
+from extensions.BrainHackingChip.kv_cache import HackingchipCache, make_cache, cache_matches
+from extensions.BrainHackingChip.vector_store import get_store, make_key as make_store_key
+from extensions.BrainHackingChip.profiler import steering_profiler, SpeculativeStats
+from extensions.BrainHackingChip.scheduler import request_chips, batch_scheduler, BatchRequest
+from extensions.BrainHackingChip.streaming import TokenDelta, cumulative_text, stream_deltas
 
 # Override functions to inject hackingchip behavior into model loaders. These functions need to be kept up to date with oobabooga's exllamav2
 
 # The below functions come from exllamav2, my code is just inserted into them (anything dealing with hackingchip)
 
 def hijack_generate_with_streaming(self, prompt, state):
+    # oobabooga expects the whole text so far on every token
+    yield from cumulative_text(generate_deltas(self, prompt, state))
+
+def stream_steered(exllamav2_model, prompt, state, cancel = None):
+    # Async generator of TokenDelta for callers with an event loop, prompt and state as they were given to custom_generate_chat_prompt
+    # Stopping is decided on the event loop: setting cancel (an asyncio.Event), the stop button, or closing the generator
+    def generate(should_stop):
+        lock = shared.generation_lock if hasattr(shared, 'generation_lock') else None # taken like generate_reply does
+        if lock: lock.acquire()
+        try:
+            yield from generate_deltas(exllamav2_model, prompt, state, should_stop)
+        finally:
+            if lock: lock.release()
+            
+    return stream_deltas(generate, cancel, lambda: shared.stop_everything)
+
+def generate_deltas(self, prompt, state, should_stop = None):
+    # The steered generation, yields a TokenDelta for every token and a final one with its finish_reason
+    # should_stop() ends it early, by default that's the stop button
+    if should_stop is None: should_stop = lambda: shared.stop_everything
+    started = time.perf_counter()
+    
     settings = ExLlamaV2Sampler.Settings()
     settings.temperature = state['temperature']
     settings.top_k = state['top_k']
@@ -72,8 +115,12 @@ def hijack_generate_with_streaming(self, prompt, state):
         if len(to_ban) > 0:
             settings.disallow_tokens(self.tokenizer, to_ban)
             
-    hackingchip = self.generator.model.hackingchip if hasattr(self.generator.model, 'hackingchip') else None
-    if hackingchip:
+    hackingchip = request_chips.take(state) # the hackingchip gen_full_prompt made for this request, None if the chip is off
+    row_lengths = None
+    if hackingchip and hackingchip.prompts.batch_ids and all(ids is not None for ids in hackingchip.prompts.batch_ids):
+        ids = pad_batch_ids(hackingchip.prompts.batch_ids, self.tokenizer.pad_token_id)
+        row_lengths = [row_ids.shape[-1] for row_ids in hackingchip.prompts.batch_ids]
+    elif hackingchip:
         ids = self.tokenizer.encode(hackingchip.prompts.batch_prompts if hasattr(hackingchip.prompts, 'batch_prompts') else prompt, add_bos=state['add_bos_token'], encode_special_tokens=True)
     else:
         ids = self.tokenizer.encode(prompt, add_bos=state['add_bos_token'], encode_special_tokens=True)
@@ -84,16 +131,46 @@ def hijack_generate_with_streaming(self, prompt, state):
         max_new_tokens = state['truncation_length'] - ids.shape[-1]
     else:
         max_new_tokens = state['max_new_tokens']
+    
+    # Other users' requests with the same chip can share this one's batch
+    if hackingchip and batch_users_enabled(hackingchip):
+        padding = [ids.shape[-1] - min(length, ids.shape[-1]) for length in row_lengths] if row_lengths is not None else [0] * ids.shape[0]
+        request = BatchRequest(hackingchip, ids, padding, settings, max_new_tokens, hackingchip.settings, started)
+        for delta in batch_scheduler.generate(request, partial(run_user_batch, self), shared.generation_lock, hackingchip.settings.batch_window_ms / 1000, hackingchip.settings.batch_max_requests):
+            if should_stop(): request.cancelled = True # the batch finishes this request with a 'stop' delta on its next token
+            yield delta
+        return
+    
+    # The cache, generator and active hackingchip are only set up now, while this request holds the generation lock
+    prepare_model(self, hackingchip)
+    
+    # Precomputed steering vectors from the store mean the negative rows don't have to be run at all
+    if hackingchip and hackingchip.load_stored_vectors():
+        ids = ids[:hackingchip.prompts.numpos]
+        if row_lengths is not None: row_lengths = row_lengths[:hackingchip.prompts.numpos]
+    
+    # Padding is masked out and every row's positions start at its first real token
+    if row_lengths is not None:
+        hackingchip.prompts.set_padding([ids.shape[-1] - min(length, ids.shape[-1]) for length in row_lengths])
 
+    # Only the attention layers that need it run the hijacked forward this generation
+    if hackingchip: dispatch_attention(self, hackingchip)
+    
+    if hackingchip and hackingchip.profiler: hackingchip.profiler.start(hackingchip.settings.attn_to_layers)
+    
     self.generator.begin_stream(ids, settings, loras=self.loras)
     
-    # I still need this here maybe? Not sure
-    self.generator._gen_single_token = hijack_gen_single_token.__get__(shared.model.generator, ExLlamaV2StreamingGenerator)
+    if hackingchip and hackingchip.ui_settings['output_prompts'] and hackingchip.prompts.padding_stats:
+        stats = hackingchip.prompts.padding_stats
+        print("Hackingchip padding: " + str(stats['padding']) + " padding tokens in the batch, " + str(stats['padding_computed']) + " computed in prefill (" + str(stats['prefill_tokens']) + " prefill tokens in " + str(stats['segments']) + " segments)")
     
-    decoded_text = ''
+    tokens = 0
+    finish_reason = 'length'
     for i in range(max_new_tokens):
-        chunk, eos, _ = self.generator.stream()
-        if eos or shared.stop_everything:
+        chunk, eos, token = self.generator.stream()
+        if eos or should_stop():
+            finish_reason = 'eos' if eos else 'stop'
+            
             # Below is getting skipped now and I have no idea why
             if hackingchip and hackingchip.ui_settings['sample_other_prompts'] and hasattr(hackingchip, 'real_ids'):
                 strings = self.generator.tokenizer.decode(hackingchip.real_ids)
@@ -111,37 +188,264 @@ def hijack_generate_with_streaming(self, prompt, state):
                         print(" Negative " + str(index) + ": " + string_value)
                 
             if hasattr(self.generator.model, 'hackingchip'): del self.generator.model.hackingchip # remove hackingchip after use, just in case
-            # TODO: I realized I probably should return the functions back to normal too, have to store and retrieve to do so
             break
 
-        decoded_text += chunk
-        yield decoded_text
+        yield TokenDelta(chunk, int(token[0, -1]) if isinstance(token, torch.Tensor) and token.numel() else None, tokens, None, started)
+        tokens += 1
+    
+    if hackingchip and hackingchip.profiler: hackingchip.profiler.finish(tokens)
+    
+    if hackingchip and hackingchip.speculative.verify_passes:
+        steering_profiler.add_speculative(hackingchip.speculative)
+        if hackingchip.ui_settings['output_prompts']: print("Hackingchip speculative decoding: " + hackingchip.speculative.summary())
+    
+    yield TokenDelta('', None, tokens, finish_reason, started)
+    
+def prepare_model(exllamav2_model, hackingchip, layout = None):
+    # Makes sure the cache fits the batch and installs the hackingchip (or removes it, for None), only called under the generation lock
+    # layout is (numpos, numneg, negative_cache), taken from the hackingchip if it isn't given
+    if layout is None and hackingchip: layout = (hackingchip.prompts.numpos, hackingchip.prompts.numneg, hackingchip.settings.negative_cache)
+    
+    if layout is not None:
+        numpos, numneg, negative_cache = layout
+        cache_layout = (numpos, numneg, shared.args.cache_8bit, negative_cache)
+        
+        if not cache_matches(exllamav2_model.cache, *cache_layout): # the hackingchip tends to have extra batches, so it's time to prepare for that
+            # I'm not correctly deleting the existing cache, but it gets removed from VRAM somehow anyway
+            
+            exllamav2_model.cache = make_cache(exllamav2_model.model, *cache_layout)
+            
+            # Keep the draft model for speculative decoding
+            generator = exllamav2_model.generator
+            draft_model = generator.draft_model if hasattr(generator, 'draft_model') else None
+            if draft_model is not None:
+                exllamav2_model.generator = ExLlamaV2StreamingGenerator(exllamav2_model.model, exllamav2_model.cache, exllamav2_model.tokenizer, draft_model, generator.draft_cache, generator.num_speculative_tokens)
+            else:
+                exllamav2_model.generator = ExLlamaV2StreamingGenerator(exllamav2_model.model, exllamav2_model.cache, exllamav2_model.tokenizer)
+            
+            # Binds the hijacks to the new generator
+            install_hijacks(exllamav2_model)
+    
+    if hackingchip:
+        exllamav2_model.generator.model.hackingchip = hackingchip # hackingchip installed
+    elif hasattr(exllamav2_model.generator.model, 'hackingchip'):
+        del exllamav2_model.generator.model.hackingchip
+        
+    # A steered draft model runs the whole batch, so its cache needs a row for each prompt
+    generator = exllamav2_model.generator
+    draft_model = generator.draft_model if hasattr(generator, 'draft_model') else None
+    draft = hackingchip.draft if hackingchip and hasattr(hackingchip, 'draft') else None
+    if draft_model is not None:
+        if draft:
+            if generator.draft_cache.batch_size < draft.prompts.batch_size:
+                generator.draft_cache = make_cache(draft_model, draft.prompts.batch_size, 0, shared.args.cache_8bit)
+            draft_model.hackingchip = draft
+        elif hasattr(draft_model, 'hackingchip'):
+            del draft_model.hackingchip
+
+# Cross-user batching (see scheduler.py), several users' requests with the same chip run as one batch
+# Every request's rows (positive then negative, as usual) are a group, and each group is steered with its own program on its own rows
+
+def batch_users_enabled(hackingchip):
+    # Only with --multi-user, where oobabooga's generation lock can be handed over to other requests while one is collecting a batch
+    return (getattr(hackingchip.settings, 'batch_users', False) and shared.args.multi_user and hasattr(shared, 'generation_lock')
+            and not hackingchip.ui_settings['sample_other_prompts'])
+
+def group_op(groups, ops):
+    # Runs each group's op on that group's rows, None if no group steers this site
+    steered = [(group, op) for group, op in zip(groups, ops) if op is not None]
+    if not steered: return None
+    
+    def op(x, hackingchip):
+        for group, group_op in steered:
+            rows = x.narrow(0, group.start, group.rows)
+            steered_rows = group_op(rows, group.hackingchip)
+            if steered_rows is not rows: rows.copy_(steered_rows)
+        return x
+        
+    return op
+
+class BatchedProgram:
+    # The same shape as a SteeringProgram, with every site's op covering each group
+    def __init__(self, groups):
+        programs = [group.hackingchip.program for group in groups]
+        
+        self.layers = [group_op(groups, [program.layers[idx] for program in programs]) for idx in range(len(programs[0].layers))]
+        
+        self.attn = []
+        for attn_idx in range(len(programs[0].attn)):
+            group_ops = [program.attn[attn_idx] for program in programs]
+            if all(ops is None for ops in group_ops):
+                self.attn.append(None)
+            else:
+                self.attn.append(AttnProgram(*[group_op(groups, [getattr(ops, name) if ops else None for ops in group_ops]) for name in ('h', 'q', 'k', 'v', 'a')]))
+        
+        self.steers_layers = any(op is not None for op in self.layers)
+        self.empty = not self.steers_layers and all(ops is None for ops in self.attn)
+
+class BatchedHackingchip:
+    # Stands in for the hackingchip while a cross-user batch runs, the whole batch runs every layer (no exit layer, precomputed or stored vectors)
+    def __init__(self, groups, padding):
+        self.settings = groups[0].hackingchip.settings # the same for every group
+        self.prompts = HackingchipPrompts(None, len(padding), 0)
+        self.prompts.set_padding(padding)
+        self.program = BatchedProgram(groups)
+        self.exit_layer = None
+        self.profiler = None
+        
+    def steer(self, x, op, site):
+        return op(x, self)
+
+class UserGroup:
+    # One request's rows in a cross-user batch, only its positive row is sampled
+    def __init__(self, request, start):
+        self.request = request
+        self.hackingchip = request.hackingchip
+        self.start = start
+        self.rows = request.ids.shape[0]
+        self.sequence_ids = request.ids[:1, request.padding[0]:] # the positive prompt without its padding, for the repetition penalty
+        self.prompt_length = self.sequence_ids.shape[-1]
+        self.token = request.ids[:1, -1:]
+        self.text_length = 0
+        self.done = False
+        if request.max_new_tokens <= 0: self.finish('length')
+        
+    def finish(self, reason):
+        if self.done: return
+        self.done = True
+        self.request.put(TokenDelta('', None, self.sequence_ids.shape[-1] - self.prompt_length, reason, self.request.started))
+        
+    def step(self, exllamav2_model, logits):
+        # Samples the group's next token, returns it for every row of the group (finished groups keep repeating their last token)
+        if self.request.cancelled: self.finish('stop')
+        
+        if not self.done:
+            positive_logits = copy_logits_to_host(exllamav2_model.generator, logits.narrow(0, self.start, 1))
+            token, _, eos = ExLlamaV2Sampler.sample(positive_logits, self.request.gen_settings, self.sequence_ids, random.random(), exllamav2_model.tokenizer)
+            self.token = token
+            
+            if eos:
+                self.finish('eos')
+            else:
+                self.sequence_ids = torch.cat([self.sequence_ids, token], dim = 1)
+                index = self.sequence_ids.shape[-1] - self.prompt_length - 1
+                
+                # Decoded as a whole so spaces and multi-token characters come out right, only the new part is sent
+                text = exllamav2_model.tokenizer.decode(self.sequence_ids[:, self.prompt_length:])[0]
+                if text.endswith('\ufffd'): # part of a character, wait for the rest of it
+                    chunk = ''
+                else:
+                    chunk = text[self.text_length:]
+                    self.text_length = len(text)
+                
+                self.request.put(TokenDelta(chunk, int(token[0, -1]), index, None, self.request.started))
+                if index + 1 >= self.request.max_new_tokens: self.finish('length')
+        
+        return self.token.expand(self.rows, -1)
+
+def run_user_batch(self, requests):
+    # Runs every request of a cross-user batch with its own sampler settings, yields after each token
+    try:
+        groups = []
+        start = 0
+        for request in requests:
+            groups.append(UserGroup(request, start))
+            start += request.ids.shape[0]
+        
+        # Every group is left padded again to the longest one
+        width = max(request.ids.shape[-1] for request in requests)
+        ids = pad_batch_ids([row for request in requests for row in request.ids], self.tokenizer.pad_token_id)
+        padding = [pad + width - request.ids.shape[-1] for request in requests for pad in request.padding]
+        
+        batched = BatchedHackingchip(groups, padding)
+        
+        prepare_model(self, batched, (ids.shape[0], 0, 'fp16'))
+        registry = install_hijacks(self)
+        registry.dispatch_attention([True] * len(registry.attn_patches)) # padding and per group steering need the hijacked forward everywhere
+        
+        generator = self.generator
+        model = generator.model
+        cache = generator.cache
+        
+        # The cache won't hold what the generator thinks it does anymore
+        generator.sequence_ids = None
+        generator.hackingchip_prefill_key = None
         
+        cache.current_seq_len = 0
+        if ids.shape[-1] > 1: model.forward(ids[:, :-1], cache, preprocess_only = True, loras = self.loras)
+        next_ids = ids[:, -1:]
+        
+        while not all(group.done for group in groups) and cache.current_seq_len < cache.max_seq_len:
+            logits = model.forward(next_ids, cache, loras = self.loras)
+            next_ids = torch.cat([group.step(self, logits) for group in groups], dim = 0)
+            yield
+    finally:
+        if hasattr(self.generator.model, 'hackingchip'): del self.generator.model.hackingchip
+        for group in groups: group.finish('length') # the cache is full (or something went wrong)
+        for request in requests: request.finish()
+        
+def copy_logits_to_host(owner, logits):
+    # Copies logits to the CPU through a pinned buffer that gets reused for every token
+    logits = logits.float()
+    if logits.device.type != 'cuda': return logits
+    
+    buffer = owner.hackingchip_logits_buffer if hasattr(owner, 'hackingchip_logits_buffer') else None
+    if buffer is None or buffer.shape != logits.shape:
+        buffer = torch.empty(logits.shape, dtype = torch.float32, pin_memory = True)
+        owner.hackingchip_logits_buffer = buffer
+        
+    buffer.copy_(logits)
+    return buffer
+
+def sample_other_rows(self, hackingchip, logits, token, gen_settings, prefix_token = None):
+    # Debug only: samples the rest of the batch too, so the output of the other prompts can be printed at the end
+    # This is the only place the other rows' logits ever leave the GPU
+    other_logits = logits.narrow(0, 1, logits.shape[0] - 1).float().cpu()
+    other_tokens, _, _ = ExLlamaV2Sampler.sample(other_logits, gen_settings, self.sequence_ids[1:], random.random(), self.tokenizer, prefix_token)
+    
+    tokens = torch.cat([token, other_tokens], dim = 0)
+    
+    if hasattr(hackingchip, 'real_ids'):
+        hackingchip.real_ids = torch.cat([hackingchip.real_ids, tokens], dim = 1)
+    else:
+        hackingchip.real_ids = tokens.clone()
+
 def hijack_gen_single_token(self, gen_settings, prefix_token = None):
     hackingchip = self.model.hackingchip if hasattr(self.model, 'hackingchip') else None
     
     batch_token = None
 
-    if self.draft_model is None:
-
-        logits = self.model.forward(self.sequence_ids[:, -1:], self.cache, loras = self.active_loras).float().cpu()
+    if self.draft_model is not None and hackingchip and not (hackingchip.precomputed_decode() and hackingchip.steering_vectors is None):
         
-        if hackingchip and hackingchip.ui_settings['sample_other_prompts']:
-            samplerids = self.sequence_ids
-        else:
-            logits = logits[0].unsqueeze(0)
-            samplerids = self.sequence_ids[0].unsqueeze(0)
+        token, eos = gen_single_token_speculative(self, hackingchip, gen_settings, prefix_token)
         
-        token, _, eos = ExLlamaV2Sampler.sample(logits, gen_settings, samplerids, random.random(), self.tokenizer, prefix_token)
+        if hackingchip.prompts.batch_size > 1: batch_token = token.expand(self.sequence_ids.size(0), -1)
         
-        if token.size(0) > 1:
-            if hackingchip and hackingchip.ui_settings['sample_other_prompts']:
-                if hasattr(hackingchip, 'real_ids'):
-                    hackingchip.real_ids = torch.cat([hackingchip.real_ids, token], dim = 1)
-                else:
-                    hackingchip.real_ids = token.clone()
+    elif self.draft_model is None or hackingchip:
+        
+        if hackingchip and hackingchip.precomputed_decode() and hackingchip.steering_vectors is not None:
+            # Only the positive row, the negative rows' part is already in the steering vectors
+            logits = self.model.forward(self.sequence_ids[:1, -1:], self.cache, loras = self.active_loras)
+        elif hackingchip and hackingchip.precomputed_decode():
+            # First token (the last prompt token) with the full batch, capturing the steering vectors on the way
+            hackingchip.start_capture()
+            logits = self.model.forward(self.sequence_ids[:, -1:], self.cache, loras = self.active_loras)
+            hackingchip.finish_capture()
+            hackingchip.store_vectors()
+            self.hackingchip_rows_len = self.cache.current_seq_len
             
-            token = token[0].unsqueeze(0) # only using the one positive sampled token
+            # Speculative decoding starts with the next token, the draft model has to be caught up on this one
+            if self.draft_model is not None: self.draft_model.forward(self.sequence_ids[:draft_rows(self, hackingchip), -1:], self.draft_cache, preprocess_only = True)
+        else:
+            logits = self.model.forward(self.sequence_ids[:, -1:], self.cache, loras = self.active_loras)
+            self.hackingchip_rows_len = self.cache.current_seq_len
+        
+        # Only the positive row gets sampled, so it's the only one copied to the CPU
+        positive_logits = copy_logits_to_host(self, logits.narrow(0, 0, 1))
+        token, _, eos = ExLlamaV2Sampler.sample(positive_logits, gen_settings, self.sequence_ids[:1], random.random(), self.tokenizer, prefix_token)
+        
+        if hackingchip and hackingchip.ui_settings['sample_other_prompts'] and logits.shape[0] > 1:
+            sample_other_rows(self, hackingchip, logits, token, gen_settings, prefix_token)
         
         # Maybe this if statement isn't necessary and expand won't cause issues?
         if hackingchip and hackingchip.prompts.batch_size > 1: batch_token = token.expand(self.sequence_ids.size(0), -1)
@@ -154,6 +458,221 @@ def hijack_gen_single_token(self, gen_settings, prefix_token = None):
     gen_settings.feed_filters(token)
     return token, eos
 
+def draft_rows(self, hackingchip):
+    # The draft model only runs the positive row, unless it's steered too
+    return self.sequence_ids.shape[0] if hackingchip and hackingchip.draft else 1
+
+def gen_single_token_speculative(self, hackingchip, gen_settings, prefix_token = None):
+    # exllamav2's speculative decoding, with steering: the target model verifies the whole draft in one forward with every row of the batch,
+    # so each drafted position is steered exactly like a normally decoded token (or with the precomputed vectors, positive row only)
+    # The draft is made from the positive row only, every row gets the same draft tokens the same way every row gets the same sampled token
+    stats = hackingchip.speculative
+    
+    if self.future_tokens is None:
+        
+        # Draft
+        rows = draft_rows(self, hackingchip)
+        draft_gen_settings = gen_settings.greedy_clone()
+        draft_sequence_ids = self.sequence_ids[:rows, :]
+        num_drafted_tokens = 0
+        
+        for k in range(self.num_speculative_tokens):
+            logits = self.draft_model.forward(draft_sequence_ids[:, -1:], self.draft_cache)
+            positive_logits = copy_logits_to_host(self.draft_model, logits.narrow(0, 0, 1))
+            token, prob, _ = ExLlamaV2Sampler.sample(positive_logits, draft_gen_settings, draft_sequence_ids[:1], random.random(), self.tokenizer, prefix_token if k == 0 else None)
+            
+            if prob < self.speculative_prob_threshold:
+                self.draft_cache.current_seq_len -= 1
+                break
+                
+            draft_sequence_ids = torch.cat((draft_sequence_ids, token.expand(rows, -1)), dim = 1)
+            num_drafted_tokens += 1
+            
+        # Rewind draft cache
+        self.draft_cache.current_seq_len -= num_drafted_tokens
+        
+        # Forward last sampled token plus draft through the target model, steered
+        # Each row starts from its own last token, right after the prompt those aren't the same in every row
+        self.future_tokens = draft_sequence_ids[:1, -1 - num_drafted_tokens:]
+        verify_rows = 1 if hackingchip.precomputed_decode() else self.sequence_ids.shape[0]
+        verify_ids = torch.cat((self.sequence_ids[:verify_rows, -1:], self.future_tokens[:, 1:].expand(verify_rows, -1)), dim = 1)
+        logits = self.model.forward(verify_ids, self.cache, loras = self.active_loras)
+        self.future_logits = logits.narrow(0, 0, 1).float().cpu() # only the positive row is sampled
+        
+        # Rewind model cache
+        self.cache.current_seq_len -= num_drafted_tokens + 1
+        
+        stats.drafted += num_drafted_tokens
+        stats.verify_passes += 1
+    
+    # Sample the first future logits
+    token, _, eos = ExLlamaV2Sampler.sample(self.future_logits[:, :1, :], gen_settings, self.sequence_ids[:1], random.random(), self.tokenizer, prefix_token)
+    self.future_logits = self.future_logits[:, 1:, :]
+    self.future_tokens = self.future_tokens[:, 1:]
+    self.cache.current_seq_len += 1
+    self.draft_cache.current_seq_len += 1
+    if not hackingchip.precomputed_decode(): self.hackingchip_rows_len = self.cache.current_seq_len
+    
+    # If sampled token doesn't match future token or no more future tokens
+    if self.future_tokens.shape[-1] == 0 or self.future_tokens[0, 0] != token[0, 0]:
+        self.future_tokens = None
+        self.future_logits = None
+    else:
+        stats.accepted += 1
+        
+    stats.tokens += 1
+    return token, eos
+
+def common_prefix_length(ids_a, ids_b):
+    # Longest prefix shared by every row of both batches, since the rows all share one cache position that's the min over the rows
+    length = min(ids_a.shape[-1], ids_b.shape[-1])
+    if length == 0: return 0
+    
+    mismatch = (ids_a[:, :length] != ids_b[:, :length]).any(dim=0).nonzero()
+    return int(mismatch[0]) if mismatch.numel() > 0 else length
+
+min_shared_prefix = 32 # shorter shared prefixes aren't worth the extra forward pass
+
+def shared_prefix_length(ids):
+    # Number of leading columns where every row of the batch has the same token
+    mismatch = (ids != ids[:1]).any(dim=0).nonzero()
+    return int(mismatch[0]) if mismatch.numel() > 0 else ids.shape[-1]
+
+def copy_cache_prefix(cache, length):
+    # Copies the first length positions of row 0 into every other row of the cache, for every layer
+    # Works on the raw storage so it's the same for the FP16 and 8-bit caches
+    if isinstance(cache, HackingchipCache):
+        cache.copy_prefix(length) # the row groups are stored differently
+        return
+    
+    for states in (cache.key_states, cache.value_states):
+        for layer_states in states:
+            if layer_states is None: continue
+            
+            source = layer_states.narrow(0, 0, 1).narrow(1, 0, length)
+            layer_states.narrow(0, 1, cache.batch_size - 1).narrow(1, 0, length).copy_(source)
+
+def steers_identical_rows(settings):
+    # The default CFG (mean or max_margin) only steers by the difference between rows, so it does nothing where every row is the same
+    # A cfg_func can still change identical rows (scaling, projecting, adding its own terms), so any cfg_func counts
+    for layer_settings in settings.layer_settings:
+        if layer_settings is not None and layer_settings.cfg_func: return True
+        
+    for attn_settings in settings.attn_settings:
+        if attn_settings is None: continue
+        for vector_settings in (attn_settings.h, attn_settings.q, attn_settings.k, attn_settings.v, attn_settings.a):
+            if vector_settings is not None and vector_settings.cfg_func: return True
+            
+    return False
+
+min_ragged_savings = 256 # a prefill segment is only split off when it skips at least this many padding tokens
+
+def plan_prefill(prompts, batch_size, start, end):
+    # Splits the prefill of columns start to end into (rows, start, end) segments
+    # Rows are left padded, so a column only needs the rows that already have a real token there, and since rows are
+    # taken from the front of the batch, a segment uses every row up to the last one that has real tokens in it
+    padding = prompts.padding if prompts and prompts.padded else None
+    
+    if padding is None:
+        segments = [(batch_size, start, end)]
+    else:
+        segments = []
+        segment_start = start
+        
+        for boundary in sorted(set(pad for pad in padding if start < pad < end)) + [end]:
+            rows = 1 + max(row for row, pad in enumerate(padding) if pad < boundary)
+            
+            # Merge into the last segment unless splitting actually skips enough padding
+            if segments and (rows - segments[-1][0]) * (segments[-1][2] - segments[-1][1]) < min_ragged_savings:
+                segments[-1] = (rows, segments[-1][1], boundary)
+            else:
+                segments.append((rows, segment_start, boundary))
+                
+            segment_start = boundary
+            
+    if prompts:
+        padding_computed = 0
+        for rows, segment_start, segment_end in segments:
+            for row in range(rows):
+                padding_computed += max(0, min(padding[row], segment_end) - segment_start) if padding else 0
+                
+        prompts.padding_stats = {
+            'padding': sum(padding) if padding else 0,
+            'padding_computed': padding_computed,
+            'prefill_tokens': sum(rows * (segment_end - segment_start) for rows, segment_start, segment_end in segments),
+            'segments': len(segments)
+        }
+        
+    return segments
+
+def hijack_gen_begin(self, in_tokens, gen_settings):
+    hackingchip = self.model.hackingchip if hasattr(self.model, 'hackingchip') else None
+    
+    self.cache.current_seq_len = 0
+    self.sequence_ids = in_tokens
+    
+    # The rows usually only differ starting at the context/system message, so anything before that is prefilled once at batch size 1
+    # Identical rows have identical states, so with only the default CFG steering can be left off for it
+    shared_len = 0
+    if hackingchip and in_tokens.shape[0] > 1 and isinstance(self.cache, ExLlamaV2CacheBase) and in_tokens.shape[0] == self.cache.batch_size and not steers_identical_rows(hackingchip.settings):
+        shared_len = shared_prefix_length(in_tokens[:, :-1])
+        if shared_len < min_shared_prefix: shared_len = 0
+        
+    if shared_len > 0:
+        self.model.hackingchip = None
+        try:
+            self.model.forward(in_tokens[:1, :shared_len], self.cache, preprocess_only = True, loras = self.active_loras)
+        finally:
+            self.model.hackingchip = hackingchip
+            
+        copy_cache_prefix(self.cache, shared_len)
+        
+    if shared_len < in_tokens.shape[-1] - 1:
+        segments = plan_prefill(hackingchip.prompts if hackingchip else None, in_tokens.shape[0], shared_len, in_tokens.shape[-1] - 1)
+        
+        for rows, start, end in segments:
+            self.cache.current_seq_len = start
+            self.model.forward(in_tokens[:rows, start:end], self.cache, preprocess_only = True, loras = self.active_loras)
+    
+    self.hackingchip_rows_len = self.cache.current_seq_len
+    
+    if self.draft_model is not None:
+        self.future_tokens = None
+        self.future_logits = None
+        self.draft_cache.current_seq_len = 0
+        self.draft_model.forward(in_tokens[:in_tokens.shape[0] if hackingchip and hackingchip.draft else 1, :-1], self.draft_cache, preprocess_only = True)
+
+def hijack_gen_begin_reuse(self, in_tokens, gen_settings):
+    hackingchip = self.model.hackingchip if hasattr(self.model, 'hackingchip') else None
+    prefill_key = hackingchip.prefill_key() if hackingchip else None
+    
+    # The steered rows' cache is only reusable if it was made with the same chip settings and the same batch layout
+    reuse = 0
+    if self.sequence_ids is not None and self.cache.current_seq_len > 0 and self.draft_model is None:
+        if getattr(self, 'hackingchip_prefill_key', None) == prefill_key and self.sequence_ids.shape[0] == in_tokens.shape[0]:
+            reuse = common_prefix_length(self.sequence_ids, in_tokens)
+            
+            # Past this point only the positive row was decoded (precomputed steering), the other rows have nothing in the cache
+            rows_len = getattr(self, 'hackingchip_rows_len', None)
+            if rows_len is not None: reuse = min(reuse, rows_len + 1)
+            
+    self.hackingchip_prefill_key = prefill_key
+    
+    if reuse < 2:
+        self._gen_begin(in_tokens, gen_settings)
+        return
+    
+    # Only the new suffix of every row gets prefilled, the rest is already in the cache from the last turn
+    self.cache.current_seq_len = reuse - 1
+    self.sequence_ids = in_tokens[:, :reuse]
+    
+    if reuse < in_tokens.shape[-1]: self._gen_feed_tokens(in_tokens[:, reuse:], gen_settings)
+    self.hackingchip_rows_len = self.cache.current_seq_len
+
+def narrow_batch(rows, *tensors):
+    # Keeps the first rows of every per-row tensor (the positive rows always come first), leaving None and shared tensors alone
+    return tuple(t.narrow(0, 0, rows) if isinstance(t, torch.Tensor) and t.dim() > 0 and t.shape[0] > rows else t for t in tensors)
+
 @torch.inference_mode()
 def hijack_model_forward(self,
                 input_ids,
@@ -183,6 +702,22 @@ def hijack_model_forward(self,
     last_state = None
     
     hackingchip = self.hackingchip if hasattr(self, 'hackingchip') else None
+    layer_ops = hackingchip.program.layers if hackingchip and hackingchip.program.steers_layers else None # steering op of each layer, None for most
+    
+    # Padded batches get their padding mask and position offsets from the hackingchip, narrowed to however many rows this forward has
+    if hackingchip and hackingchip.prompts.padded:
+        if input_mask is None: input_mask = narrow_batch(batch_size, hackingchip.prompts.input_mask)[0]
+        if position_offsets is None: position_offsets = narrow_batch(batch_size, hackingchip.prompts.position_offsets)[0]
+    
+    # Negative rows are only needed up to the deepest steered layer, after that only the positive rows continue
+    exit_layer = None
+    if hackingchip and hackingchip.exit_layer is not None and not isinstance(cache, list) and batch_size > hackingchip.prompts.numpos:
+        exit_layer = hackingchip.exit_layer
+        
+        if exit_layer < 0: # nothing is steered at all
+            batch_size = hackingchip.prompts.numpos
+            x, input_mask, position_offsets = narrow_batch(batch_size, x, input_mask, position_offsets)
+            exit_layer = None
 
     for idx, module in enumerate(self.modules):
 
@@ -212,18 +747,12 @@ def hijack_model_forward(self,
         x = module.forward(x, cache = cache, attn_mask = attn_mask, past_len = past_len, loras = loras, position_offsets = position_offsets)
         
         # Deprecated, moving to an attn focused setup
-        if hackingchip and hackingchip.prompts.numneg > 0 and hackingchip.settings.layer_settings[idx] != None:
-            settings = hackingchip.settings.layer_settings[idx]
-            
-            if settings.cfg_func:
-                x = settings.cfg_func(x, settings, hackingchip)
-            else:
-                x_neg_steering = x[hackingchip.prompts.numpos:hackingchip.prompts.negend]
-                x_neg_steering = torch.mean(x_neg_steering, dim=0, keepdim=False) # probably not the best way to handle this but oh well
-                x_neg_steering = settings.weight * (x_neg_steering - x[0])
-
-                # It's important to steer all of the vectors, or else the difference artificially accumulates and accelerates.
-                x -= x_neg_steering
+        if layer_ops and layer_ops[idx] is not None:
+            x = hackingchip.steer(x, layer_ops[idx], ('layer', idx))
+                
+        if idx == exit_layer:
+            batch_size = hackingchip.prompts.numpos
+            x, input_mask, position_offsets, attn_mask = narrow_batch(batch_size, x, input_mask, position_offsets, attn_mask)
         
         if preprocess_only and idx == self.last_kv_layer_idx:
             x = None
@@ -246,29 +775,96 @@ def hijack_model_forward(self,
 
     return x, last_state
 
+def matmul_attention(self, q_states, k_states, v_states, attn_mask):
+    # Torch matmul attention, q/k/v are (batch, seq, heads, head_dim) and the output is (batch, q_len, hidden_size)
+    batch_size, q_len = q_states.shape[0], q_states.shape[1]
+    num_key_value_groups = self.model.config.num_key_value_groups
+    head_dim = self.model.config.head_dim
+    
+    q_states = q_states.transpose(1, 2)
+    k_states = k_states.transpose(1, 2)
+    v_states = v_states.transpose(1, 2)
+
+    k_states = self.repeat_kv(k_states, num_key_value_groups)
+    k_states = k_states.transpose(-1, -2)
+
+    attn_weights = torch.matmul(q_states, k_states)
+    k_states = None
+    q_states = None
+
+    attn_weights /= math.sqrt(head_dim)
+    if attn_mask is not None: attn_weights = attn_weights + attn_mask
+    attn_weights = nn.functional.softmax(attn_weights, dim = -1, dtype = torch.float16)
+
+    v_states = self.repeat_kv(v_states, num_key_value_groups)
+    attn_output = torch.matmul(attn_weights, v_states)
+    v_states = None
+
+    attn_output = attn_output.transpose(1, 2)
+    return attn_output.reshape((batch_size, q_len, self.model.config.hidden_size))
+
+def sdpa_attention(self, q_states, k_states, v_states, attn_mask):
+    # Torch SDP attention without repeat_kv, same shapes as matmul_attention
+    # Grouped-query attention is done by broadcasting: enable_gqa where torch has it, otherwise each K/V head's group of Q heads
+    # is folded into the query length, so a group of Q heads attends to its K/V head as one longer query (only the small mask gets repeated)
+    batch_size, q_len = q_states.shape[0], q_states.shape[1]
+    num_attention_heads = self.model.config.num_attention_heads
+    num_key_value_heads = self.model.config.num_key_value_heads
+    num_key_value_groups = self.model.config.num_key_value_groups
+    head_dim = self.model.config.head_dim
+    
+    q_states = q_states.transpose(1, 2)
+    k_states = k_states.transpose(1, 2)
+    v_states = v_states.transpose(1, 2)
+    
+    if attn_mask is not None and attn_mask.dim() == 3: attn_mask = attn_mask.unsqueeze(1)
+    
+    if num_key_value_groups == 1:
+        attn_output = nn.functional.scaled_dot_product_attention(q_states, k_states, v_states, attn_mask = attn_mask)
+    elif has_sdpa_gqa:
+        attn_output = nn.functional.scaled_dot_product_attention(q_states, k_states, v_states, attn_mask = attn_mask, enable_gqa = True)
+    else:
+        q_states = q_states.reshape(batch_size, num_key_value_heads, num_key_value_groups * q_len, head_dim)
+        if attn_mask is not None:
+            mask_batch, kv_len = attn_mask.shape[0], attn_mask.shape[-1]
+            attn_mask = attn_mask.unsqueeze(2).expand(mask_batch, 1, num_key_value_groups, q_len, kv_len).reshape(mask_batch, 1, num_key_value_groups * q_len, kv_len)
+        attn_output = nn.functional.scaled_dot_product_attention(q_states, k_states, v_states, attn_mask = attn_mask)
+        attn_output = attn_output.reshape(batch_size, num_attention_heads, q_len, head_dim) # the fused kernels' output isn't contiguous
+        
+    attn_output = attn_output.transpose(1, 2)
+    return attn_output.reshape((batch_size, q_len, self.model.config.hidden_size))
+
+attention_backends = {
+    'matmul': matmul_attention,
+    'sdpa': sdpa_attention,
+}
+
+def select_attention(hackingchip):
+    # The attention function for this call when flash-attn isn't used, 'auto' is SDP attention wherever torch has it
+    backend = hackingchip.settings.attention_backend if hackingchip and hasattr(hackingchip.settings, 'attention_backend') else default_attention_backend
+    
+    if backend == 'auto' or backend not in attention_backends:
+        backend = 'sdpa' if has_sdpa else 'matmul'
+    elif backend == 'sdpa' and not has_sdpa:
+        backend = 'matmul'
+        
+    return attention_backends[backend]
+
 def hijack_attn_forward(self, hidden_states, cache = None, attn_mask = None, past_len = None, intermediates = False, loras = None, position_offsets = None):
     global has_flash_attn
 
     qkv_embed = self.model.config.qkv_embed and self.layer_idx == 0
 
-    def hack_states(states, states_settings):
-        if states_settings.cfg_func:
-            states = states_settings.cfg_func(states, states_settings, hackingchip)
-        else:
-            if hackingchip.prompts.numneg > 0 and states_settings.weight != 0.0:
-                state_neg_steering = states[hackingchip.prompts.numpos:hackingchip.prompts.negend]
-                state_neg_steering = torch.mean(state_neg_steering, dim=0, keepdim=False) # probably not the best way to handle this but oh well
-                state_neg_steering = states_settings.weight * (state_neg_steering - states[0])
-                
-                states -= state_neg_steering
+    def hack_states(states, op, name):
+        hackingchip.steer(states, op, (self.layer_idx, name))
     
     #Hacking chip stuff
-    hackingchip = shared.model.generator.model.hackingchip if hasattr(shared.model.generator.model, 'hackingchip') else None
-    chip_settings = hackingchip.settings.attn_settings[self.layer_idx] if hackingchip and hackingchip.settings.attn_settings[self.layer_idx] != None else None
+    hackingchip = self.model.hackingchip if hasattr(self.model, 'hackingchip') else None
+    attn_ops = hackingchip.program.attn[self.layer_idx] if hackingchip else None # steering ops for this layer's vectors, None if none are steered
     
     #Hacking chip stuff
-    if chip_settings:
-        if chip_settings.h: hack_states(hidden_states, chip_settings.h)
+    if attn_ops:
+        if attn_ops.h: hack_states(hidden_states, attn_ops.h, 'h')
     
     if self.q_handle is None or intermediates:
         return self.forward_torch(hidden_states, cache, attn_mask, past_len, intermediates, loras = loras, position_offsets = position_offsets)
@@ -280,7 +876,7 @@ def hijack_attn_forward(self, hidden_states, cache = None, attn_mask = None, pas
         batch_size = hidden_states.shape[0]
         q_len = hidden_states.shape[1]
 
-    direct = (batch_size == 1 and cache is not None and isinstance(cache, ExLlamaV2CacheBase)) and not qkv_embed
+    direct = (batch_size == 1 and cache is not None and isinstance(cache, ExLlamaV2CacheBase) and not isinstance(cache, HackingchipCache)) and not qkv_embed
 
     # past_len = 0
     # if cache is not None:
@@ -370,14 +966,50 @@ def hijack_attn_forward(self, hidden_states, cache = None, attn_mask = None, pas
     v_states = v_states.view(batch_size, q_len, num_key_value_heads, head_dim)
 
     #Hacking chip stuff
-    if chip_settings:
-        if chip_settings.q: hack_states(q_states, chip_settings.q)
-        if chip_settings.k: hack_states(k_states, chip_settings.k)
-        if chip_settings.v: hack_states(v_states, chip_settings.v)
+    if attn_ops:
+        if attn_ops.q: hack_states(q_states, attn_ops.q, 'q')
+        if attn_ops.k: hack_states(k_states, attn_ops.k, 'k')
+        if attn_ops.v: hack_states(v_states, attn_ops.v, 'v')
+        
+    # flash-attn can't take the padding mask
+    use_flash_attn = has_flash_attn and not self.model.config.no_flash_attn and not (hackingchip and hackingchip.prompts.padded)
+    attention = select_attention(hackingchip) if not use_flash_attn else None
+    
+    # Hackingchip cache with row groups, each group of rows reads and writes its own cache
+    
+    if isinstance(cache, HackingchipCache):
         
+        attn_outputs = []
+        for start, rows, group_cache in cache.groups(batch_size):
+            
+            batch_keys, batch_values = group_cache.get_kv_state(self.layer_idx, rows, 0, past_len)
+            batch_keys = batch_keys.narrow(0, 0, rows)
+            batch_values = batch_values.narrow(0, 0, rows)
+            batch_keys.narrow(1, past_len, q_len).copy_(k_states.narrow(0, start, rows))
+            batch_values.narrow(1, past_len, q_len).copy_(v_states.narrow(0, start, rows))
+            
+            q_states_b = q_states.narrow(0, start, rows)
+            k_states_b = batch_keys.narrow(1, 0, past_len + q_len)
+            v_states_b = batch_values.narrow(1, 0, past_len + q_len)
+            
+            if use_flash_attn:
+                attn_output_b = flash_attn_func(q_states_b, k_states_b, v_states_b, causal = True).reshape((rows, q_len, hidden_size))
+            else:
+                attn_mask_b = attn_mask.narrow(0, start, rows) if attn_mask is not None and attn_mask.shape[0] > 1 else attn_mask
+                attn_output_b = attention(self, q_states_b, k_states_b, v_states_b, attn_mask_b)
+                
+            group_cache.store_kv_state(self.layer_idx, rows, past_len, q_len)
+            attn_outputs.append(attn_output_b)
+            
+        q_states = None
+        k_states = None
+        v_states = None
+            
+        attn_output = torch.cat(attn_outputs, dim = 0) if len(attn_outputs) > 1 else attn_outputs[0]
+
     # Regular (batched) attention with optional padding mask
 
-    if cache is None or isinstance(cache, ExLlamaV2CacheBase):
+    elif cache is None or isinstance(cache, ExLlamaV2CacheBase):
 
         # Add keys and values to cache
 
@@ -396,37 +1028,20 @@ def hijack_attn_forward(self, hidden_states, cache = None, attn_mask = None, pas
                 new_keys.copy_(k_states)
                 new_values.copy_(v_states)
 
-                # Key/value tensors with past
-
-                k_states = batch_keys.narrow(1, 0, past_len + q_len)
-                v_states = batch_values.narrow(1, 0, past_len + q_len)
+                # Key/value tensors with past (only the rows in this batch, the hackingchip can run fewer rows than the cache has)
 
-        # Torch matmul attention
-
-        if self.model.config.no_flash_attn or not has_flash_attn:
+                k_states = batch_keys.narrow(0, 0, batch_size).narrow(1, 0, past_len + q_len)
+                v_states = batch_values.narrow(0, 0, batch_size).narrow(1, 0, past_len + q_len)
 
-            q_states = q_states.transpose(1, 2)
-            k_states = k_states.transpose(1, 2)
-            v_states = v_states.transpose(1, 2)
+        # Torch attention (SDP or matmul)
 
-            k_states = self.repeat_kv(k_states, num_key_value_groups)
-            k_states = k_states.transpose(-1, -2)
+        if not use_flash_attn:
 
-            attn_weights = torch.matmul(q_states, k_states)
+            attn_output = attention(self, q_states, k_states, v_states, attn_mask)
             k_states = None
             q_states = None
-
-            attn_weights /= math.sqrt(head_dim)
-            if attn_mask is not None: attn_weights = attn_weights + attn_mask
-            attn_weights = nn.functional.softmax(attn_weights, dim = -1, dtype = torch.float16)
-
-            v_states = self.repeat_kv(v_states, num_key_value_groups)
-            attn_output = torch.matmul(attn_weights, v_states)
             v_states = None
 
-            attn_output = attn_output.transpose(1, 2)
-            attn_output = attn_output.reshape((batch_size, q_len, hidden_size))
-
         # Flash Attention 2
 
         else:
@@ -439,19 +1054,6 @@ def hijack_attn_forward(self, hidden_states, cache = None, attn_mask = None, pas
         # attn_output = xops.memory_efficient_attention(q_states, k_states, v_states, attn_bias = xops.LowerTriangularMask())
         # attn_output = attn_output.reshape((batch_size, q_len, hidden_size));
 
-        # Torch SDP attention:
-
-        # q_states = q_states.transpose(1, 2)
-        # k_states = k_states.transpose(1, 2)
-        # v_states = v_states.transpose(1, 2)
-        #
-        # # k_states = self.repeat_kv(k_states, num_key_value_groups)
-        # # v_states = self.repeat_kv(v_states, num_key_value_groups)
-        #
-        # attn_output = F.scaled_dot_product_attention(q_states, k_states, v_states, attn_mask = attn_mask, is_causal = False)
-        # attn_output = attn_output.transpose(1, 2)
-        # attn_output = attn_output.reshape((batch_size, q_len, hidden_size))
-
         # Update 8-bit cache
 
         if cache is not None:
@@ -479,27 +1081,14 @@ def hijack_attn_forward(self, hidden_states, cache = None, attn_mask = None, pas
             k_states_b = batch_keys.narrow(1, 0, past_len[1][i] + q_len)
             v_states_b = batch_values.narrow(1, 0, past_len[1][i] + q_len)
 
-            # Torch matmul attention
+            # Torch attention (SDP or matmul)
 
             # TODO: enable flash-attn
 
-            q_states_b = q_states.transpose(1, 2).narrow(0, i, 1)
-            k_states_b = k_states_b.transpose(1, 2)
-            v_states_b = v_states_b.transpose(1, 2)
-
-            k_states_b = self.repeat_kv(k_states_b, num_key_value_groups)
-            k_states_b = k_states_b.transpose(-1, -2)
-
-            attn_weights = torch.matmul(q_states_b, k_states_b)
+            q_states_b = q_states.narrow(0, i, 1)
+            attn_output_b = (attention or select_attention(hackingchip))(self, q_states_b, k_states_b, v_states_b, attn_mask[i] if attn_mask is not None else None)
             q_states_b = None
             k_states_b = None
-
-            attn_weights /= math.sqrt(head_dim)
-            if attn_mask is not None: attn_weights = attn_weights + attn_mask[i]
-            attn_weights = nn.functional.softmax(attn_weights, dim = -1, dtype = torch.float16)
-
-            v_states_b = self.repeat_kv(v_states_b, num_key_value_groups)
-            attn_output_b = torch.matmul(attn_weights, v_states_b)
             v_states_b = None
 
             attn_outputs.append(attn_output_b)
@@ -509,8 +1098,6 @@ def hijack_attn_forward(self, hidden_states, cache = None, attn_mask = None, pas
         v_states = None
 
         attn_output = torch.cat(attn_outputs, dim = 0)
-        attn_output = attn_output.transpose(1, 2)
-        attn_output = attn_output.reshape((batch_size, q_len, hidden_size))
 
     # Output projection
 
@@ -526,79 +1113,340 @@ def hijack_attn_forward(self, hidden_states, cache = None, attn_mask = None, pas
     attn_weights = None
     
     #Hacking chip stuff
-    if chip_settings:
-        if chip_settings.a: hack_states(hidden_states, chip_settings.a)
+    if attn_ops:
+        if attn_ops.a: hack_states(hidden_states, attn_ops.a, 'a')
 
     return hidden_states
 
 # Here is the actual construction and injection of the hackingchip into the model
 
+def current_hijacks():
+    return (hijack_generate_with_streaming, hijack_gen_single_token, hijack_gen_begin, hijack_gen_begin_reuse, hijack_model_forward, hijack_attn_forward)
+
+class HijackRegistry:
+    # Keeps track of every function the hackingchip replaces, so the hijacks only get bound once per model load
+    # and the stock exllamav2 functions can be put back when the chip is switched off
+    def __init__(self, exllamav2_model):
+        self.model = exllamav2_model.generator.model
+        self.generator = exllamav2_model.generator
+        self.hijacks = current_hijacks() # changes if chip.py gets reloaded
+        self.installed = False
+        self.patches = [] # (object, attribute name, hijacked bound method, had its own attribute, original attribute)
+        self.attn_patches = [] # the attention forward patches, in attention layer order
+        
+        self.add(exllamav2_model, 'generate_with_streaming', hijack_generate_with_streaming, Exllamav2Model)
+        self.add(self.generator, '_gen_single_token', hijack_gen_single_token, ExLlamaV2StreamingGenerator)
+        self.add(self.generator, '_gen_begin', hijack_gen_begin, ExLlamaV2StreamingGenerator)
+        self.add(self.generator, '_gen_begin_reuse', hijack_gen_begin_reuse, ExLlamaV2StreamingGenerator)
+        self.add(self.model, '_forward', hijack_model_forward, ExLlamaV2)
+        
+        for module in self.model.modules:
+            if isinstance(module, ExLlamaV2Attention):
+                self.attn_patches.append(self.add(module, 'forward', hijack_attn_forward, ExLlamaV2Attention))
+                
+        # The draft model (speculative decoding) only runs the hijacked forwards while it's steered
+        self.draft_patches = []
+        draft_model = self.generator.draft_model if hasattr(self.generator, 'draft_model') else None
+        if draft_model is not None:
+            self.draft_patches.append(self.add(draft_model, '_forward', hijack_model_forward, ExLlamaV2))
+            
+            for module in draft_model.modules:
+                if isinstance(module, ExLlamaV2Attention):
+                    self.draft_patches.append(self.add(module, 'forward', hijack_attn_forward, ExLlamaV2Attention))
+                
+    def add(self, obj, name, func, cls):
+        had_attr = name in obj.__dict__
+        patch = (obj, name, func.__get__(obj, cls), had_attr, obj.__dict__[name] if had_attr else None)
+        self.patches.append(patch)
+        return patch
+        
+    def matches(self, exllamav2_model):
+        return self.generator is exllamav2_model.generator and self.model is exllamav2_model.generator.model and self.hijacks == current_hijacks()
+        
+    def install(self):
+        if self.installed: return
+        
+        for obj, name, hijack, had_attr, original in self.patches:
+            setattr(obj, name, hijack)
+            
+        self.installed = True
+        
+    def uninstall(self):
+        if not self.installed: return
+        
+        for patch in self.patches:
+            self.restore(patch)
+                
+        self.installed = False
+        
+    def restore(self, patch):
+        obj, name, hijack, had_attr, original = patch
+        if had_attr:
+            setattr(obj, name, original)
+        elif name in obj.__dict__:
+            delattr(obj, name) # falls back to the class's own function
+            
+    def dispatch_attention(self, hijacked):
+        # hijacked[attention layer index] says if that layer runs hijack_attn_forward or exllamav2's own forward
+        if not self.installed: return
+        
+        for patch, use_hijack in zip(self.attn_patches, hijacked):
+            if use_hijack:
+                setattr(patch[0], patch[1], patch[2])
+            else:
+                self.restore(patch)
+                
+    def dispatch_draft(self, steered):
+        if not self.installed: return
+        
+        for patch in self.draft_patches:
+            if steered:
+                setattr(patch[0], patch[1], patch[2])
+            else:
+                self.restore(patch)
+        
+def install_hijacks(exllamav2_model):
+    registry = exllamav2_model.hackingchip_hijacks if hasattr(exllamav2_model, 'hackingchip_hijacks') else None
+    
+    if registry is None or not registry.matches(exllamav2_model): # new model, new generator or chip.py was reloaded
+        if registry: registry.uninstall()
+        registry = HijackRegistry(exllamav2_model)
+        exllamav2_model.hackingchip_hijacks = registry
+        
+    registry.install()
+    return registry
+
+def dispatch_attention(exllamav2_model, hackingchip):
+    registry = exllamav2_model.hackingchip_hijacks if hasattr(exllamav2_model, 'hackingchip_hijacks') else None
+    if registry:
+        registry.dispatch_attention(hackingchip.hijacked_attention(exllamav2_model.generator.cache))
+        registry.dispatch_draft(hackingchip.draft is not None)
+
+def uninstall_hijacks(exllamav2_model):
+    registry = exllamav2_model.hackingchip_hijacks if hasattr(exllamav2_model, 'hackingchip_hijacks') else None
+    if registry: registry.uninstall()
+    
+    if hasattr(exllamav2_model.generator.model, 'hackingchip'): del exllamav2_model.generator.model.hackingchip
+    
+    # The cache still holds steered rows, don't let the stock generator reuse them
+    generator = exllamav2_model.generator
+    if getattr(generator, 'hackingchip_prefill_key', None) is not None:
+        generator.sequence_ids = None
+        generator.hackingchip_prefill_key = None
+
 class Hackingchip:
     def __init__(self, ui_settings, settings, prompts):
         self.ui_settings = ui_settings
         self.settings = settings
         self.prompts = prompts
+        self.program = get_program(settings, prompts) # the chip's steering ops, only built once for each chip and batch layout
+        self.steering = self.program.steering # coefficients for the default CFG
+        self.workspace = Workspace() # scratch buffers for the steering math, sized by the first forward and reused for every token after
+        self.exit_layer = self.find_exit_layer()
+        
+        # Precomputed steering: per site steering vectors captured on the first decode step (full batch), then decoding continues at batch size 1
+        self.capturing = False
+        self.captured_vectors = None
+        self.steering_vectors = None
+        self.vectors_only = False # True when the steering vectors came from the store and the negative rows aren't run at all
+        
+        self.profiler = steering_profiler if ui_settings.get('profile_steering') else None # None unless profiling was switched on in the UI
+        
+        self.draft = None # the same chip built for the draft model's layers, when the draft model (speculative decoding) is steered too
+        self.speculative = SpeculativeStats() # draft tokens proposed and accepted this generation
+        
+    def find_exit_layer(self):
+        # The deepest layer any steering touches, negative rows are dropped from the batch after it
+        # None means the negative rows are needed all the way through (no negatives, head layer CFG, or sampling the other prompts)
+        if self.prompts.numneg == 0 or self.ui_settings['sample_other_prompts']: return None
+        
+        deepest = self.program.deepest_layer(self.settings.attn_to_layers)
+        
+        if deepest >= len(self.settings.layer_settings) - 1: return None
+        
+        return deepest
+        
+    def hijacked_attention(self, cache):
+        # Which attention layers need hijack_attn_forward for this generation, the others run exllamav2's own forward
+        # Besides the steered layers, exllamav2's forward can't handle a HackingchipCache or padding, or running fewer rows than
+        # the cache has (after the exit layer, or decoding with precomputed vectors) unless it's a single row (its direct path)
+        if not isinstance(cache, ExLlamaV2CacheBase) or isinstance(cache, HackingchipCache) or self.prompts.padded:
+            return [True] * len(self.program.attn)
+        
+        fewer_rows = self.prompts.numpos > 1 and self.prompts.numneg > 0
+        all_fewer_rows = fewer_rows and (self.settings.precompute_steering or self.vectors_only)
+        
+        hijacked = []
+        for attn_idx, ops in enumerate(self.program.attn):
+            layer_idx = self.settings.attn_to_layers[attn_idx]
+            after_exit = self.exit_layer is not None and layer_idx > self.exit_layer
+            hijacked.append(ops is not None or all_fewer_rows or (fewer_rows and after_exit))
+            
+        return hijacked
+        
+    def steer(self, x, op, site):
+        # Applies one steering site (a layer or one of an attention layer's H, Q, K, V, A vectors) to x with its op from the program and returns it
+        if self.profiler: return self.profiler.measure(self.steer_site, x, op, site)
+        return self.steer_site(x, op, site)
+    
+    def steer_site(self, x, op, site):
+        if x.shape[0] < self.prompts.negend:
+            # No negative rows here: either part of a ragged prefill that doesn't have them yet, or a batch size 1 decode with precomputed vectors
+            vector = self.steering_vectors.get(site) if self.steering_vectors is not None else None
+            if vector is not None:
+                if vector.device != x.device or vector.dtype != x.dtype: # stored vectors start out on the CPU
+                    vector = vector.to(device = x.device, dtype = x.dtype)
+                    self.steering_vectors[site] = vector
+                x.sub_(vector)
+            return x
+        
+        if self.capturing: before = x[0, -1].clone()
+        
+        x = op(x, self)
+            
+        # Keep what was subtracted from the positive row at the last position, that's reused for every later token
+        if self.capturing: self.captured_vectors[site] = before - x[0, -1]
+        
+        return x
+    
+    def start_capture(self):
+        self.capturing = True
+        self.captured_vectors = {}
+        
+    def finish_capture(self):
+        self.capturing = False
+        self.steering_vectors = self.captured_vectors
+        self.captured_vectors = None
+    
+    def store_key(self):
+        # Stored vectors are shared by every conversation with the same model, chip (file and slider values), layout and negative prompts
+        negative_variants = self.prompts.variants[self.prompts.numpos:self.prompts.negend] if self.prompts.variants else None
+        if not negative_variants: return None
+        
+        layout = (len(self.settings.layer_settings), tuple(self.settings.attn_to_layers))
+        return make_store_key(getattr(shared, 'model_name', None), getattr(self.settings, 'chip_key', None), layout, self.prompts.neg_names, negative_variants)
+    
+    def load_stored_vectors(self):
+        if not (self.settings.steering_store and self.precomputed_decode()): return False
+        
+        key = self.store_key()
+        vectors = get_store(max_bytes = self.settings.steering_store_mb * 1024 * 1024).load(key) if key else None
+        if vectors is None: return False
+        
+        self.steering_vectors = vectors
+        self.vectors_only = True
+        return True
+    
+    def store_vectors(self):
+        if not (self.settings.steering_store and self.steering_vectors): return
+        
+        key = self.store_key()
+        if key: get_store(max_bytes = self.settings.steering_store_mb * 1024 * 1024).save(key, self.steering_vectors)
+    
+    def precomputed_decode(self):
+        # Decoding at batch size 1 with steering vectors captured from the full batch
+        return self.settings.precompute_steering and self.prompts.numneg > 0 and not self.ui_settings['sample_other_prompts']
+        
+    def prefill_key(self):
+        # Anything that changes what ends up in the cache for the same tokens, used to decide if last turn's cache can be reused
+        return (self.settings, self.prompts.numpos, self.prompts.numneg, tuple(self.prompts.neg_names or ()), self.exit_layer, self.precomputed_decode(), self.vectors_only)
         
 class HackingchipPrompts:
-    def __init__(self, prompts, numpos, numneg):
+    def __init__(self, prompts, numpos, numneg, neg_names=None, batch_ids=None):
         self.batch_prompts = prompts
+        self.batch_ids = batch_ids # token ids of each prompt, made while rendering so they don't have to be encoded again
+        self.variants = None # (context, custom system message) of each prompt
         self.numpos = numpos
         self.numneg = numneg
+        self.neg_names = neg_names # section name of each negative prompt, in batch order (used for per negative weights)
         self.negend = numpos + numneg
         self.batch_size = numpos + numneg
         
-def gen_full_prompt(user_settings, ui_settings, ui_params, user_input, state, **kwargs):
-    settings = None
-    
-    if shared.model != None and isinstance(shared.model, Exllamav2Model): # hackingchippable
-        last_kv_layer = shared.model.generator.model.last_kv_layer_idx
-        head_layer = shared.model.generator.model.head_layer_idx
+        self.padding = None # number of left padding tokens in each row
+        self.padded = False
+        self.input_mask = None
+        self.position_offsets = None
+        self.padding_stats = None
         
-        attn_layers = []
+    def positive_only(self):
+        prompts = HackingchipPrompts(self.batch_prompts[:self.numpos], self.numpos, 0, batch_ids=self.batch_ids[:self.numpos] if self.batch_ids else None)
+        prompts.variants = self.variants[:self.numpos] if self.variants else None
+        return prompts
         
-        for idx, module in enumerate(shared.model.generator.model.modules):
-            if isinstance(module, ExLlamaV2Attention):
-                attn_layers.append(idx)
+    def set_padding(self, padding):
+        self.padding = padding
+        self.padded = any(pad > 0 for pad in padding)
+        
+        if self.padded:
+            seq_len = max(padding) + 1 # only the padded columns need to be in the mask, anything past its end counts as real
+            self.input_mask = torch.zeros((len(padding), seq_len), dtype = torch.float16)
+            for row, pad in enumerate(padding): self.input_mask[row, :pad] = -65504.
             
-        layers_count = head_layer + 1
+            self.position_offsets = torch.tensor([-pad for pad in padding], dtype = torch.int).unsqueeze(1)
+        else:
+            self.input_mask = None
+            self.position_offsets = None
         
-        settings = user_settings.brainhackingchip_settings(HackingchipSettings(layers_count, attn_layers), ui_params, last_kv_layer, head_layer) # prepare hackingchip settings
+def get_model_layout(model):
+    # Everything about the model that the chip settings depend on, also used as part of the settings cache key
+    attn_layers = []
+    
+    for idx, module in enumerate(model.modules):
+        if isinstance(module, ExLlamaV2Attention):
+            attn_layers.append(idx)
+            
+    return (model.head_layer_idx + 1, tuple(attn_layers), model.last_kv_layer_idx, model.head_layer_idx)
+
+def build_settings(user_settings, ui_params, layout):
+    layers_count, attn_layers, last_kv_layer, head_layer = layout
+    return user_settings.brainhackingchip_settings(HackingchipSettings(layers_count, list(attn_layers)), ui_params, last_kv_layer, head_layer)
+
+def gen_full_prompt(user_settings, ui_settings, ui_params, user_input, state, **kwargs):
+    settings = None
+    
+    if shared.model != None and isinstance(shared.model, Exllamav2Model): # hackingchippable
+        layout = get_model_layout(shared.model.generator.model)
+        settings = chip_cache.get_settings(user_settings, ui_params, layout, build_settings) # prepare hackingchip settings, only built again when something changed
         
     if settings and ui_settings['on']:
         baseprompt, prompts = gen_full_prompt2(user_input, state, **kwargs) # prepare hackingchip prompts
         
         hackingchip = Hackingchip(ui_settings, settings, prompts)
-        shared.model.generator.model.hackingchip = hackingchip # hackingchip installed
         
-        if isinstance(shared.model, Exllamav2Model): # May as well be prepared for other model loaders, making sure this is exllamav2
-            if hackingchip.prompts.batch_size != shared.model.cache.batch_size: # the hackingchip tends to have extra batches, so it's time to prepare for that
-                # I'm not correctly deleting the existing cache, but it gets removed from VRAM somehow anyway
-                
-                if shared.args.cache_8bit:
-                    shared.model.cache = ExLlamaV2Cache_8bit(shared.model.model, hackingchip.prompts.batch_size)
-                else:
-                    shared.model.cache = ExLlamaV2Cache(shared.model.model, hackingchip.prompts.batch_size)
-
-                shared.model.generator = ExLlamaV2StreamingGenerator(shared.model.model, shared.model.cache, shared.model.tokenizer)
-                
-            # Hijack functions
-            shared.model.generate_with_streaming = hijack_generate_with_streaming.__get__(shared.model, Exllamav2Model)
-            shared.model.generator._gen_single_token = hijack_gen_single_token.__get__(shared.model.generator, ExLlamaV2StreamingGenerator)
-            shared.model.generator.model._forward = hijack_model_forward.__get__(shared.model.generator.model, ExLlamaV2)
+        # Nothing would be steered (every weight is 0), so the negative prompts don't need to be in the batch at all
+        if hackingchip.program.empty and prompts.numneg > 0 and not ui_settings['sample_other_prompts']:
+            hackingchip = Hackingchip(ui_settings, settings, prompts.positive_only())
+            
+        # With steer_draft the draft model (speculative decoding) gets the same chip, built for its own layers
+        draft_model = shared.model.generator.draft_model if hasattr(shared.model.generator, 'draft_model') else None
+        if draft_model is not None and settings.steer_draft and hackingchip.prompts.numneg > 0:
+            draft_settings = chip_cache.get_settings(user_settings, ui_params, get_model_layout(draft_model), build_settings)
+            hackingchip.draft = Hackingchip(ui_settings, draft_settings, hackingchip.prompts)
+            hackingchip.draft.profiler = None # the profile is the target model's layers
         
-            for idx, module in enumerate(shared.model.generator.model.modules):
-                if isinstance(module, ExLlamaV2Attention):
-                    module.forward = hijack_attn_forward.__get__(module, ExLlamaV2Attention)
+        if isinstance(shared.model, Exllamav2Model): # May as well be prepared for other model loaders, making sure this is exllamav2
+            # Hijack functions, this only binds anything the first time for each model/generator
+            install_hijacks(shared.model)
+            
+        # This runs outside of oobabooga's generation lock, putting the hackingchip on the model here would replace the one of a request that's
+        # still generating (--multi-user). It waits under a token in this request's state until its generation starts, which sets up the cache for it
+        request_chips.put(state, hackingchip)
                     
         if ui_settings['output_prompts']:
             print("Hackingchip prompts:")
             for prompt in hackingchip.prompts.batch_prompts:
                 print(prompt)
+                
+            template_info = get_template.cache_info()
+            print("Template cache: " + str(template_info.hits) + " hits, " + str(template_info.misses) + " misses, " + str(template_info.currsize) + " cached")
         
         return baseprompt
     else:
+        request_chips.take(state) # a hackingchip left over from an earlier prompt with this state isn't for this request
+        
         # Should I warn the user that they aren't able to use hackingchip with their current model loader? Or would that be annoying?
         if settings is None: print("Unsupported model loader: Brain-Hacking Chip won't work with it")
+        else: uninstall_hijacks(shared.model) # chip is switched off, back to the stock exllamav2 functions
         return chat.generate_chat_prompt(user_input, state, **kwargs)
             
             
@@ -621,6 +1469,7 @@ def gen_full_prompt2(user_input, state, **kwargs): # modifies hackingchip and st
         
     numpos = 1
     numneg = 0
+    neg_names = []
                 
     if prompt is None:
         positive_context, negative_context, positive_context_extras, negative_context_extras = process_context(state['context'])
@@ -656,35 +1505,33 @@ def gen_full_prompt2(user_input, state, **kwargs): # modifies hackingchip and st
                 negative_extras[name].char = negative_context
             negative_extras[name].inst = text
             
-        state['context'] = positive_context
-        state['custom_system_message'] = positive_context_instruct
-        posprompt = generate_chat_prompt(user_input, state, **kwargs)
-        prompt = [posprompt]
+        # Every variant is a (context, custom system message) pair, rendered and tokenized on its own copy of state
+        variants = [(positive_context, positive_context_instruct)]
 
-        if positive_extras:
-            for name, extras in positive_extras.items():
-                state['context'] = extras.char
-                state['custom_system_message'] = extras.inst
-                prompt.append(generate_chat_prompt(user_input, state, **kwargs))
-                numpos += 1
+        for name, extras in positive_extras.items():
+            variants.append((extras.char, extras.inst))
+            numpos += 1
 
-        if negative_extras:
-            for name, extras in negative_extras.items():
-                state['context'] = extras.char
-                state['custom_system_message'] = extras.inst
-                prompt.append(generate_chat_prompt(user_input, state, **kwargs))
-                numneg += 1
+        for name, extras in negative_extras.items():
+            variants.append((extras.char, extras.inst))
+            numneg += 1
+            neg_names.append(name)
         
         if len(negative_context) + len(negative_context_instruct) > 0:
-            state['context'] = negative_context
-            state['custom_system_message'] = negative_context_instruct
-            prompt.append(generate_chat_prompt(user_input, state, **kwargs))
+            variants.append((negative_context, negative_context_instruct))
             numneg += 1
+            neg_names.append('NEGATIVE')
+            
+        rendered = render_variants(user_input, state, variants, **kwargs)
+        prompt = [variant_prompt for variant_prompt, variant_ids in rendered]
+        batch_ids = [variant_ids for variant_prompt, variant_ids in rendered]
+        posprompt = prompt[0]
             
         state['context'] = positive_context
         state['custom_system_message'] = positive_context_instruct
         
-        prompt_info = HackingchipPrompts(prompt, numpos, numneg)
+        prompt_info = HackingchipPrompts(prompt, numpos, numneg, neg_names, batch_ids)
+        prompt_info.variants = variants
         
         # TODO: load the default negative cfg here in state for convenience
         
@@ -724,17 +1571,61 @@ def gen_full_prompt2(user_input, state, **kwargs): # modifies hackingchip and st
             
     return prompt, prompt_info
             
+prompt_executor = None
+
+def render_variant(user_input, state, context, custom_system_message, **kwargs):
+    # Renders one prompt variant, state is copied so the variants don't change each other's context and system message
+    variant_state = dict(state)
+    variant_state['context'] = context
+    variant_state['custom_system_message'] = custom_system_message
+    
+    return generate_chat_prompt(user_input, variant_state, **kwargs)
+
+def encode_variant(prompt, state):
+    return shared.model.tokenizer.encode(prompt, add_bos=state['add_bos_token'], encode_special_tokens=True) if hasattr(shared.model, 'tokenizer') else None
+
+def render_variants(user_input, state, variants, **kwargs):
+    # Rendering calls into other extensions (bot_prefix and whatever else they hook), which were never meant to run on other threads,
+    # so the variants are rendered one after another on this thread and only the tokenizing (native code, doesn't hold the GIL) uses the thread pool
+    global prompt_executor
+    
+    prompts = [render_variant(user_input, state, context, inst, **kwargs) for context, inst in variants]
+    
+    if len(prompts) == 1:
+        return [(prompt, encode_variant(prompt, state)) for prompt in prompts]
+    
+    if prompt_executor is None: prompt_executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix='hackingchip_prompts')
+    
+    futures = [prompt_executor.submit(encode_variant, prompt, state) for prompt in prompts]
+    return [(prompt, future.result()) for prompt, future in zip(prompts, futures)]
+
+def pad_batch_ids(batch_ids, pad_token_id):
+    # Left pads the ids of each prompt into one batch, the same way the tokenizer does when it's given a list of prompts
+    length = max(ids.shape[-1] for ids in batch_ids)
+    batch = torch.full((len(batch_ids), length), pad_token_id, dtype = torch.long)
+    
+    for row, ids in enumerate(batch_ids):
+        batch[row, length - ids.shape[-1]:] = ids.view(-1)
+        
+    return batch
+
 class ExtraInfo:
     def __init__(self):
         self.char = ''
         self.inst = ''
         
+section_pattern = re.compile(r"(?:\[\[(?P<name>[^\]]+)\]\]\n)?(?P<text>(?:(?!\n\[\[[^\]]+\]\]\n).)*)", re.DOTALL)
+section_start_pattern = re.compile(r'^\[\[(.*?)\]\]\n')
+placeholder_pattern = re.compile(r'\{\{(.+?)\}\}')
+
 def process_context(context):
-    pattern = r"(?:\[\[(?P<name>[^\]]+)\]\]\n)?(?P<text>(?:(?!\n\[\[[^\]]+\]\]\n).)*)"
-    
-    if not re.match(r'^\[\[(.*?)\]\]\n', context): context = "[[SHARED]]\n" + context
-    
-    matches = re.finditer(pattern, context, re.DOTALL)
+    # The same character card and system message get parsed every turn, so the parsed result is memoized on the text
+    positive, negative, positive_extras, negative_extras = parse_context(context)
+    return positive, negative, dict(positive_extras), dict(negative_extras)
+
+@lru_cache(maxsize=64)
+def parse_context(context):
+    if not section_start_pattern.match(context): context = "[[SHARED]]\n" + context
     
     regions = {}
     
@@ -744,7 +1635,7 @@ def process_context(context):
     positive_extras = {}
     negative_extras = {}
 
-    for match in matches:
+    for match in section_pattern.finditer(context):
         if match.group("name") is not None:
             name = match.group("name").upper().strip()
             text = match.group("text") # don't strip
@@ -772,17 +1663,114 @@ def process_context(context):
     elif negative_extras:
         name, text = negative_extras.popitem()
         negative = text
+        
+    # {{NAME}} tags are filled in with one pass over each text, sections that contain tags are resolved first (and only once)
+    # A section that ends up including itself is left as the plain {{NAME}} tag
+    resolved = {}
+    resolving = set()
+    
+    def resolve_region(name):
+        if name in resolved: return resolved[name]
+        if name in resolving: return None
+        
+        resolving.add(name)
+        resolved[name] = resolve(regions[name])
+        resolving.discard(name)
+        return resolved[name]
+    
+    def replace_placeholder(match):
+        name = match.group(1)
+        if name not in regions: return match.group(0)
+        
+        text = resolve_region(name)
+        return text if text is not None else match.group(0)
     
-    for name, text in regions.items():
-        positive = positive.replace('{{' + name + '}}', text)
-        negative = negative.replace('{{' + name + '}}', text)
-        for name2, text2 in positive_extras.items():
-            positive_extras[name2] = text2.replace('{{' + name + '}}', text)
-        for name2, text2 in negative_extras.items():
-            negative_extras[name2] = text2.replace('{{' + name + '}}', text)
+    def resolve(text):
+        return placeholder_pattern.sub(replace_placeholder, text) if '{{' in text else text
+    
+    positive = resolve(positive)
+    negative = resolve(negative)
+    positive_extras = tuple((name, resolve(text)) for name, text in positive_extras.items())
+    negative_extras = tuple((name, resolve(text)) for name, text in negative_extras.items())
        
     return positive, negative, positive_extras, negative_extras
         
+# Token lengths of message contents, kept across turns so truncation doesn't have to encode the same history over and over
+message_token_lengths = OrderedDict()
+message_token_lengths_lock = threading.Lock() # oobabooga can build prompts for more than one request at a time
+max_message_token_lengths = 4096
+
+def get_message_token_length(text):
+    key = (id(shared.tokenizer), text)
+    
+    with message_token_lengths_lock:
+        length = message_token_lengths.get(key)
+        if length is not None:
+            message_token_lengths.move_to_end(key)
+            return length
+        
+    length = get_encoded_length(text)
+    
+    with message_token_lengths_lock:
+        message_token_lengths[key] = length
+        if len(message_token_lengths) > max_message_token_lengths: message_token_lengths.popitem(last=False)
+        
+    return length
+
+def truncate_messages(messages, make_prompt, max_length, full_length):
+    # Finds the fewest old messages to drop so the prompt fits, same order as oobabooga drops them:
+    # oldest non-system message first, and the system message last once nothing else is left
+    # Returns the kept messages and their rendered prompt
+    head = messages[:1] if messages[0]['role'] == 'system' else []
+    body = messages[len(head):]
+    most_dropped = len(body) + len(head) # dropping this many leaves no messages, which is always accepted
+    
+    def kept(dropped):
+        return head + body[dropped:] if dropped <= len(body) else []
+    
+    rendered = {}
+    def render(dropped):
+        if dropped not in rendered: rendered[dropped] = make_prompt(kept(dropped))
+        return rendered[dropped]
+    
+    # Running total guess: every dropped message saves its (memoized) content length plus an even share of the template overhead
+    content_lengths = [get_message_token_length(message['content']) for message in body]
+    overhead = max(0, full_length - sum(content_lengths) - (get_message_token_length(head[0]['content']) if head else 0)) / len(messages)
+    
+    excess = full_length - max_length
+    guess = len(body)
+    saved = 0
+    for index, length in enumerate(content_lengths):
+        saved += length + overhead
+        if saved >= excess:
+            guess = index + 1
+            break
+    
+    # Check the guess and its neighbor with real renders, then fall back to binary search
+    # Dropping 0 is known to not fit, dropping everything is always accepted
+    low = 0
+    high = most_dropped
+    attempts = 0
+    
+    while high - low > 1:
+        dropped = guess if attempts < 2 and low < guess < high else (low + high) // 2
+        attempts += 1
+        
+        if get_encoded_length(render(dropped)) <= max_length:
+            high = dropped
+            guess = dropped - 1
+        else:
+            low = dropped
+            guess = dropped + 1
+            
+    return kept(high), render(high)
+
+# Compiled chat/instruction templates, shared by every prompt variant and every turn
+# get_template.cache_info() has the hit/miss counts
+@lru_cache(maxsize=32)
+def get_template(template_str):
+    return jinja_env.from_string(template_str)
+
 # Just copying the entirety of generate_chat_prompt so I can put <|nochat|> support in it
 
 def generate_chat_prompt(user_input, state, **kwargs):
@@ -792,8 +1780,8 @@ def generate_chat_prompt(user_input, state, **kwargs):
     history = kwargs.get('history', state['history'])['internal']
 
     # Templates
-    chat_template = jinja_env.from_string(state['chat_template_str'])
-    instruction_template = jinja_env.from_string(state['instruction_template_str'])
+    chat_template = get_template(state['chat_template_str'])
+    instruction_template = get_template(state['instruction_template_str'])
     chat_renderer = partial(chat_template.render, add_generation_prompt=False, name1=state['name1'], name2=state['name2'])
     instruct_renderer = partial(instruction_template.render, add_generation_prompt=False)
 
@@ -808,16 +1796,15 @@ def generate_chat_prompt(user_input, state, **kwargs):
         if state['context'].strip() != '':
             messages.append({"role": "system", "content": state['context']})
 
-    insert_pos = len(messages)
-    for user_msg, assistant_msg in reversed(history):
+    for user_msg, assistant_msg in history:
         user_msg = user_msg.strip()
         assistant_msg = assistant_msg.strip()
 
-        if assistant_msg:
-            messages.insert(insert_pos, {"role": "assistant", "content": assistant_msg})
-
         if user_msg not in ['', '<|BEGIN-VISIBLE-CHAT|>']:
-            messages.insert(insert_pos, {"role": "user", "content": user_msg})
+            messages.append({"role": "user", "content": user_msg})
+
+        if assistant_msg:
+            messages.append({"role": "assistant", "content": assistant_msg})
 
     user_input = user_input.strip()
     if user_input and not impersonate and not _continue:
@@ -871,14 +1858,10 @@ def generate_chat_prompt(user_input, state, **kwargs):
 
     # Handle truncation
     max_length = get_max_prompt_length(state)
-    while len(messages) > 0 and get_encoded_length(prompt) > max_length:
-        # Try to save the system message
-        if len(messages) > 1 and messages[0]['role'] == 'system':
-            messages.pop(1)
-        else:
-            messages.pop(0)
-
-        prompt = make_prompt(messages)
+    if len(messages) > 0:
+        full_length = get_encoded_length(prompt)
+        if full_length > max_length:
+            messages, prompt = truncate_messages(messages, make_prompt, max_length, full_length)
 
     if also_return_rows:
         return prompt, [message['content'] for message in messages]
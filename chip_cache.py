@@ -0,0 +1,75 @@
+import importlib
+import os
+from collections import OrderedDict
+
+# Keeps chip modules and the settings they build around between generations
+# Modules are only reloaded when their file changes on disk (checked with a stat, which is much cheaper than a reload)
+# Built HackingchipSettings are kept keyed by (chip module, file stamp, ui_params values, model layer layout)
+# This module itself is never reloaded, so the cache survives chip.py being reloaded
+
+class ChipCache:
+    def __init__(self, max_settings=8):
+        self.max_settings = max_settings
+        self.stamps = {} # module name -> file stamp at the time it was last (re)loaded
+        self.settings = OrderedDict() # LRU of built settings
+        self.hits = 0
+        self.misses = 0
+
+    def file_stamp(self, module):
+        path = getattr(module, '__file__', None)
+        if not path: return None
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def get_module(self, name):
+        # Imports the module the first time, after that it is only reloaded if its file was changed
+        module = importlib.import_module(name)
+        stamp = self.file_stamp(module)
+
+        if name in self.stamps and self.stamps[name] != stamp:
+            module = importlib.reload(module)
+            stamp = self.file_stamp(module)
+            self.invalidate(name)
+
+        self.stamps[name] = stamp
+        return module
+
+    def watch(self, module):
+        # Returns the up to date module, reloading it if it changed on disk since it was last seen
+        return self.get_module(module.__name__)
+
+    def invalidate(self, name=None):
+        if name is None:
+            self.settings.clear()
+            return
+
+        for key in [key for key in self.settings if key[0] == name]:
+            del self.settings[key]
+
+    def get_settings(self, user_settings, ui_params, layout, build):
+        # build(user_settings, ui_params, layout) is only called when there isn't a matching cached settings object
+        name = user_settings.__name__
+        key = (name, self.stamps.get(name), tuple(sorted(ui_params.items())), layout)
+
+        settings = self.settings.get(key)
+        if settings is not None:
+            self.settings.move_to_end(key)
+            self.hits += 1
+            return settings
+
+        self.misses += 1
+        settings = build(user_settings, dict(ui_params), layout) # the chip may modify params, so give it a copy
+        settings.chip_key = key[:3] # which chip file and slider values made these settings
+
+        self.settings[key] = settings
+        while len(self.settings) > self.max_settings:
+            self.settings.popitem(last=False)
+
+        return settings
+
+chip_cache = ChipCache()
@@ -1,5 +1,6 @@
 import torch
 from extensions.BrainHackingChip.settings_classes import LayerSettings, AttnSettings, VectorSettings, Value
+from extensions.BrainHackingChip.cfg_functions import cfg_subtract, cfg_repulsor, cfg_clamp_radius, cfg_project, cfg_rescale
 
 # These are parameters for the settings tab in the UI
 # The user set values will be passed into the settings function, using the dictionary names from params
@@ -26,6 +27,12 @@ def brainhackingchip_settings(chip, params, last_kv_layer, head_layer):
     3. That difference is subtracted from the tensors (steering positive away from negative by their difference)
     The larger the weight, the more intense of an effect
     
+    With multiple negative prompts, the negative tensors are combined according to chip.steering_mode:
+      'mean' (default) uses the weighted mean of the negatives, with weights from chip.negative_weights
+      'max_margin' steers away from whichever weighted negative is farthest from the positive, picked per vector
+    chip.negative_weights is a dictionary of section name to weight, like {'NEGATIVE': 1.0, 'NEGATIVE 2': 0.5}
+    Any negative prompt not in the dictionary gets a weight of 1.0
+    
     
     
     There is also support for a custom CFG function instead of the default above, by setting cfg_func in any layer you want to override
@@ -36,30 +43,14 @@ def brainhackingchip_settings(chip, params, last_kv_layer, head_layer):
       Hackingchip is included for extra info, such as hackingchip.prompt.numpos, hackingchip.prompt.numneg, and hackingchip.prompt.negend
     You must return the new full tensors (same shape as input tensors) after your modification
     
-    For an example of a custom cfg_func, see cfg_repulsor below
+    Built-in cfg_funcs from cfg_functions.py can be used directly, and are examples for writing your own:
+      cfg_subtract (same as the default), cfg_repulsor, cfg_clamp_radius, cfg_project, cfg_rescale
+    Avoid .item() and if statements on tensor values in a cfg_func, they make the CPU wait for the GPU on every steered layer (use torch.where)
     """
     
     if not 'weight' in params: params['weight'] = 0.2 # Fix for right now when autoload on launch isn't working
     
-    # Repels positive from negative, up to a distance determined by negative's magnitude * settings.weight
-    def cfg_repulsor(tensor, settings, hackingchip):
-            # Get negative tensor
-            tensor_neg_orig = tensor[hackingchip.prompts.numpos:hackingchip.prompts.negend, :, :]
-            tensor_neg_orig = torch.mean(tensor_neg_orig, dim=0, keepdim=False)
-            
-            # Find the strength of the repulsion, the difference between pos and neg, and the magnitude of that difference
-            strength = torch.norm(tensor_neg_orig).item() * settings.weight
-            difference = tensor[0] - tensor_neg_orig
-            diff_strength = torch.norm(difference).item()
-            
-            # If the repulsion strength is higher than the distance between pos and neg, repel pos so it's at that distance away
-            # If pos is already repulsion strength distance away or more, then don't modify it (although this could be changed to pull it back toward neg)
-            repulsion = ((strength / diff_strength) - 1) * difference if strength > diff_strength else torch.zeros_like(difference)
-            
-            tensor[0] += repulsion # There's no accelerating issues with this cfg func, so only need to modify positive
-            return tensor
-        
-    # Set a cfg_func for my thought CFG example
+    # Set a cfg_func for my thought CFG example, like cfg_repulsor (repels positive from negative, up to a distance determined by negative's magnitude * weight)
     thought_cfg_func = None
     
     # The weight of the CFG for thoughts in this example, change this value to change how strongly thoughts are affected by negative prompts
@@ -67,6 +58,23 @@ def brainhackingchip_settings(chip, params, last_kv_layer, head_layer):
     # It seems like once you accumulate 0.5 weight among all layers or more, things can get weird. The default puts 0.2 weight into two different layers.
     thought_weight = params['weight']
     
+    # Negative prompts only steer and never output text, so their cache can be stored in 8-bit to save VRAM
+    # chip.negative_cache = '8bit'
+    
+    # Faster decoding: the negative prompts are only run for the first token, what they steered there is reused for every later token
+    # chip.precompute_steering = True
+    # The steering vectors can also be saved to disk and reused for every conversation with the same negative prompts (no negative rows run at all then)
+    # chip.steering_store = True
+    
+    # The default CFG can be compiled with torch.compile (the first generation is slower while it compiles)
+    # chip.compile_steering = True
+    
+    # With --multi-user, requests from different users can share one batch (each is still steered with its own negative prompts)
+    # chip.batch_users = True
+    
+    # chip.steering_mode = 'max_margin'
+    # chip.negative_weights = {'NEGATIVE 2': 0.5}
+    
     chip.layer_settings[last_kv_layer - 1] = LayerSettings(weight=thought_weight, cfg_func=thought_cfg_func)
     chip.layer_settings[last_kv_layer + 1] = LayerSettings(weight=thought_weight, cfg_func=thought_cfg_func)
     
@@ -0,0 +1,77 @@
+from exllamav2.cache import ExLlamaV2CacheBase
+from exllamav2 import (
+    ExLlamaV2Cache,
+    ExLlamaV2Cache_8bit,
+)
+
+# Cache split into row groups: the positive rows stay at full precision and the negative rows (which only ever steer) go in 8-bit
+# Each group is its own exllamav2 cache, sized for its own rows, and they always share the same sequence position
+# This lives in its own module (not chip.py) so the class doesn't change when chip.py is reloaded while a cache is alive
+
+class HackingchipCache(ExLlamaV2CacheBase):
+    def __init__(self, model, numpos, numneg, max_seq_len=-1):
+        # ExLlamaV2CacheBase.__init__ isn't called, it would allocate a cache for the whole batch
+        self.model = model
+        self.numpos = numpos
+        self.numneg = numneg
+        self.batch_size = numpos + numneg
+
+        self.positive = ExLlamaV2Cache(model, numpos, max_seq_len)
+        self.negative = ExLlamaV2Cache_8bit(model, numneg, max_seq_len)
+        self.max_seq_len = self.positive.max_seq_len
+
+    @property
+    def current_seq_len(self):
+        return self.positive.current_seq_len
+
+    @current_seq_len.setter
+    def current_seq_len(self, value):
+        self.positive.current_seq_len = value
+        self.negative.current_seq_len = value
+
+    def groups(self, batch_size):
+        # (first row, row count, cache) for every group that has rows in a batch of batch_size, rows are always taken from the front
+        groups = [(0, min(batch_size, self.numpos), self.positive)]
+        if batch_size > self.numpos: groups.append((self.numpos, batch_size - self.numpos, self.negative))
+        return groups
+
+    # The stock exllamav2 attention only ever sees this cache with the positive rows (chip switched off, batch size 1)
+
+    def get_kv_state(self, layer_idx, batch_size, offset, width):
+        assert batch_size <= self.numpos, "Stock attention can only use the positive rows of a HackingchipCache"
+        return self.positive.get_kv_state(layer_idx, batch_size, offset, width)
+
+    def store_kv_state(self, layer_idx, batch_size, offset, width):
+        self.positive.store_kv_state(layer_idx, batch_size, offset, width)
+
+    def copy_prefix(self, length):
+        # Copies the first length positions of row 0 into every other row, going through the groups' own conversion for the 8-bit rows
+        for layer_idx in range(len(self.positive.key_states)):
+            if self.positive.key_states[layer_idx] is None: continue
+
+            source_keys = self.positive.key_states[layer_idx].narrow(0, 0, 1).narrow(1, 0, length)
+            source_values = self.positive.value_states[layer_idx].narrow(0, 0, 1).narrow(1, 0, length)
+
+            if self.numpos > 1:
+                self.positive.key_states[layer_idx].narrow(0, 1, self.numpos - 1).narrow(1, 0, length).copy_(source_keys)
+                self.positive.value_states[layer_idx].narrow(0, 1, self.numpos - 1).narrow(1, 0, length).copy_(source_values)
+
+            keys, values = self.negative.get_kv_state(layer_idx, self.numneg, 0, 0)
+            keys.narrow(0, 0, self.numneg).narrow(1, 0, length).copy_(source_keys)
+            values.narrow(0, 0, self.numneg).narrow(1, 0, length).copy_(source_values)
+            self.negative.store_kv_state(layer_idx, self.numneg, 0, length)
+
+def make_cache(model, numpos, numneg, cache_8bit=False, negative_cache='fp16'):
+    # The plain single cache unless the negative rows should be stored differently from the positive ones
+    if cache_8bit:
+        return ExLlamaV2Cache_8bit(model, numpos + numneg)
+    if numneg > 0 and negative_cache == '8bit':
+        return HackingchipCache(model, numpos, numneg)
+    return ExLlamaV2Cache(model, numpos + numneg)
+
+def cache_matches(cache, numpos, numneg, cache_8bit=False, negative_cache='fp16'):
+    if isinstance(cache, HackingchipCache):
+        return not cache_8bit and negative_cache == '8bit' and cache.numpos == numpos and cache.numneg == numneg
+
+    # A plain cache is fine as long as a HackingchipCache wouldn't have been made
+    return cache.batch_size == numpos + numneg and (cache_8bit or numneg == 0 or negative_cache != '8bit') and isinstance(cache, ExLlamaV2Cache_8bit) == cache_8bit
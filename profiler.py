@@ -0,0 +1,216 @@
+import json
+import os
+import time
+
+import torch
+
+# Optional per site steering profiler, switched on with "Debug: Profile Steering" in the UI
+# Every steering site (a layer, or one of an attention layer's H, Q, K, V, A vectors) records its call count, wall time,
+# bytes allocated (CUDA only) and the norm of the change it made to the positive row
+# When it's switched off the hackingchip doesn't reference it at all, the only cost is one attribute check per steered site
+# Timing synchronizes the GPU around every steered site, so generation is slower while profiling, but each site's time is its own
+# Speculative decoding acceptance (draft tokens proposed and accepted) is counted for every steered generation with a draft model, profiling or not
+# This module is never reloaded, so the totals survive chip.py being reloaded
+
+default_profile_dir = os.path.dirname(os.path.abspath(__file__))
+
+class SiteStats:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.delta_norm = 0.0 # sum over calls
+        self.delta_norm_max = 0.0
+
+    def add(self, other):
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.bytes += other.bytes
+        self.delta_norm += other.delta_norm
+        self.delta_norm_max = max(self.delta_norm_max, other.delta_norm_max)
+
+class SpeculativeStats:
+    # Speculative decoding with a draft model: how much of the draft the target model accepted
+    def __init__(self):
+        self.tokens = 0 # tokens generated
+        self.drafted = 0 # draft tokens proposed
+        self.accepted = 0 # draft tokens that matched what was sampled from the target model
+        self.verify_passes = 0 # target model forwards, each one checks a whole draft
+
+    def add(self, other):
+        self.tokens += other.tokens
+        self.drafted += other.drafted
+        self.accepted += other.accepted
+        self.verify_passes += other.verify_passes
+
+    def acceptance_rate(self):
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    def tokens_per_pass(self):
+        return self.tokens / self.verify_passes if self.verify_passes else 0.0
+
+    def report(self):
+        return {
+            'tokens': self.tokens,
+            'drafted': self.drafted,
+            'accepted': self.accepted,
+            'verify_passes': self.verify_passes,
+            'acceptance_rate': self.acceptance_rate(),
+            'tokens_per_pass': self.tokens_per_pass(),
+        }
+
+    def summary(self):
+        return (str(self.accepted) + " of " + str(self.drafted) + " draft tokens accepted (" + format(self.acceptance_rate() * 100, '.1f') + "%), " +
+                format(self.tokens_per_pass(), '.2f') + " tokens per target forward")
+
+class SteeringProfiler:
+    def __init__(self, directory=default_profile_dir):
+        self.directory = directory
+        self.current = None # {site: SiteStats} of the request being generated
+        self.attn_to_layers = []
+        self.started = None
+        self.requests = 0
+        self.totals = {} # (layer, vector) -> SiteStats over every profiled request
+        self.last_report = None
+        self.speculative = SpeculativeStats() # over every steered generation with a draft model, whether profiling is on or not
+        self.last_speculative = None
+
+    def start(self, attn_to_layers):
+        if self.current is not None: self.finish() # the last request's generator was closed before it got to finish
+        self.current = {}
+        self.attn_to_layers = attn_to_layers
+        self.started = time.perf_counter()
+
+    def measure(self, steer, x, op, site):
+        # Runs steer(x, op, site) and records it
+        if self.current is None: return steer(x, op, site)
+
+        cuda = x.is_cuda
+        before = x[0].clone()
+        if cuda:
+            torch.cuda.synchronize(x.device)
+            torch.cuda.reset_peak_memory_stats(x.device)
+            allocated = torch.cuda.memory_allocated(x.device)
+
+        start = time.perf_counter()
+        x = steer(x, op, site)
+        if cuda: torch.cuda.synchronize(x.device)
+        seconds = time.perf_counter() - start
+
+        stats = self.current.get(site)
+        if stats is None:
+            stats = SiteStats()
+            self.current[site] = stats
+
+        norm = torch.linalg.vector_norm(before.sub_(x[0]).float()).item()
+        stats.calls += 1
+        stats.seconds += seconds
+        if cuda: stats.bytes += torch.cuda.max_memory_allocated(x.device) - allocated
+        stats.delta_norm += norm
+        stats.delta_norm_max = max(stats.delta_norm_max, norm)
+
+        return x
+
+    def add_speculative(self, stats):
+        self.speculative.add(stats)
+        self.last_speculative = stats
+
+    def site_name(self, site):
+        # ('layer', 12) -> (12, 'layer'), (attention index, 'q') -> (layer index, 'q')
+        if site[0] == 'layer': return (site[1], 'layer')
+        return (self.attn_to_layers[site[0]] if site[0] < len(self.attn_to_layers) else site[0], site[1])
+
+    def finish(self, tokens=None):
+        if self.current is None: return
+
+        sites = {}
+        for site, stats in self.current.items():
+            sites[self.site_name(site)] = stats
+
+        for name, stats in sites.items():
+            self.totals.setdefault(name, SiteStats()).add(stats)
+
+        self.requests += 1
+        self.last_report = {
+            'tokens': tokens,
+            'seconds': time.perf_counter() - self.started,
+            'sites': self.site_list(sites, tokens),
+        }
+        self.current = None
+
+        try:
+            self.export()
+        except OSError as e:
+            print("Couldn't write the steering profile: " + str(e))
+
+    def site_list(self, sites, tokens=None):
+        result = []
+        for (layer, vector), stats in sorted(sites.items(), key=lambda item: -item[1].seconds):
+            result.append({
+                'layer': layer,
+                'vector': vector,
+                'calls': stats.calls,
+                'seconds': stats.seconds,
+                'ms_per_call': stats.seconds * 1000 / stats.calls if stats.calls else 0.0,
+                'ms_per_token': stats.seconds * 1000 / tokens if tokens else None,
+                'bytes': stats.bytes,
+                'delta_norm_mean': stats.delta_norm / stats.calls if stats.calls else 0.0,
+                'delta_norm_max': stats.delta_norm_max,
+            })
+        return result
+
+    def prometheus_text(self):
+        metrics = [
+            ('hackingchip_steering_calls_total', 'counter', 'Steering calls per site', lambda stats: stats.calls),
+            ('hackingchip_steering_seconds_total', 'counter', 'Wall time spent steering per site', lambda stats: stats.seconds),
+            ('hackingchip_steering_bytes_total', 'counter', 'CUDA bytes allocated while steering per site', lambda stats: stats.bytes),
+            ('hackingchip_steering_delta_norm_sum', 'counter', 'Sum of the norm of the change made to the positive row per site', lambda stats: stats.delta_norm),
+            ('hackingchip_steering_delta_norm_max', 'gauge', 'Largest norm of the change made to the positive row per site', lambda stats: stats.delta_norm_max),
+        ]
+
+        lines = ['# HELP hackingchip_profiled_requests_total Generations profiled', '# TYPE hackingchip_profiled_requests_total counter',
+                 'hackingchip_profiled_requests_total ' + str(self.requests)]
+        
+        for name, description, value in (('drafted', 'Draft tokens proposed', self.speculative.drafted), ('accepted', 'Draft tokens accepted', self.speculative.accepted),
+                                         ('verify_passes', 'Target model forwards verifying a draft', self.speculative.verify_passes)):
+            lines += ['# HELP hackingchip_speculative_' + name + '_total ' + description, '# TYPE hackingchip_speculative_' + name + '_total counter',
+                      'hackingchip_speculative_' + name + '_total ' + str(value)]
+        for name, kind, description, value in metrics:
+            lines.append('# HELP ' + name + ' ' + description)
+            lines.append('# TYPE ' + name + ' ' + kind)
+            for (layer, vector), stats in sorted(self.totals.items(), key=lambda item: (item[0][0], item[0][1])):
+                lines.append(name + '{layer="' + str(layer) + '",vector="' + vector + '"} ' + repr(value(stats)))
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        # steering_profile.json (last request and totals) and steering_profile.prom (totals, Prometheus text format for a textfile collector)
+        os.makedirs(self.directory, exist_ok=True)
+        report = {'requests': self.requests, 'last_request': self.last_report, 'total': self.site_list(self.totals),
+                  'speculative': {'last_request': self.last_speculative.report() if self.last_speculative else None, 'total': self.speculative.report()}}
+
+        for filename, text in (('steering_profile.json', json.dumps(report, indent=2)), ('steering_profile.prom', self.prometheus_text())):
+            path = os.path.join(self.directory, filename)
+            temp_path = path + '.' + str(os.getpid()) + '.tmp'
+            with open(temp_path, 'w') as file:
+                file.write(text)
+            os.replace(temp_path, path) # readers never see a half written file
+
+    def summary(self):
+        # Short text for the UI
+        speculative = ["Speculative decoding, last generation: " + self.last_speculative.summary() + ", overall: " + self.speculative.summary()] if self.last_speculative else []
+        if self.last_report is None: return '\n'.join(speculative or ["Nothing profiled yet. Turn on profiling and generate something."])
+
+        report = self.last_report
+        total = sum(site['seconds'] for site in report['sites'])
+        lines = ["Last generation: " + str(report['tokens']) + " tokens in " + format(report['seconds'], '.2f') + " s, " +
+                 format(total * 1000, '.1f') + " ms of it steering (" + str(len(report['sites'])) + " sites, " + str(self.requests) + " generations profiled)"]
+
+        for site in report['sites']:
+            line = ("layer " + str(site['layer']) + " " + site['vector'] + ": " + str(site['calls']) + " calls, " +
+                    format(site['seconds'] * 1000, '.2f') + " ms (" + format(site['ms_per_call'], '.3f') + " ms/call), mean |delta| " + format(site['delta_norm_mean'], '.3g'))
+            if site['bytes']: line += ", " + format(site['bytes'] / (1024 * 1024), '.2f') + " MB allocated"
+            lines.append(line)
+
+        return '\n'.join(lines + speculative)
+
+steering_profiler = SteeringProfiler()
@@ -0,0 +1,129 @@
+import itertools
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+# Request scoped chip state and cross-user batching for --multi-user
+#
+# The prompt for a request is made outside of oobabooga's generation lock, so the hackingchip built for it can't just be put on the shared model,
+# another user's request could replace it before this one gets to generate. Instead it's kept here until that request's generate_with_streaming takes it
+#
+# With batch_users on, requests that arrive within batch_window_ms of each other with the same chip (file and slider values) are run as one batch
+# Every request keeps its own rows (positive then negative) as a group, steering is applied to each group separately
+# The first request leads: it lets go of the generation lock for the window so others can join, then runs the whole batch
+# The others wait for their tokens without holding the lock
+#
+# This module is never reloaded, so requests in flight survive chip.py being reloaded
+
+state_key = 'hackingchip_request' # the request token in oobabooga's state dict
+
+class RequestChips:
+    # Hackingchips waiting for their request to start generating
+    # Each one gets a token that's put in the request's state, so a copy of the state still finds it and nothing else can
+    def __init__(self, max_pending=64):
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.tokens = itertools.count(1)
+        self.by_token = OrderedDict() # request token -> hackingchip
+
+    def put(self, state, hackingchip):
+        with self.lock:
+            self.by_token.pop(state.get(state_key), None) # the same state made another prompt before generating
+            token = next(self.tokens)
+            state[state_key] = token
+            self.by_token[token] = hackingchip
+            while len(self.by_token) > self.max_pending: # requests that never got to generate
+                self.by_token.popitem(last=False)
+
+    def take(self, state):
+        # None if the chip is off for this request (or its entry was dropped)
+        with self.lock:
+            return self.by_token.pop(state.get(state_key), None)
+
+request_chips = RequestChips()
+
+class BatchRequest:
+    def __init__(self, hackingchip, ids, padding, gen_settings, max_new_tokens, key, started=None):
+        self.hackingchip = hackingchip
+        self.ids = ids # this request's rows, left padded to the same length
+        self.padding = padding # padding tokens in each row
+        self.gen_settings = gen_settings
+        self.max_new_tokens = max_new_tokens
+        self.key = key # only requests with the same key can share a batch
+        self.started = started # time.perf_counter() when the request started, for TokenDelta.seconds
+        self.deltas = queue.Queue() # a TokenDelta for every token, then None when it's done
+        self.cancelled = False # the request's consumer stopped reading (stop string, stop button, closed connection)
+
+    def put(self, delta):
+        self.deltas.put(delta)
+
+    def finish(self):
+        self.deltas.put(None)
+
+class BatchScheduler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.collecting = None # the batch the current leader is still collecting requests for
+        self.batches = 0
+        self.batched_requests = 0
+
+    def join(self, request, max_requests):
+        # Returns (batch, leader)
+        with self.lock:
+            batch = self.collecting
+            if batch is not None and len(batch) < max_requests and batch[0].key == request.key:
+                batch.append(request)
+                return batch, False
+
+            batch = [request]
+            self.collecting = batch
+            return batch, True
+
+    def close(self, batch):
+        with self.lock:
+            if self.collecting is batch: self.collecting = None
+            self.batches += 1
+            self.batched_requests += len(batch)
+
+    def generate(self, request, run, generation_lock, window, max_requests):
+        # Yields the request's TokenDeltas, called with generation_lock held and returns with it held again
+        # run(batch) runs every request of the batch, yielding after each token, and calls finish() on each of them at the end
+        batch, leader = self.join(request, max_requests)
+
+        if not leader:
+            generation_lock.release()
+            try:
+                while True:
+                    delta = request.deltas.get()
+                    if delta is None: break
+                    yield delta
+            finally:
+                request.cancelled = True
+                generation_lock.acquire()
+            return
+
+        generation_lock.release()
+        try:
+            time.sleep(window)
+        finally:
+            self.close(batch)
+            generation_lock.acquire()
+
+        steps = run(batch)
+        try:
+            for _ in steps:
+                yield from self.drain(request)
+        finally:
+            # If this request was stopped, the rest of the batch still has to be finished for the others
+            request.cancelled = True
+            for _ in steps: pass
+
+        yield from self.drain(request)
+
+    def drain(self, request):
+        while not request.deltas.empty():
+            delta = request.deltas.get_nowait()
+            if delta is not None: yield delta
+
+batch_scheduler = BatchScheduler()
@@ -1,7 +1,9 @@
-import importlib
 import gradio as gr
 from modules import shared
 
+from extensions.BrainHackingChip.chip_cache import chip_cache
+from extensions.BrainHackingChip.profiler import steering_profiler
+
 from modules.ui import create_refresh_button
 
 import os
@@ -27,7 +29,8 @@ slider_values = []
 ui_settings = {
     'on': True,
     'output_prompts': False,
-    'sample_other_prompts': False
+    'sample_other_prompts': False,
+    'profile_steering': False
     # 'output_extra_samples': False
 }
 
@@ -52,7 +55,7 @@ def select_file(filename):
     def do_default():
         try:
             global chip_settings
-            chip_settings = importlib.import_module("extensions.BrainHackingChip.chip_settings") # default settings
+            chip_settings = chip_cache.get_module("extensions.BrainHackingChip.chip_settings") # default settings
         except Exception as e:
             print("This shouldn't happen")
     
@@ -62,11 +65,9 @@ def select_file(filename):
         path = chip_path.format(name=filename)
         
         try:
-            chip_settings = importlib.import_module(path)
+            chip_settings = chip_cache.get_module(path) # only reloaded if the file changed since it was last loaded
         except Exception as e:
             do_default()
-        
-    importlib.reload(chip_settings)
     
     return populate_sliders()
 
@@ -128,6 +129,9 @@ def output_prompts_change(value):
     
 def sample_other_prompts_change(value):
     ui_settings['sample_other_prompts'] = value
+    
+def profile_steering_change(value):
+    ui_settings['profile_steering'] = value
         
 # I'm learning gradio with this function, bear with me here
 def ui():
@@ -143,6 +147,12 @@ def ui():
                 
                 # This isn't working now and I'm not sure why, made it invisible for now
                 gradio['sample_other_prompts'] = gr.Checkbox(label="Debug: Sample Other Prompts", value=False, info='Samples tokens from any extra prompts and prints their output to the console.', visible=False)
+            with gr.Row():
+                gradio['profile_steering'] = gr.Checkbox(label="Debug: Profile Steering", value=False, info='Times every steered layer, written to steering_profile.json and steering_profile.prom. Slows down generation while on.')
+            with gr.Row():
+                gradio['profile_summary'] = gr.Textbox(label='Steering profile', value='', lines=6, interactive=False)
+            with gr.Row():
+                gradio['profile_refresh'] = gr.Button('Refresh profile')
             sliders_full = []
             for i in range(max_sliders):
                 with gr.Row():
@@ -165,6 +175,8 @@ def ui():
     gradio['on_switch'].change(on_switch_change, gradio['on_switch'])
     gradio['output_prompts'].change(output_prompts_change, gradio['output_prompts'])
     gradio['sample_other_prompts'].change(sample_other_prompts_change, gradio['sample_other_prompts'])
+    gradio['profile_steering'].change(profile_steering_change, gradio['profile_steering'])
+    gradio['profile_refresh'].click(steering_profiler.summary, None, gradio['profile_summary'])
     
     # I wasn't sure how to get up to date slider values for every generation, so I just had to add change event listeners to them all
     # I know it's inefficient, I know it's bad, but it's all I've got right now
@@ -175,13 +187,15 @@ def custom_generate_chat_prompt(user_input, state, **kwargs):
     global ui_settings, chip_settings
     ui_params = get_slider_values()
     
-    chip = importlib.import_module("extensions.BrainHackingChip.chip")
-    importlib.reload(chip)
+    # Both of these are only reloaded when their file was changed on disk
+    chip = chip_cache.get_module("extensions.BrainHackingChip.chip")
     
     if not chip_settings: # Just in case
-        chip_settings = importlib.import_module("extensions.BrainHackingChip.chip_settings")
-        importlib.reload(chip_settings)
+        chip_settings = chip_cache.get_module("extensions.BrainHackingChip.chip_settings")
+    else:
+        chip_settings = chip_cache.watch(chip_settings)
         
-    prompt = chip.gen_full_prompt(chip_settings, ui_settings, ui_params, user_input, state, **kwargs)
+    # Every request gets its own copy of the settings, so switching something in the UI doesn't change requests that are already generating
+    prompt = chip.gen_full_prompt(chip_settings, dict(ui_settings), ui_params, user_input, state, **kwargs)
     
     return prompt
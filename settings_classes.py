@@ -9,6 +9,20 @@ class HackingchipSettings:
         self.layers_to_attn = [None] * layer_count # Stores the attention index of each layer, for conversion from layer idx to attention layer idx
         for index, value in enumerate(self.attn_to_layers): self.layers_to_attn[value] = index
         
+        self.steering_mode = 'mean' # How multiple negative prompts are combined for the default CFG: 'mean' (weighted mean) or 'max_margin'
+        self.negative_weights = {} # Optional weight per negative prompt by section name, like {'NEGATIVE': 1.0, 'NEGATIVE 2': 0.5}, missing names use 1.0
+        self.precompute_steering = False # Capture steering vectors from the full batch on the first token, then decode only the positive prompt
+        self.steering_store = False # With precompute_steering, keep the steering vectors on disk and reuse them for the same negative prompts
+        self.steering_store_mb = 256 # Size limit of the steering vector store, least recently used entries are removed past this
+        self.negative_cache = 'fp16' # Cache format for the negative rows: 'fp16' (same as positive) or '8bit' (positive rows stay FP16), ignored with --cache_8bit
+        self.compile_steering = False # Run the default CFG through torch.compile, the first generation is slower while it compiles
+        self.compile_backend = 'inductor' # torch.compile backend used with compile_steering
+        self.attention_backend = 'auto' # Attention when flash-attn can't be used: 'sdpa' (torch SDP attention, no K/V copies), 'matmul', or 'auto' (sdpa if torch has it)
+        self.batch_users = False # With --multi-user, run requests from different users with this chip as one batch, each keeps its own positive/negative rows and steering
+        self.batch_window_ms = 50 # How long the first request waits for others to join its batch
+        self.batch_max_requests = 4 # Most requests in one batch
+        self.steer_draft = False # With a draft model (speculative decoding), steer it with this chip too, costs a draft cache row per prompt
+        
 class Value:
     def __init__(self, name=None, description=None, start=None, min=None, max=None, step=None):
         self.name = name
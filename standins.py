@@ -0,0 +1,384 @@
+import math
+import os
+import sys
+import types
+
+import torch
+
+# Stand-ins for the parts of exllamav2 and oobabooga that chip.py imports, so chip.py can run on the CPU (or a GPU) without either
+# A tiny stand-in model with the same shape as an exllamav2 model (modules, head_layer_idx, last_kv_layer_idx, build_attn_mask,
+# attention modules with q_handle, caches with get_kv_state/store_kv_state) is driven through hijack_model_forward and hijack_attn_forward
+# install_standins() replaces the modules chip.py imports with these before chip.py is imported, even if the real ones are installed
+# Used by the tests, the layers only have random weights so only compare outputs against other runs on the same model
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+# Stand-in exllamav2
+
+module_device = 'cpu:0' # what _torch_device gives for the model's device, chip.py only builds the attention mask on a device that isn't "cpu"
+
+def _torch_device(idx):
+    return 'cpu' if idx == -1 else module_device
+
+def safe_move_tensor(tensor, device):
+    if isinstance(tensor, tuple): return tuple(safe_move_tensor(t, device) for t in tensor)
+    device = torch.device(device)
+    if tensor.device.type == device.type and (device.index is None or tensor.device.index in (None, device.index)): return tensor
+    return tensor.to(device)
+
+none_tensor = torch.empty((1, 1), device = 'meta')
+
+attn_handles = {} # q_handle -> StandinAttention, like the C++ side of exllamav2 keeping the weights for each handle
+
+def rms_norm(x, weight, eps = 1e-6):
+    x32 = x.float()
+    return (x32 * torch.rsqrt(x32.pow(2).mean(-1, keepdim = True) + eps)).to(x.dtype) * weight
+
+def rotate(states, sin, cos, positions, heads, head_dim):
+    # Rotary position embedding (rotate half), states are (batch, seq, heads * head_dim) and positions are (batch, seq)
+    x = states.reshape(states.shape[0], states.shape[1], heads, head_dim)
+    positions = positions.clamp(min = 0) # padding columns have negative positions, they're masked anyway
+    cos_p = cos[positions].unsqueeze(2)
+    sin_p = sin[positions].unsqueeze(2)
+    half = head_dim // 2
+    rotated = torch.cat((-x[..., half:], x[..., :half]), dim = -1)
+    return x * cos_p + rotated * sin_p
+
+def token_positions(batch_size, q_len, past_len_1, past_len_2, device):
+    positions = torch.arange(q_len, device = device).unsqueeze(0)
+    if past_len_1 == -1:
+        positions = positions + past_len_2.to(device).view(-1, 1)
+    else:
+        positions = positions + past_len_1
+        if past_len_2 is not none_tensor: positions = positions + past_len_2.to(device).view(-1, 1)
+    return positions.expand(batch_size, q_len)
+
+def q_attn_forward_1(q_handle, hidden_states, batch_size, q_len, past_len_1, past_len_2, q_states, k_states, v_states, sin, cos, loras, lora_temp):
+    # RMS norm, Q/K/V projections and position embeddings, written into q_states, k_states and v_states (which may be cache views)
+    attn = attn_handles[q_handle]
+    config = attn.model.config
+    positions = token_positions(batch_size, q_len, past_len_1, past_len_2, hidden_states.device)
+
+    x = rms_norm(hidden_states, attn.norm_weight)
+    q_states.copy_(rotate(x @ attn.q_weight, sin, cos, positions, config.num_attention_heads, config.head_dim).view(q_states.shape))
+    k_states.copy_(rotate(x @ attn.k_weight, sin, cos, positions, config.num_key_value_heads, config.head_dim).view(k_states.shape))
+    v_states.copy_((x @ attn.v_weight).view(v_states.shape))
+
+def q_attn_forward_2(q_handle, hidden_states, attn_output, batch_size, q_len, loras, lora_temp):
+    # Output projection, added onto the residual in place
+    attn = attn_handles[q_handle]
+    hidden_states.add_(attn_output @ attn.o_weight)
+
+def rope_(states, sin, cos, past_len, heads, head_dim, offsets):
+    positions = token_positions(states.shape[0], states.shape[1], past_len, offsets, states.device)
+    flat = states.view(states.shape[0], states.shape[1], -1)
+    states.copy_(rotate(flat, sin, cos, positions, heads, head_dim).view(states.shape))
+
+class StandinConfig:
+    def __init__(self, hidden_size = 512, num_attention_heads = 8, num_key_value_heads = 2, num_hidden_layers = 8, intermediate_size = 1024, vocab_size = 4096, max_seq_len = 2048):
+        self.hidden_size = hidden_size
+        self.num_attention_heads = num_attention_heads
+        self.num_key_value_heads = num_key_value_heads
+        self.num_key_value_groups = num_attention_heads // num_key_value_heads
+        self.head_dim = hidden_size // num_attention_heads
+        self.num_hidden_layers = num_hidden_layers
+        self.intermediate_size = intermediate_size
+        self.vocab_size = vocab_size
+        self.max_seq_len = max_seq_len
+        self.qkv_embed = False
+        self.no_flash_attn = True
+
+def random_weight(rows, columns, device):
+    return (torch.randn((rows, columns), device = device) / math.sqrt(rows)).half()
+
+class StandinEmbedding:
+    def __init__(self, model):
+        self.device_idx = -1 # exllamav2 keeps the embedding table on the CPU
+        self.weight = torch.randn((model.config.vocab_size, model.config.hidden_size)).half()
+        self.padding = 0
+
+    def forward(self, hidden_states, cache = None, attn_mask = None, past_len = None, loras = None, position_offsets = None):
+        return self.weight[hidden_states]
+
+class StandinAttention:
+    def __init__(self, model, layer_idx):
+        config = model.config
+        self.model = model
+        self.layer_idx = layer_idx # index among the attention layers, like exllamav2
+        self.device_idx = 0
+        self.temp_lora_size = 0
+        self.padding = 0
+
+        self.norm_weight = torch.ones(config.hidden_size, device = model.device).half()
+        self.q_weight = random_weight(config.hidden_size, config.num_attention_heads * config.head_dim, model.device)
+        self.k_weight = random_weight(config.hidden_size, config.num_key_value_heads * config.head_dim, model.device)
+        self.v_weight = random_weight(config.hidden_size, config.num_key_value_heads * config.head_dim, model.device)
+        self.o_weight = random_weight(config.num_attention_heads * config.head_dim, config.hidden_size, model.device)
+
+        self.q_proj = types.SimpleNamespace(out_features = self.q_weight.shape[1])
+        self.k_proj = types.SimpleNamespace(out_features = self.k_weight.shape[1])
+        self.v_proj = types.SimpleNamespace(out_features = self.v_weight.shape[1])
+
+        self.q_handle = len(attn_handles)
+        attn_handles[self.q_handle] = self
+
+    def repeat_kv(self, hidden_states, n_rep):
+        if n_rep == 1: return hidden_states
+        batch, num_key_value_heads, seq_len, head_dim = hidden_states.shape
+        hidden_states = hidden_states[:, :, None, :, :].expand(batch, num_key_value_heads, n_rep, seq_len, head_dim)
+        return hidden_states.reshape(batch, num_key_value_heads * n_rep, seq_len, head_dim)
+
+    def forward(self, hidden_states, cache = None, attn_mask = None, past_len = None, intermediates = False, loras = None, position_offsets = None):
+        # exllamav2's own forward (no hackingchip), with matmul attention
+        # Like exllamav2 it attends over every row of the cache, unless it's a single row (its direct path)
+        config = self.model.config
+        batch_size, q_len = hidden_states.shape[0], hidden_states.shape[1]
+        past_len = cache.current_seq_len if cache is not None else 0
+        constants = self.model.get_device_tensors(self.device_idx)
+
+        q_states = torch.empty((batch_size, q_len, config.num_attention_heads, config.head_dim), dtype = torch.half, device = hidden_states.device)
+        k_states = torch.empty((batch_size, q_len, config.num_key_value_heads, config.head_dim), dtype = torch.half, device = hidden_states.device)
+        v_states = torch.empty_like(k_states)
+        q_attn_forward_1(self.q_handle, hidden_states, batch_size, q_len, past_len, position_offsets if position_offsets is not None else none_tensor,
+                         q_states, k_states, v_states, constants.sin, constants.cos, [], none_tensor)
+
+        if cache is not None:
+            batch_keys, batch_values = cache.get_kv_state(self.layer_idx, batch_size, 0, past_len)
+            batch_keys.narrow(0, 0, batch_size).narrow(1, past_len, q_len).copy_(k_states)
+            batch_values.narrow(0, 0, batch_size).narrow(1, past_len, q_len).copy_(v_states)
+            rows = batch_size if batch_size == 1 else batch_keys.shape[0]
+            k_states = batch_keys.narrow(0, 0, rows).narrow(1, 0, past_len + q_len)
+            v_states = batch_values.narrow(0, 0, rows).narrow(1, 0, past_len + q_len)
+
+        q_states = q_states.transpose(1, 2)
+        k_states = self.repeat_kv(k_states.transpose(1, 2), config.num_key_value_groups)
+        v_states = self.repeat_kv(v_states.transpose(1, 2), config.num_key_value_groups)
+
+        attn_weights = torch.matmul(q_states, k_states.transpose(-1, -2)) / math.sqrt(config.head_dim)
+        if attn_mask is not None: attn_weights = attn_weights + attn_mask
+        attn_weights = torch.nn.functional.softmax(attn_weights, dim = -1, dtype = torch.float16)
+        attn_output = torch.matmul(attn_weights, v_states).transpose(1, 2).reshape((batch_size, q_len, config.hidden_size))
+
+        if cache is not None: cache.store_kv_state(self.layer_idx, batch_size, past_len, q_len)
+
+        q_attn_forward_2(self.q_handle, hidden_states, attn_output, batch_size, q_len, [], none_tensor)
+        return hidden_states
+
+    def forward_torch(self, *args, **kwargs):
+        raise NotImplementedError("The stand-in attention always has a q_handle")
+
+class StandinMLP:
+    def __init__(self, model):
+        config = model.config
+        self.device_idx = 0
+        self.padding = 0
+        self.norm_weight = torch.ones(config.hidden_size, device = model.device).half()
+        self.gate_weight = random_weight(config.hidden_size, config.intermediate_size, model.device)
+        self.up_weight = random_weight(config.hidden_size, config.intermediate_size, model.device)
+        self.down_weight = random_weight(config.intermediate_size, config.hidden_size, model.device)
+
+    def forward(self, hidden_states, cache = None, attn_mask = None, past_len = None, loras = None, position_offsets = None):
+        x = rms_norm(hidden_states, self.norm_weight)
+        x = torch.nn.functional.silu(x @ self.gate_weight) * (x @ self.up_weight)
+        return hidden_states.add_(x @ self.down_weight)
+
+class StandinHead:
+    def __init__(self, model):
+        config = model.config
+        self.device_idx = 0
+        self.padding = 0
+        self.norm_weight = torch.ones(config.hidden_size, device = model.device).half()
+        self.weight = random_weight(config.hidden_size, config.vocab_size, model.device)
+
+    def forward(self, hidden_states, cache = None, attn_mask = None, past_len = None, loras = None, position_offsets = None):
+        return rms_norm(hidden_states, self.norm_weight) @ self.weight
+
+class StandinModel:
+    def __init__(self, config, device = 'cpu'):
+        self.config = config
+        self.device = device
+
+        self.modules = [StandinEmbedding(self)]
+        for layer_idx in range(config.num_hidden_layers):
+            self.modules.append(StandinAttention(self, layer_idx))
+            self.modules.append(StandinMLP(self))
+        self.modules.append(StandinHead(self))
+
+        self.head_layer_idx = len(self.modules) - 1
+        self.last_kv_layer_idx = len(self.modules) - 3 # the last attention
+
+        inv_freq = 1.0 / (10000 ** (torch.arange(0, config.head_dim, 2, device = device).float() / config.head_dim))
+        freqs = torch.outer(torch.arange(config.max_seq_len, device = device).float(), inv_freq)
+        emb = torch.cat((freqs, freqs), dim = -1)
+        self.constants = types.SimpleNamespace(sin = emb.sin().half(), cos = emb.cos().half())
+
+    def get_device_tensors(self, device_idx):
+        return self.constants
+
+    def build_attn_mask(self, batch_size, seq_len, past_len, input_mask, device):
+        # Same as exllamav2: causal mask over the new tokens, combined with the padding mask
+        if input_mask is None and seq_len == 1: return None
+        if isinstance(past_len, tuple): raise NotImplementedError("The stand-ins don't use lists of caches")
+
+        attn_mask = torch.zeros((batch_size, 1, seq_len, past_len + seq_len), dtype = torch.float16, device = device)
+        attn_mask_triu = torch.triu(torch.full((seq_len - 1, seq_len - 1), -65504.0, dtype = torch.float16, device = device))
+        attn_mask[:, :, :seq_len - 1, past_len + 1:past_len + seq_len] = attn_mask_triu
+
+        if input_mask is not None:
+            min_mask_width = min(input_mask.shape[-1], seq_len + past_len)
+            input_mask_part = safe_move_tensor(input_mask[:, :min_mask_width], attn_mask.device).unsqueeze(1).unsqueeze(2)
+            attn_mask[:, :, :, :min_mask_width] = torch.minimum(attn_mask[:, :, :, :min_mask_width], input_mask_part)
+
+        return attn_mask
+
+    def forward(self, input_ids, cache = None, input_mask = None, preprocess_only = False, last_id_only = False, loras = None, return_last_state = False, position_offsets = None):
+        # exllamav2 splits long inputs into chunks for _forward, the stand-ins run them in one go
+        result, last_state = self._forward(input_ids, cache, input_mask, preprocess_only, last_id_only, loras, return_last_state, position_offsets)
+        return (result, last_state) if return_last_state else result
+
+    def _forward(self, *args, **kwargs):
+        raise RuntimeError("The stand-in model only runs with hijack_model_forward installed")
+
+class StandinCacheBase:
+    pass
+
+class StandinCache(StandinCacheBase):
+    def __init__(self, model, batch_size = 1, max_seq_len = -1):
+        config = model.config
+        self.model = model
+        self.batch_size = batch_size
+        self.max_seq_len = max_seq_len if max_seq_len != -1 else config.max_seq_len
+        self.current_seq_len = 0
+
+        shape = (batch_size, self.max_seq_len, config.num_key_value_heads, config.head_dim)
+        self.key_states = [self.make_states(shape) for _ in range(config.num_hidden_layers)]
+        self.value_states = [self.make_states(shape) for _ in range(config.num_hidden_layers)]
+
+    def make_states(self, shape):
+        return torch.zeros(shape, dtype = torch.half, device = self.model.device)
+
+    def get_kv_state(self, layer_idx, batch_size, offset, width):
+        return self.key_states[layer_idx], self.value_states[layer_idx]
+
+    def store_kv_state(self, layer_idx, batch_size, offset, width):
+        pass
+
+class StandinCache_8bit(StandinCache):
+    # Keeps the top byte of each FP16 value (like exllamav2's FP8 cache), converted through shared FP16 buffers on get/store
+    def __init__(self, model, batch_size = 1, max_seq_len = -1):
+        super().__init__(model, batch_size, max_seq_len)
+        shape = (batch_size, self.max_seq_len, model.config.num_key_value_heads, model.config.head_dim)
+        self.temp_keys = torch.zeros(shape, dtype = torch.half, device = model.device)
+        self.temp_values = torch.zeros(shape, dtype = torch.half, device = model.device)
+
+    def make_states(self, shape):
+        return torch.zeros(shape, dtype = torch.int8, device = self.model.device)
+
+    def get_kv_state(self, layer_idx, batch_size, offset, width):
+        if width > 0:
+            for states, temp in ((self.key_states[layer_idx], self.temp_keys), (self.value_states[layer_idx], self.temp_values)):
+                part = states.narrow(0, 0, batch_size).narrow(1, offset, width)
+                temp.narrow(0, 0, batch_size).narrow(1, offset, width).copy_((part.to(torch.int16) << 8).view(torch.half))
+        return self.temp_keys, self.temp_values
+
+    def store_kv_state(self, layer_idx, batch_size, offset, width):
+        for states, temp in ((self.key_states[layer_idx], self.temp_keys), (self.value_states[layer_idx], self.temp_values)):
+            part = temp.narrow(0, 0, batch_size).narrow(1, offset, width).contiguous()
+            states.narrow(0, 0, batch_size).narrow(1, offset, width).copy_((part.view(torch.int16) >> 8).to(torch.int8))
+
+class StandinSampler:
+    class Settings:
+        def greedy_clone(self):
+            return StandinSampler.Settings()
+
+        def feed_filters(self, token):
+            pass
+
+    @staticmethod
+    def sample(logits, settings, sequence_ids, random, tokenizer, prefix_token = None):
+        # Always greedy, returns (token, probability, eos)
+        probs = torch.softmax(logits[:, -1].float(), dim = -1)
+        prob, token = probs.max(-1, keepdim = True)
+        return token, prob, tokenizer.eos_token_id is not None and bool((token == tokenizer.eos_token_id).all())
+
+class StandinTokenizer:
+    # Token ids are their own text
+    pad_token_id = 0
+    eos_token_id = None
+
+    def decode(self, ids):
+        return [' '.join(str(int(token)) for token in row) for row in ids]
+
+class StandinGenerator:
+    # Only the state the hijacked generator functions use
+    def __init__(self, model = None, cache = None, tokenizer = None, draft_model = None, draft_cache = None, num_speculative_tokens = 5):
+        self.model = model
+        self.cache = cache
+        self.tokenizer = tokenizer
+        self.draft_model = draft_model
+        self.draft_cache = draft_cache
+        self.num_speculative_tokens = num_speculative_tokens
+        self.speculative_prob_threshold = 0.25
+        self.active_loras = []
+        self.sequence_ids = None
+        self.future_tokens = None
+        self.future_logits = None
+
+class StandinExllamav2Model:
+    pass
+
+def unavailable(*args, **kwargs):
+    raise RuntimeError("Not available with the stand-ins")
+
+class StandinJinjaEnvironment:
+    def __init__(self, **kwargs):
+        pass
+
+    def from_string(self, source):
+        raise RuntimeError("jinja2 isn't installed")
+
+def make_module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+def install_standins():
+    # Puts the stand-ins where chip.py imports exllamav2 and oobabooga from, has to happen before chip.py is imported
+    if 'extensions.BrainHackingChip.chip' in sys.modules:
+        raise RuntimeError("chip.py was already imported with the real exllamav2, run it in its own process")
+
+    exllamav2 = make_module('exllamav2', ExLlamaV2Cache = StandinCache, ExLlamaV2Cache_8bit = StandinCache_8bit)
+    exllamav2.generator = make_module('exllamav2.generator', ExLlamaV2Sampler = StandinSampler, ExLlamaV2StreamingGenerator = StandinGenerator)
+    exllamav2.cache = make_module('exllamav2.cache', ExLlamaV2CacheBase = StandinCacheBase, ExLlamaV2Cache = StandinCache, ExLlamaV2Cache_8bit = StandinCache_8bit)
+    exllamav2.model = make_module('exllamav2.model', _torch_device = _torch_device, ExLlamaV2 = StandinModel)
+    exllamav2.compat = make_module('exllamav2.compat', safe_move_tensor = safe_move_tensor)
+    exllamav2.attn = make_module('exllamav2.attn', ExLlamaV2Attention = StandinAttention)
+    ext_c = types.SimpleNamespace(q_attn_forward_1 = q_attn_forward_1, q_attn_forward_2 = q_attn_forward_2, rope_ = rope_)
+    exllamav2.ext = make_module('exllamav2.ext', none_tensor = none_tensor, exllamav2_ext = ext_c)
+
+    shared = types.SimpleNamespace(model = None, tokenizer = None, args = types.SimpleNamespace(), stop_everything = False, model_name = 'standin')
+    modules = make_module('modules', shared = shared)
+    modules.chat = make_module('modules.chat', generate_chat_prompt = unavailable, get_generation_prompt = unavailable)
+    modules.text_generation = make_module('modules.text_generation', get_encoded_length = unavailable, get_max_prompt_length = unavailable)
+    modules.extensions = make_module('modules.extensions', apply_extensions = unavailable)
+    modules.exllamav2 = make_module('modules.exllamav2', Exllamav2Model = StandinExllamav2Model)
+
+    try:
+        import jinja2.sandbox
+    except ImportError:
+        make_module('jinja2').sandbox = make_module('jinja2.sandbox', ImmutableSandboxedEnvironment = StandinJinjaEnvironment)
+
+    # Running from this directory instead of the oobabooga one, make the extension importable under its usual name
+    try:
+        import extensions.BrainHackingChip
+    except ImportError:
+        make_module('extensions', __path__ = []).BrainHackingChip = make_module('extensions.BrainHackingChip', __path__ = [here])
+
+    return shared
+
+def import_chip():
+    shared = install_standins()
+    from extensions.BrainHackingChip import chip
+    return shared, chip
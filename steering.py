@@ -0,0 +1,121 @@
+import torch
+
+# The steering engine does the default "mean of negatives minus positive, times weight" CFG for every steering site
+# The per-row coefficients are worked out once per chip and batch layout (see steering_program.py), so at each layer the whole update is
+#   delta = sum(coefficient[row] * x[row]) (a single weighted reduction over the batch)
+#   x -= weight * delta (in place, broadcast over every row)
+# Positive row 0 gets a coefficient of -1 and each negative row gets its normalized negative weight, everything else is 0
+# Given a Workspace, the delta (and max_margin's temporaries) are written into its buffers instead of new tensors, so once the first token
+# has sized them, decoding doesn't allocate anything for steering
+
+STEERING_MODES = ['mean', 'max_margin']
+
+class Workspace:
+    # Scratch buffers for the steering math, owned by the hackingchip and reused for every site of every token
+    # One flat buffer per (slot, device, dtype), only reallocated when something bigger than it comes along (a longer prefill chunk or a bigger batch)
+    # A buffer is only valid until the next get() of the same slot, steering sites run one after another so that's all they need
+    def __init__(self):
+        self.buffers = {}
+        self.allocations = 0 # how many times a buffer had to be made, stops going up once decoding has started
+
+    def get(self, slot, shape, like, dtype=None):
+        dtype = dtype if dtype is not None else like.dtype
+        key = (slot, like.device, dtype)
+        numel = 1
+        for size in shape: numel *= size
+
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.numel() < numel:
+            buffer = torch.empty(numel, device=like.device, dtype=dtype)
+            self.buffers[key] = buffer
+            self.allocations += 1
+
+        return buffer[:numel].view(shape)
+
+def weighted_sum(coefficients, rows, workspace=None):
+    # sum(coefficients[row] * rows[row]), a single matrix multiply into the workspace's delta buffer when rows can be flattened without a copy
+    if workspace is None or not rows.is_contiguous():
+        return torch.tensordot(coefficients, rows, dims=1)
+
+    out = workspace.get('delta', rows.shape[1:], rows)
+    torch.mm(coefficients.view(1, -1), rows.view(rows.shape[0], -1), out=out.view(1, -1))
+    return out
+
+class SteeringEngine:
+    def __init__(self, settings, prompts):
+        self.numpos = prompts.numpos
+        self.numneg = prompts.numneg
+        self.negend = prompts.negend
+        self.mode = settings.steering_mode if hasattr(settings, 'steering_mode') else 'mean'
+
+        if self.mode not in STEERING_MODES:
+            print("Unknown steering_mode '" + str(self.mode) + "', using 'mean'")
+            self.mode = 'mean'
+
+        # Per negative prompt weights, looked up by section name (NEGATIVE, NEGATIVE 2, ...), anything not listed gets 1.0
+        negative_weights = settings.negative_weights if hasattr(settings, 'negative_weights') and settings.negative_weights else {}
+        neg_names = prompts.neg_names if hasattr(prompts, 'neg_names') and prompts.neg_names else [None] * self.numneg
+
+        self.neg_weights = [float(negative_weights.get(name, 1.0)) for name in neg_names]
+        self.uniform = all(weight == 1.0 for weight in self.neg_weights)
+
+        # If every negative is weighted 0 there's nothing to steer away from, so skip the sites just like having no negatives
+        total = sum(self.neg_weights)
+        self.enabled = self.numneg > 0 and total != 0.0
+
+        coefficients = [0.0] * self.negend
+        if self.enabled:
+            coefficients[0] = -1.0
+            for index, weight in enumerate(self.neg_weights):
+                coefficients[self.numpos + index] = weight / total
+
+        self.coefficients = torch.tensor(coefficients, dtype=torch.float32)
+        self.neg_weights_tensor = torch.tensor(self.neg_weights, dtype=torch.float32)
+
+        self.device_tensors = {} # (name, device, dtype) -> tensor, so each coefficient tensor is only moved once per generation
+
+    def get_tensor(self, name, tensor, like):
+        key = (name, like.device, like.dtype)
+        cached = self.device_tensors.get(key)
+        if cached is None:
+            cached = tensor.to(device=like.device, dtype=like.dtype)
+            self.device_tensors[key] = cached
+        return cached
+
+    def active(self, x, weight):
+        return self.enabled and weight != 0.0 and x.shape[0] >= self.negend
+
+    def delta(self, x, workspace=None):
+        # x is the full block of positive and negative tensors, batch first, returns the unweighted delta for a single row
+        # With a workspace the delta is one of its buffers, use it before the next delta
+        if self.mode == 'max_margin':
+            return self.max_margin_delta(x, workspace)
+
+        coefficients = self.get_tensor('coefficients', self.coefficients, x)
+        return weighted_sum(coefficients, x.narrow(0, 0, self.negend), workspace)
+
+    def max_margin_delta(self, x, workspace=None):
+        # Steer away from whichever (weighted) negative is farthest from the positive, picked per vector
+        negatives = x.narrow(0, self.numpos, self.numneg)
+        diffs = torch.sub(negatives, x[0], out=workspace.get('diffs', negatives.shape, x) if workspace else None)
+        if not self.uniform:
+            weights = self.get_tensor('neg_weights', self.neg_weights_tensor, x)
+            diffs.mul_(weights.view((-1,) + (1,) * (x.dim() - 1)))
+
+        if workspace is None:
+            norms = torch.linalg.vector_norm(diffs, dim=-1, keepdim=True)
+            index = norms.argmax(dim=0, keepdim=True).expand((1,) + diffs.shape[1:])
+            return diffs.gather(0, index).squeeze(0)
+
+        norms_shape = diffs.shape[:-1] + (1,)
+        norms = torch.linalg.vector_norm(diffs, dim=-1, keepdim=True, out=workspace.get('norms', norms_shape, x))
+        index_shape = (1,) + norms_shape[1:]
+        torch.max(norms, dim=0, keepdim=True, out=(workspace.get('max_norms', index_shape, x), workspace.get('index', index_shape, x, torch.long)))
+        index = workspace.get('index', index_shape, x, torch.long).expand((1,) + diffs.shape[1:])
+        return torch.gather(diffs, 0, index, out=workspace.get('delta', (1,) + diffs.shape[1:], x)).squeeze(0)
+
+    def apply(self, x, weight, workspace=None):
+        # It's important to steer all of the vectors, or else the difference artificially accumulates and accelerates.
+        if self.active(x, weight):
+            x.sub_(self.delta(x, workspace), alpha=weight)
+        return x
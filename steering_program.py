@@ -0,0 +1,140 @@
+import copy
+import weakref
+
+import torch
+
+from extensions.BrainHackingChip.steering import SteeringEngine, weighted_sum
+
+# A chip's LayerSettings/AttnSettings lowered into a steering program: one op per steered site, looked up by index in the hijacked forwards
+# Everything that only depends on the chip and the batch layout is decided once when the program is built instead of on every forward:
+#   sites that can't do anything (weight 0 without a cfg_func, or no negative prompts to subtract without one) have no op at all
+#   the default CFG's per row coefficients are pre-multiplied by the site's weight, so the op is a single weighted reduction and subtract
+#   a cfg_func is bound to its settings
+# With settings.compile_steering the default CFG kernel goes through torch.compile (inductor by default, which also works on the CPU)
+# Programs are cached per settings object (a chip file with its slider values and model layout) and batch layout
+# This lives in its own module (not chip.py) so the cache and the compiled kernels survive chip.py being reloaded
+
+def subtract_delta(x, coefficients, negend, workspace=None):
+    # x -= sum(coefficients[row] * x[row]), broadcast over every row, the sum goes into the hackingchip's workspace
+    return x.sub_(weighted_sum(coefficients, x.narrow(0, 0, negend), workspace))
+
+class Kernel:
+    # Runs func through torch.compile when asked to, falling back to plain func if compiling isn't possible
+    # Compiling happens on the first call, so only that one falls back, errors after it are real errors and are raised
+    def __init__(self, func, backend=None):
+        self.func = func
+        self.compiled = None
+        self.traced = False
+
+        if backend is not None:
+            if hasattr(torch, 'compile'):
+                self.compiled = torch.compile(func, backend=backend, dynamic=True)
+            else:
+                print("torch.compile isn't available in this version of torch, the steering program runs uncompiled")
+
+    def __call__(self, *args, workspace=None):
+        # The compiled kernel plans its own buffers, the workspace is only for running it uncompiled
+        if self.compiled is not None:
+            if self.traced: return self.compiled(*args)
+
+            try:
+                result = self.compiled(*args)
+                self.traced = True
+                return result
+            except Exception as e: # before anything is modified, so it's safe to run it uncompiled instead
+                print("Couldn't compile the steering program, running it uncompiled: " + str(e))
+                self.compiled = None
+        return self.func(*args, workspace=workspace)
+
+kernels = {} # torch.compile backend (None for uncompiled) -> Kernel, shared by every program so each backend only compiles once
+
+def get_kernel(backend):
+    kernel = kernels.get(backend)
+    if kernel is None:
+        kernel = Kernel(subtract_delta, backend)
+        kernels[backend] = kernel
+    return kernel
+
+class AttnProgram:
+    def __init__(self, h=None, q=None, k=None, v=None, a=None): # ops for each vector of an attention layer, None if it isn't steered
+        self.h = h
+        self.q = q
+        self.k = k
+        self.v = v
+        self.a = a
+
+class SteeringProgram:
+    def __init__(self, settings, prompts):
+        self.steering = SteeringEngine(settings, prompts)
+
+        compile_steering = settings.compile_steering if hasattr(settings, 'compile_steering') else False
+        self.kernel = get_kernel((settings.compile_backend if hasattr(settings, 'compile_backend') else 'inductor') if compile_steering else None)
+
+        self.layers = [self.make_op(layer_settings) for layer_settings in settings.layer_settings]
+
+        self.attn = []
+        for attn_settings in settings.attn_settings:
+            ops = AttnProgram(*[self.make_op(getattr(attn_settings, name)) for name in ('h', 'q', 'k', 'v', 'a')]) if attn_settings is not None else None
+            self.attn.append(ops if ops and (ops.h or ops.q or ops.k or ops.v or ops.a) else None)
+            
+        self.steers_layers = any(op is not None for op in self.layers)
+        self.empty = not self.steers_layers and all(ops is None for ops in self.attn) # nothing is steered at all
+
+    def make_op(self, settings):
+        # op(x, hackingchip) steers the full block of positive and negative rows and returns it
+        steering = self.steering
+        if settings is None: return None
+
+        # A cfg_func does its own thing and can work without negative prompts
+        if settings.cfg_func:
+            cfg_func = settings.cfg_func
+            return lambda x, hackingchip: cfg_func(x, settings, hackingchip)
+
+        # The built-in CFG needs negatives to subtract
+        weight = settings.weight
+        if weight == 0.0 or not steering.enabled: return None
+
+        if steering.mode != 'mean':
+            return lambda x, hackingchip: steering.apply(x, weight, hackingchip.workspace)
+
+        kernel = self.kernel
+        negend = steering.negend
+        coefficients = steering.coefficients * weight
+        name = ('coefficients', weight)
+        return lambda x, hackingchip: kernel(x, steering.get_tensor(name, coefficients, x), negend, workspace=hackingchip.workspace)
+
+    def passthrough(self):
+        # A copy with every op swapped for one that leaves x as it is, the same rows go through the same sites and layers
+        # (so the same exit layer) without anything being steered, the benchmark's baseline for what steering costs
+        program = copy.copy(self)
+        keep = lambda x, hackingchip: x
+        program.layers = [keep if op is not None else None for op in self.layers]
+        program.attn = [AttnProgram(*[keep if getattr(ops, name) is not None else None for name in ('h', 'q', 'k', 'v', 'a')]) if ops is not None else None
+                        for ops in self.attn]
+        return program
+
+    def deepest_layer(self, attn_to_layers):
+        # The last layer with anything to steer, -1 if there's nothing
+        deepest = -1
+        for idx, op in enumerate(self.layers):
+            if op is not None: deepest = idx
+        for attn_idx, ops in enumerate(self.attn):
+            if ops is not None: deepest = max(deepest, attn_to_layers[attn_idx])
+        return deepest
+
+programs = weakref.WeakKeyDictionary() # settings -> {batch layout: SteeringProgram}, dropped along with the settings
+
+def get_program(settings, prompts):
+    layout = (prompts.numpos, prompts.numneg, tuple(prompts.neg_names) if prompts.neg_names else None)
+
+    settings_programs = programs.get(settings)
+    if settings_programs is None:
+        settings_programs = {}
+        programs[settings] = settings_programs
+
+    program = settings_programs.get(layout)
+    if program is None:
+        program = SteeringProgram(settings, prompts)
+        settings_programs[layout] = program
+
+    return program
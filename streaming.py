@@ -0,0 +1,69 @@
+import asyncio
+import threading
+import time
+
+# Token by token output of a steered generation
+# chip.generate_deltas yields a TokenDelta for every token, only the new text instead of everything generated so far
+# cumulative_text turns deltas into what oobabooga's generate_with_streaming is expected to yield (the whole text so far, on every token)
+# stream_deltas is the async form: generation runs on a worker thread, and whether to stop (cancel event, stop button) is decided on the event loop
+
+class TokenDelta:
+    def __init__(self, text, token=None, index=0, finish_reason=None, started=None):
+        self.text = text # text added by this token, can be '' while the tokenizer is holding back part of a character or a stop string
+        self.token = token # token id, None for the final delta
+        self.index = index # how many tokens came before this one
+        self.finish_reason = finish_reason # None for every token, the final delta has 'eos', 'length' (max new tokens or cache full) or 'stop'
+        self.seconds = time.perf_counter() - started if started is not None else 0.0 # since generation started
+
+    def __repr__(self):
+        return 'TokenDelta(' + repr(self.text) + ', token=' + repr(self.token) + ', index=' + str(self.index) + ', finish_reason=' + repr(self.finish_reason) + ')'
+
+def cumulative_text(deltas):
+    # The whole text so far after every token, the final delta doesn't add any text so nothing is yielded for it
+    text = ''
+    for delta in deltas:
+        if delta.finish_reason is not None: continue # keep going so the generator gets to finish (profiler, cleanup)
+        text += delta.text
+        yield text
+
+async def stream_deltas(generate, cancel=None, stop_check=None, poll_interval=0.05):
+    # generate(should_stop) is a blocking generator of TokenDelta, it's run on a worker thread and ends early once should_stop() is true
+    # should_stop is set from the event loop when cancel (an asyncio.Event) is set, stop_check() is true, or the consumer stops reading
+    loop = asyncio.get_running_loop()
+    deltas = asyncio.Queue()
+    stop = threading.Event()
+
+    def send(item):
+        try:
+            loop.call_soon_threadsafe(deltas.put_nowait, item)
+        except RuntimeError: # the event loop is gone, nobody is reading anymore
+            stop.set()
+
+    def produce():
+        try:
+            for delta in generate(stop.is_set):
+                send(delta)
+        except Exception as e:
+            send(e)
+        finally:
+            send(None)
+
+    async def watch():
+        while not stop.is_set():
+            if (cancel is not None and cancel.is_set()) or (stop_check is not None and stop_check()):
+                stop.set()
+                break
+            await asyncio.sleep(poll_interval)
+
+    worker = loop.run_in_executor(None, produce)
+    watcher = asyncio.ensure_future(watch())
+    try:
+        while True:
+            delta = await deltas.get()
+            if delta is None: break
+            if isinstance(delta, Exception): raise delta
+            yield delta
+    finally:
+        stop.set()
+        watcher.cancel()
+        await asyncio.wait([worker]) # the worker holds the generation lock until it's done
@@ -0,0 +1,40 @@
+import os
+import sys
+import types
+
+import pytest
+import torch
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Running from this directory instead of the oobabooga one, make the extension importable under its usual name
+try:
+    import extensions.BrainHackingChip
+except ImportError:
+    extensions = types.ModuleType('extensions')
+    extensions.__path__ = []
+    extensions.BrainHackingChip = types.ModuleType('extensions.BrainHackingChip')
+    extensions.BrainHackingChip.__path__ = [here]
+    sys.modules['extensions'] = extensions
+    sys.modules['extensions.BrainHackingChip'] = extensions.BrainHackingChip
+
+@pytest.fixture(scope = 'session')
+def standin():
+    # chip.py with the stand-ins for exllamav2 and oobabooga, on a small CPU model
+    # chip.py can only be imported once with the stand-ins, so every test shares this
+    from extensions.BrainHackingChip import standins
+
+    shared, chip = standins.import_chip()
+    standins.module_device = 'cpu:0'
+
+    torch.manual_seed(0)
+    config = standins.StandinConfig(hidden_size = 64, num_attention_heads = 4, num_key_value_heads = 2, num_hidden_layers = 6,
+                                    intermediate_size = 128, vocab_size = 256, max_seq_len = 64)
+    model = standins.StandinModel(config, 'cpu')
+    shared.model = types.SimpleNamespace(generator = types.SimpleNamespace(model = model)) # where hijack_attn_forward finds the hackingchip
+
+    model._forward = chip.hijack_model_forward.__get__(model, standins.StandinModel) # for model.forward, the stand-in model only runs the hijacked forward
+    for module in model.modules:
+        if isinstance(module, standins.StandinAttention): module.forward = chip.hijack_attn_forward.__get__(module, standins.StandinAttention)
+
+    return types.SimpleNamespace(shared = shared, chip = chip, standins = standins, model = model)
@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+@pytest.mark.parametrize('gqa', [True, False])
+@pytest.mark.parametrize('masked', [True, False])
+@pytest.mark.parametrize('fused_layout', [True, False])
+def test_sdpa_matches_matmul_with_grouped_kv_heads(standin, monkeypatch, gqa, masked, fused_layout):
+    # gqa False is the fold path older torch versions take, each K/V head's Q heads folded into the query length
+    chip = standin.chip
+    if gqa and not chip.has_sdpa_gqa: pytest.skip("torch has no enable_gqa")
+    monkeypatch.setattr(chip, 'has_sdpa_gqa', gqa)
+
+    if fused_layout:
+        # The fused kernels (flash and mem-efficient) give a (batch, seq, heads, head_dim) buffer transposed to (batch, heads, seq, head_dim)
+        sdpa = torch.nn.functional.scaled_dot_product_attention
+        def fused_sdpa(*args, **kwargs):
+            return sdpa(*args, **kwargs).transpose(1, 2).contiguous().transpose(1, 2)
+        monkeypatch.setattr(torch.nn.functional, 'scaled_dot_product_attention', fused_sdpa)
+
+    attn = next(module for module in standin.model.modules if isinstance(module, standin.standins.StandinAttention))
+    config = standin.model.config
+    assert config.num_key_value_groups > 1
+
+    batch_size, q_len, past_len = 2, 5, 3
+    q_states = torch.randn((batch_size, q_len, config.num_attention_heads, config.head_dim)).half()
+    k_states = torch.randn((batch_size, past_len + q_len, config.num_key_value_heads, config.head_dim)).half()
+    v_states = torch.randn((batch_size, past_len + q_len, config.num_key_value_heads, config.head_dim)).half()
+    attn_mask = standin.model.build_attn_mask(batch_size, q_len, past_len, None, 'cpu:0') if masked else None
+    if masked: attn_mask[1, :, :, :2] = -65504.0 # padding on the second row
+
+    expected = chip.matmul_attention(attn, q_states, k_states, v_states, attn_mask)
+    output = chip.sdpa_attention(attn, q_states, k_states, v_states, attn_mask)
+
+    assert output.shape == expected.shape
+    assert torch.allclose(output.float(), expected.float(), atol = 2e-3)
@@ -0,0 +1,53 @@
+import torch
+
+from extensions.BrainHackingChip import bench
+
+def layer_batch_sizes(standin, make_run, ids):
+    # Runs one generation and returns the batch size each layer ran with, for every forward
+    hackingchip, cache = make_run()
+    sizes = []
+    forwards = []
+
+    for idx, module in enumerate(standin.model.modules):
+        def recording(hidden_states, *args, forward = module.forward, idx = idx, **kwargs):
+            sizes.append((idx, hidden_states.shape[0]))
+            return forward(hidden_states, *args, **kwargs)
+
+        forwards.append(module.forward)
+        module.forward = recording
+
+    try:
+        bench.run_generation(standin.chip, standin.model, hackingchip, cache, ids, 2, 'cpu')
+    finally:
+        for module, forward in zip(standin.model.modules, forwards): module.forward = forward
+        standin.model.hackingchip = None
+
+    return hackingchip, sizes
+
+def test_baseline_runs_the_same_rows_as_the_steered_run(standin):
+    numpos, numneg = 1, 2
+    ids = torch.randint(256, (numpos + numneg, 8))
+
+    for layer_set in ('default', 'repulsor', 'attn_last'):
+        run_args = (standin.chip, standin.model, {'sample_other_prompts': False}, layer_set, numpos, numneg, 0.2, 'fp16')
+
+        steered, steered_sizes = layer_batch_sizes(standin, bench.make_run(*run_args), ids)
+        baseline, baseline_sizes = layer_batch_sizes(standin, bench.make_run(*run_args, baseline = True), ids)
+
+        assert baseline.exit_layer == steered.exit_layer
+        assert baseline_sizes == steered_sizes
+        assert (0, numpos + numneg) in baseline_sizes # the negative rows are in the baseline's batch
+
+def test_baseline_doesnt_steer(standin):
+    numpos, numneg = 1, 1
+    ids = torch.randint(256, (numpos + numneg, 8))
+    run_args = (standin.chip, standin.model, {'sample_other_prompts': False}, 'default', numpos, numneg, 0.2, 'fp16')
+
+    hackingchip, cache = bench.make_run(*run_args, baseline = True)()
+    standin.model.hackingchip = hackingchip
+    logits = standin.chip.hijack_model_forward(standin.model, ids, cache)[0]
+    standin.model.hackingchip = None
+
+    plain = standin.chip.hijack_model_forward(standin.model, ids[:numpos], standin.standins.StandinCache(standin.model, numpos))[0]
+
+    assert torch.allclose(logits[:numpos].float(), plain.float(), atol = 1e-2)
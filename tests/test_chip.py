@@ -0,0 +1,160 @@
+import types
+
+import pytest
+import torch
+
+def generate(standin, hackingchip, cache, ids, decode_tokens = 3):
+    # Prefills every token but the last and decodes greedily from row 0, returns the positive rows' logits for every decoded token
+    chip = standin.chip
+    numpos = hackingchip.prompts.numpos
+    standin.model.hackingchip = hackingchip
+
+    try:
+        chip.hijack_model_forward(standin.model, ids[:, :-1], cache, preprocess_only = True)
+        next_ids = ids[:, -1:]
+        outputs = []
+        for _ in range(decode_tokens):
+            logits = chip.hijack_model_forward(standin.model, next_ids, cache)[0]
+            outputs.append(logits[:numpos, -1].float())
+            next_ids = logits[:1, -1].argmax(-1, keepdim = True).expand(ids.shape[0], 1)
+    finally:
+        standin.model.hackingchip = None
+
+    return torch.stack(outputs)
+
+def test_exit_layer_with_several_positive_prompts(standin):
+    # Negative rows leave the batch after a mid-stack steered layer, the later layers run fewer rows than the cache has
+    chip = standin.chip
+    from extensions.BrainHackingChip.settings_classes import HackingchipSettings, LayerSettings
+
+    layers_count, attn_layers, last_kv_layer, head_layer = chip.get_model_layout(standin.model)
+    settings = HackingchipSettings(layers_count, list(attn_layers))
+    settings.layer_settings[2] = LayerSettings(weight = 0.2)
+
+    numpos, numneg = 2, 1
+    ids = torch.randint(256, (numpos + numneg, 8))
+
+    def run(sample_other_prompts):
+        prompts = chip.HackingchipPrompts([''] * (numpos + numneg), numpos, numneg)
+        hackingchip = chip.Hackingchip({'sample_other_prompts': sample_other_prompts}, settings, prompts)
+        cache = standin.standins.StandinCache(standin.model, numpos + numneg)
+        return hackingchip.exit_layer, generate(standin, hackingchip, cache, ids)
+
+    exit_layer, logits = run(False)
+    no_exit_layer, full_logits = run(True) # sampling the other prompts keeps the negative rows all the way through
+
+    assert 0 <= exit_layer < head_layer - 1
+    assert no_exit_layer is None
+    assert torch.allclose(logits, full_logits, atol = 1e-2)
+
+def test_stock_attention_matches_the_hijacked_run(standin):
+    # The attention layers handed back to exllamav2's own forward give the same logits as running all of them hijacked
+    chip = standin.chip
+    from extensions.BrainHackingChip.settings_classes import HackingchipSettings, LayerSettings, AttnSettings, VectorSettings
+
+    layers_count, attn_layers, last_kv_layer, head_layer = chip.get_model_layout(standin.model)
+    settings = HackingchipSettings(layers_count, list(attn_layers))
+    settings.layer_settings[2] = LayerSettings(weight = 0.2)
+    settings.attn_settings[3] = AttnSettings(q = VectorSettings(weight = 0.2))
+
+    # The registry only hands the stock forward back when it's the class's own, so take the fixture's hijack off while it runs
+    attn_modules = [module for module in standin.model.modules if isinstance(module, standin.standins.StandinAttention)]
+    fixture_forwards = [module.__dict__.pop('forward') for module in attn_modules]
+    generator = types.SimpleNamespace(model = standin.model)
+    registry = chip.HijackRegistry(types.SimpleNamespace(generator = generator))
+    registry.install()
+
+    try:
+        for numpos, numneg in ((1, 1), (2, 1), (2, 2)):
+            ids = torch.randint(256, (numpos + numneg, 8))
+
+            def run(dispatch):
+                prompts = chip.HackingchipPrompts([''] * (numpos + numneg), numpos, numneg)
+                hackingchip = chip.Hackingchip({'sample_other_prompts': False}, settings, prompts)
+                cache = standin.standins.StandinCache(standin.model, numpos + numneg)
+
+                hijacked = hackingchip.hijacked_attention(cache) if dispatch else [True] * len(attn_modules)
+                registry.dispatch_attention(hijacked)
+                return hijacked, generate(standin, hackingchip, cache, ids)
+
+            hijacked, logits = run(True)
+            all_hijacked, full_logits = run(False)
+
+            assert not all(hijacked) # some layers did run the stock forward
+            assert torch.allclose(logits, full_logits, atol = 1e-2)
+    finally:
+        registry.uninstall()
+        for module, forward in zip(attn_modules, fixture_forwards): module.forward = forward
+
+def draft_model_for(standin):
+    # A draft model with the target model's weights, so unsteered it drafts what the target would decode and steering makes them disagree
+    standins = standin.standins
+    draft = standins.StandinModel(standin.model.config, 'cpu')
+    for module, draft_module in zip(standin.model.modules, draft.modules):
+        for name, value in vars(module).items():
+            if name.endswith('weight'): setattr(draft_module, name, value)
+
+    draft._forward = standin.chip.hijack_model_forward.__get__(draft, standins.StandinModel) # the stand-in model only runs the hijacked forward
+    for module in draft.modules:
+        if isinstance(module, standins.StandinAttention): module.forward = standin.chip.hijack_attn_forward.__get__(module, standins.StandinAttention)
+
+    return draft
+
+def decode(standin, hackingchip, ids, draft = None, new_tokens = 12):
+    # Greedy decoding through the hijacked generator functions, with speculative decoding when there's a draft model
+    chip = standin.chip
+    standins = standin.standins
+    rows = ids.shape[0]
+
+    draft_cache = None
+    if draft is not None:
+        draft_cache = standins.StandinCache(draft, rows if hackingchip.draft else 1)
+        if hackingchip.draft: draft.hackingchip = hackingchip.draft
+
+    generator = standins.StandinGenerator(standin.model, standins.StandinCache(standin.model, rows), standins.StandinTokenizer(), draft, draft_cache, 4)
+    generator.speculative_prob_threshold = 0 # the stand-in model is never very sure
+    gen_settings = standins.StandinSampler.Settings()
+    standin.model.hackingchip = hackingchip
+
+    try:
+        chip.hijack_gen_begin(generator, ids, gen_settings)
+        tokens = [chip.hijack_gen_single_token(generator, gen_settings)[0] for _ in range(new_tokens)]
+    finally:
+        standin.model.hackingchip = None
+        if draft is not None and hasattr(draft, 'hackingchip'): del draft.hackingchip
+
+    return torch.cat(tokens, dim = 1)
+
+@pytest.mark.parametrize('precompute, steer_draft', [(False, False), (True, False), (False, True)])
+def test_speculative_decoding_matches_plain_decoding(standin, precompute, steer_draft):
+    # The draft only changes how many forwards it takes, greedy sampling gives the same tokens as decoding one at a time
+    chip = standin.chip
+    from extensions.BrainHackingChip.settings_classes import HackingchipSettings, LayerSettings, AttnSettings, VectorSettings
+
+    layers_count, attn_layers, last_kv_layer, head_layer = chip.get_model_layout(standin.model)
+    settings = HackingchipSettings(layers_count, list(attn_layers))
+    settings.layer_settings[2] = LayerSettings(weight = 0.5)
+    settings.attn_settings[3] = AttnSettings(q = VectorSettings(weight = 0.5))
+    settings.precompute_steering = precompute
+
+    numpos, numneg = 1, 2
+    torch.manual_seed(3)
+    ids = torch.randint(1, 256, (numpos + numneg, 8))
+    draft = draft_model_for(standin)
+
+    def make_chip():
+        prompts = chip.HackingchipPrompts([''] * (numpos + numneg), numpos, numneg)
+        hackingchip = chip.Hackingchip({'sample_other_prompts': False}, settings, prompts)
+        if steer_draft: hackingchip.draft = chip.Hackingchip({'sample_other_prompts': False}, settings, prompts)
+        return hackingchip
+
+    plain = decode(standin, make_chip(), ids)
+    hackingchip = make_chip()
+    speculative = decode(standin, hackingchip, ids, draft)
+    unsteered = decode(standin, None, ids[:1])
+
+    assert torch.equal(speculative, plain)
+    assert not torch.equal(plain, unsteered) # the steering did change the tokens
+    stats = hackingchip.speculative
+    assert stats.verify_passes < stats.tokens # some drafted tokens were accepted
+    assert stats.accepted < stats.drafted # and some weren't
@@ -0,0 +1,214 @@
+import threading
+import time
+import types
+from functools import partial
+
+import pytest
+import torch
+
+from extensions.BrainHackingChip.scheduler import RequestChips, BatchRequest, BatchScheduler
+from extensions.BrainHackingChip.streaming import TokenDelta
+
+def test_request_chips_follow_the_state():
+    chips = RequestChips()
+    state_a, state_b = {}, {}
+    chips.put(state_a, 'a')
+    chips.put(state_b, 'b')
+
+    assert chips.take(dict(state_b)) == 'b' # a copy of the state still finds its chip
+    assert chips.take(state_a) == 'a'
+    assert chips.take(state_a) is None # only taken once
+
+def test_request_chips_dont_match_other_requests():
+    chips = RequestChips()
+    chips.put({}, 'a')
+
+    assert chips.take({}) is None # another request with the same prompt doesn't get it
+
+def test_request_chips_replace_an_earlier_prompt():
+    chips = RequestChips()
+    state = {}
+    chips.put(state, 'old')
+    chips.put(state, 'new')
+
+    assert chips.take(state) == 'new'
+    assert len(chips.by_token) == 0
+
+class OwnedLock:
+    # Like oobabooga's generation lock, but it knows which thread holds it
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owner = None
+
+    def acquire(self):
+        self.lock.acquire()
+        self.owner = threading.get_ident()
+
+    def release(self):
+        assert self.held(), "released by a thread that doesn't hold it"
+        self.owner = None
+        self.lock.release()
+
+    def held(self):
+        return self.owner == threading.get_ident()
+
+class Consumer(threading.Thread):
+    # Generates one request the way generate_with_streaming does (holding the lock), stop_after closes it early
+    def __init__(self, scheduler, request, run_batch, lock, window, stop_after = None):
+        super().__init__(daemon = True)
+        self.scheduler = scheduler
+        self.request = request
+        self.run_batch = run_batch
+        self.lock = lock
+        self.window = window
+        self.stop_after = stop_after
+        self.deltas = []
+        self.error = None
+        self.held_after = None
+
+    def run(self):
+        self.lock.acquire()
+        try:
+            deltas = self.scheduler.generate(self.request, self.run_batch, self.lock, self.window, 8)
+            try:
+                for delta in deltas:
+                    self.deltas.append(delta)
+                    if self.stop_after is not None and len(self.deltas) >= self.stop_after: break
+            finally:
+                deltas.close()
+        except Exception as error:
+            self.error = error
+        finally:
+            self.held_after = self.lock.held()
+            if self.held_after: self.lock.release()
+
+def run_consumers(scheduler, leader, follower = None):
+    # The follower only starts once the leader is collecting, so both always end up in the same batch
+    leader.start()
+    if follower is not None:
+        while scheduler.collecting is None and leader.is_alive(): time.sleep(0.001)
+        follower.start()
+        follower.join(30)
+        assert not follower.is_alive()
+    leader.join(30)
+    assert not leader.is_alive()
+
+def fake_run(tokens, fail = False):
+    # Every request gets one delta per token, like run_user_batch
+    def run(batch):
+        try:
+            for token in range(tokens):
+                for request in batch:
+                    if not request.cancelled: request.put(TokenDelta(str(token), token, token))
+                yield
+                if fail: raise RuntimeError("forward failed")
+        finally:
+            for request in batch: request.finish()
+
+    return run
+
+def fake_request(key = 'chip'):
+    return BatchRequest(None, None, None, None, 0, key)
+
+@pytest.mark.parametrize('leader_stops, follower_stops, fail', [
+    (False, False, False),
+    (True, False, False),
+    (False, True, False),
+    (False, False, True),
+])
+def test_generation_lock_is_held_again(leader_stops, follower_stops, fail):
+    scheduler = BatchScheduler()
+    lock = OwnedLock()
+    run = fake_run(4, fail)
+
+    leader = Consumer(scheduler, fake_request(), run, lock, 0.2, stop_after = 1 if leader_stops else None)
+    follower = Consumer(scheduler, fake_request(), run, lock, 0.2, stop_after = 1 if follower_stops else None)
+    run_consumers(scheduler, leader, follower)
+
+    assert scheduler.batches == 1 and scheduler.batched_requests == 2
+    assert leader.held_after and follower.held_after
+    assert not lock.lock.locked()
+    assert isinstance(leader.error, RuntimeError) == fail
+    assert follower.error is None
+
+@pytest.fixture
+def batch_model(standin, monkeypatch):
+    # An Exllamav2Model for run_user_batch, its hijacks are taken off again after the test
+    chip = standin.chip
+    monkeypatch.setattr(standin.shared.args, 'cache_8bit', False, raising = False)
+
+    tokenizer = standin.standins.StandinTokenizer()
+    cache = standin.standins.StandinCache(standin.model, 1)
+    exllamav2_model = types.SimpleNamespace(model = standin.model, cache = cache, tokenizer = tokenizer, loras = None)
+    exllamav2_model.generator = standin.standins.StandinGenerator(standin.model, cache, tokenizer)
+
+    yield exllamav2_model
+
+    chip.uninstall_hijacks(exllamav2_model)
+
+def make_request(standin, settings, numpos, numneg, length, max_new_tokens = 5):
+    chip = standin.chip
+    prompts = chip.HackingchipPrompts([''] * (numpos + numneg), numpos, numneg)
+    hackingchip = chip.Hackingchip({'sample_other_prompts': False}, settings, prompts)
+    ids = torch.randint(1, 256, (numpos + numneg, length))
+    return lambda: BatchRequest(hackingchip, ids, [0] * ids.shape[0], standin.standins.StandinSampler.Settings(), max_new_tokens, settings)
+
+def steering_settings(standin):
+    from extensions.BrainHackingChip.settings_classes import HackingchipSettings, LayerSettings, AttnSettings, VectorSettings
+
+    layers_count, attn_layers, last_kv_layer, head_layer = standin.chip.get_model_layout(standin.model)
+    settings = HackingchipSettings(layers_count, list(attn_layers))
+    settings.layer_settings[2] = LayerSettings(weight = 0.5)
+    settings.attn_settings[3] = AttnSettings(q = VectorSettings(weight = 0.5))
+    return settings
+
+def tokens(deltas):
+    return [(delta.token, delta.finish_reason) for delta in deltas]
+
+def generate_alone(standin, batch_model, request):
+    scheduler = BatchScheduler()
+    consumer = Consumer(scheduler, request, partial(standin.chip.run_user_batch, batch_model), OwnedLock(), 0)
+    run_consumers(scheduler, consumer)
+    assert consumer.error is None
+    return tokens(consumer.deltas)
+
+def test_batched_requests_match_running_alone(standin, batch_model):
+    # Two requests with different rows and prompt lengths, each steered on its own rows
+    torch.manual_seed(1)
+    settings = steering_settings(standin)
+    first = make_request(standin, settings, 1, 1, 8)
+    second = make_request(standin, settings, 2, 1, 5)
+
+    first_alone = generate_alone(standin, batch_model, first())
+    second_alone = generate_alone(standin, batch_model, second())
+
+    scheduler = BatchScheduler()
+    lock = OwnedLock()
+    run = partial(standin.chip.run_user_batch, batch_model)
+    leader = Consumer(scheduler, first(), run, lock, 0.5)
+    follower = Consumer(scheduler, second(), run, lock, 0.5)
+    run_consumers(scheduler, leader, follower)
+
+    assert scheduler.batches == 1 and scheduler.batched_requests == 2
+    assert leader.error is None and follower.error is None
+    assert tokens(leader.deltas) == first_alone
+    assert tokens(follower.deltas) == second_alone
+    assert first_alone != second_alone # each got its own tokens
+
+def test_cancelled_leader_finishes_the_followers(standin, batch_model):
+    torch.manual_seed(2)
+    settings = steering_settings(standin)
+    first = make_request(standin, settings, 1, 1, 6)
+    second = make_request(standin, settings, 1, 2, 6)
+
+    second_alone = generate_alone(standin, batch_model, second())
+
+    scheduler = BatchScheduler()
+    lock = OwnedLock()
+    run = partial(standin.chip.run_user_batch, batch_model)
+    leader = Consumer(scheduler, first(), run, lock, 0.5, stop_after = 1)
+    follower = Consumer(scheduler, second(), run, lock, 0.5)
+    run_consumers(scheduler, leader, follower)
+
+    assert len(leader.deltas) == 1 and leader.held_after
+    assert tokens(follower.deltas) == second_alone and follower.held_after
@@ -0,0 +1,101 @@
+import types
+
+import pytest
+import torch
+
+from extensions.BrainHackingChip import steering as steering_module
+from extensions.BrainHackingChip.steering import SteeringEngine, Workspace
+
+def make_engine(numpos, numneg, negative_weights = None, steering_mode = 'mean'):
+    settings = types.SimpleNamespace(steering_mode = steering_mode, negative_weights = negative_weights)
+    neg_names = ['NEGATIVE'] + ['NEGATIVE ' + str(index + 2) for index in range(numneg - 1)] if numneg > 0 else []
+    prompts = types.SimpleNamespace(numpos = numpos, numneg = numneg, negend = numpos + numneg, neg_names = neg_names)
+    return SteeringEngine(settings, prompts)
+
+def test_mean_steers_away_from_negatives():
+    steering = make_engine(1, 2)
+    x = torch.tensor([[1.0, 5.0], [3.0, 5.0], [5.0, 5.0]])
+
+    steering.apply(x, 0.5)
+
+    # mean of the negatives minus the positive is [3, 0], times 0.5, subtracted from every row
+    assert torch.allclose(x, torch.tensor([[-0.5, 5.0], [1.5, 5.0], [3.5, 5.0]]))
+
+def test_negative_weights():
+    steering = make_engine(1, 2, {'NEGATIVE 2': 0.0})
+    x = torch.tensor([[1.0, 5.0], [3.0, 5.0], [5.0, 5.0]])
+
+    steering.apply(x, 1.0)
+
+    assert torch.allclose(x[0], torch.tensor([-1.0, 5.0]))
+
+def test_zero_negative_weights_skip_the_site():
+    steering = make_engine(1, 1, {'NEGATIVE': 0.0})
+    x = torch.tensor([[1.0, 5.0], [2.0, 5.0]])
+
+    assert not steering.active(x, 0.2)
+    steering.apply(x, 0.2)
+
+    assert torch.equal(x, torch.tensor([[1.0, 5.0], [2.0, 5.0]]))
+
+def test_no_negatives_skip_the_site():
+    steering = make_engine(1, 0)
+    x = torch.tensor([[1.0, 5.0]])
+
+    steering.apply(x, 0.2)
+
+    assert torch.equal(x, torch.tensor([[1.0, 5.0]]))
+
+modes = pytest.mark.parametrize('steering_mode, negative_weights', [
+    ('mean', None),
+    ('mean', {'NEGATIVE 2': 0.5}),
+    ('max_margin', None),
+    ('max_margin', {'NEGATIVE 2': 0.5}),
+])
+
+@modes
+def test_workspace_matches_no_workspace(steering_mode, negative_weights):
+    steering = make_engine(2, 2, negative_weights, steering_mode)
+    workspace = Workspace()
+
+    for shape in ((4, 6, 16), (4, 1, 16), (5, 1, 16)): # prefill, decode, and a batch with a row past the negatives
+        x = torch.randn(shape)
+        expected = steering.apply(x.clone(), 0.3)
+        assert torch.equal(steering.apply(x, 0.3, workspace), expected)
+
+@modes
+def test_workspace_allocations_stay_flat(steering_mode, negative_weights):
+    steering = make_engine(1, 2, negative_weights, steering_mode)
+    workspace = Workspace()
+
+    steering.apply(torch.randn(3, 8, 16), 0.3, workspace) # prefill sizes every buffer
+    allocations = workspace.allocations
+    assert allocations > 0
+
+    for _ in range(5):
+        steering.apply(torch.randn(3, 1, 16), 0.3, workspace)
+
+    assert workspace.allocations == allocations
+
+def test_non_contiguous_rows_fall_back_to_tensordot(monkeypatch):
+    steering = make_engine(1, 2)
+    workspace = Workspace()
+    calls = []
+    tensordot = torch.tensordot
+
+    def counting_tensordot(*args, **kwargs):
+        calls.append(args[1].shape)
+        return tensordot(*args, **kwargs)
+
+    monkeypatch.setattr(steering_module.torch, 'tensordot', counting_tensordot)
+
+    x = torch.randn(3, 16, 4).transpose(1, 2) # like the attention states, a transposed view
+    assert not x.is_contiguous()
+    expected = steering.apply(x.clone(), 0.3)
+    calls.clear()
+
+    assert torch.equal(steering.apply(x, 0.3, workspace), expected)
+    assert len(calls) == 1 and workspace.allocations == 0
+
+    steering.apply(torch.randn(3, 4, 16), 0.3, workspace) # contiguous rows go through the workspace
+    assert len(calls) == 1 and workspace.allocations == 1
@@ -0,0 +1,79 @@
+import pytest
+import torch
+
+from extensions.BrainHackingChip.steering_program import Kernel
+
+def run_chip(standin, settings, numpos, numneg, ids):
+    # Prefills every token but the last, then decodes the last one
+    chip = standin.chip
+    from extensions.BrainHackingChip.kv_cache import make_cache
+
+    prompts = chip.HackingchipPrompts([''] * (numpos + numneg), numpos, numneg)
+    standin.model.hackingchip = chip.Hackingchip({'sample_other_prompts': False}, settings, prompts)
+    cache = make_cache(standin.model, numpos, numneg)
+
+    chip.hijack_model_forward(standin.model, ids[:, :-1], cache, preprocess_only = True)
+    chip.hijack_model_forward(standin.model, ids[:, -1:], cache)
+    standin.model.hackingchip = None
+
+def make_settings(standin):
+    from extensions.BrainHackingChip.settings_classes import HackingchipSettings
+
+    layers_count, attn_layers, last_kv_layer, head_layer = standin.chip.get_model_layout(standin.model)
+    return HackingchipSettings(layers_count, list(attn_layers)), last_kv_layer
+
+def test_positive_only_chip_runs_its_cfg_funcs(standin):
+    # Like the HQKVA stub chip: hooks on every vector of every attention layer and no negative prompts
+    from extensions.BrainHackingChip.settings_classes import AttnSettings, VectorSettings, LayerSettings
+
+    calls = []
+    def hook(tensor, settings, hackingchip):
+        calls.append(tensor.shape[0])
+        return tensor
+
+    settings, last_kv_layer = make_settings(standin)
+    vectors = AttnSettings(*[VectorSettings(cfg_func = hook) for _ in range(5)])
+    settings.attn_settings = [vectors] * len(settings.attn_settings)
+    settings.layer_settings[last_kv_layer - 1] = LayerSettings(cfg_func = hook)
+
+    ids = torch.randint(256, (1, 8))
+    run_chip(standin, settings, 1, 0, ids)
+
+    assert len(calls) > 0
+    assert all(rows == 1 for rows in calls)
+
+def test_kernel_runs_uncompiled_when_compiling_fails():
+    calls = []
+    def func(x, workspace=None):
+        calls.append(x)
+        return x
+
+    def compiled(x):
+        raise RuntimeError("can't compile")
+
+    kernel = Kernel(func)
+    kernel.compiled = compiled
+
+    assert kernel(1) == 1
+    assert kernel(2) == 2
+    assert calls == [1, 2]
+    assert kernel.compiled is None
+
+def test_kernel_raises_errors_after_compiling():
+    calls = []
+    def func(x, workspace=None):
+        calls.append(x)
+        return x
+
+    def compiled(x):
+        if x > 1: raise RuntimeError("failed partway through")
+        return x
+
+    kernel = Kernel(func)
+    kernel.compiled = compiled
+
+    assert kernel(1) == 1
+    with pytest.raises(RuntimeError):
+        kernel(2)
+    assert calls == [] # never ran uncompiled, so nothing was steered twice
+    assert kernel.compiled is compiled
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from extensions.BrainHackingChip.streaming import TokenDelta, cumulative_text, stream_deltas
+
+class Generation:
+    # Stands in for generate_deltas: one token every few ms until should_stop() or the limit, then the final delta
+    def __init__(self, limit = 1000):
+        self.limit = limit
+        self.finished = threading.Event()
+        self.thread = None
+
+    def __call__(self, should_stop = lambda: False):
+        self.thread = threading.current_thread()
+        try:
+            finish_reason = 'length'
+            for index in range(self.limit):
+                if should_stop():
+                    finish_reason = 'stop'
+                    break
+                yield TokenDelta(str(index) + ' ', index, index)
+                time.sleep(0.002)
+            yield TokenDelta('', None, index, finish_reason)
+        finally:
+            self.finished.set() # where generate_deltas lets go of the generation lock
+
+def collect(deltas):
+    async def read():
+        return [delta async for delta in deltas()]
+
+    return asyncio.run(read())
+
+def test_cumulative_text():
+    generation = Generation(3)
+    assert list(cumulative_text(generation())) == ['0 ', '0 1 ', '0 1 2 ']
+    assert generation.finished.is_set() # the final delta was still read
+
+def test_cumulative_text_closed_early():
+    generation = Generation()
+    texts = cumulative_text(generation())
+    assert next(texts) == '0 '
+    texts.close()
+    assert generation.finished.is_set()
+
+def test_stream_deltas_runs_on_a_worker():
+    generation = Generation(5)
+    deltas = collect(lambda: stream_deltas(generation, poll_interval = 0.001))
+
+    assert [delta.token for delta in deltas] == [0, 1, 2, 3, 4, None]
+    assert deltas[-1].finish_reason == 'length'
+    assert generation.thread is not threading.main_thread()
+
+def test_stream_deltas_cancel_event():
+    generation = Generation()
+
+    async def cancel_after_first():
+        cancel = asyncio.Event()
+        seen = []
+        async for delta in stream_deltas(generation, cancel, poll_interval = 0.001):
+            seen.append(delta)
+            cancel.set()
+        return seen
+
+    deltas = asyncio.run(cancel_after_first())
+
+    assert deltas[-1].finish_reason == 'stop' # the generation saw should_stop and finished by itself
+    assert len(deltas) < 100
+    assert generation.finished.is_set()
+
+def test_stream_deltas_stop_check():
+    generation = Generation()
+    stopped = threading.Event()
+    threading.Timer(0.02, stopped.set).start()
+
+    deltas = collect(lambda: stream_deltas(generation, stop_check = stopped.is_set, poll_interval = 0.001))
+
+    assert deltas[-1].finish_reason == 'stop'
+    assert generation.finished.is_set()
+
+def test_stream_deltas_consumer_stops_reading():
+    generation = Generation()
+
+    async def read_two():
+        stream = stream_deltas(generation, poll_interval = 0.001)
+        seen = [await stream.__anext__(), await stream.__anext__()]
+        await stream.aclose()
+        return seen, generation.finished.is_set()
+
+    deltas, finished = asyncio.run(read_two())
+
+    assert len(deltas) == 2
+    assert finished # aclose waited for the worker, the generation lock is free again
+
+def test_stream_deltas_raises_generation_errors():
+    def failing(should_stop):
+        yield TokenDelta('a', 1, 0)
+        raise RuntimeError("forward failed")
+
+    with pytest.raises(RuntimeError, match = "forward failed"):
+        collect(lambda: stream_deltas(failing, poll_interval = 0.001))
@@ -0,0 +1,45 @@
+import os
+
+import torch
+
+from extensions.BrainHackingChip.vector_store import SteeringVectorStore
+
+def make_vectors():
+    return {('layer', 3): torch.randn(16).half(), ('attn', 1, 'h'): torch.randn(16).half()}
+
+def test_save_and_load(tmp_path):
+    store = SteeringVectorStore(str(tmp_path))
+    vectors = make_vectors()
+
+    store.save('key', vectors)
+    loaded = store.load('key')
+
+    assert set(loaded) == set(vectors)
+    for site, vector in vectors.items():
+        assert torch.equal(loaded[site], vector)
+
+def test_missing_entry(tmp_path):
+    assert SteeringVectorStore(str(tmp_path)).load('key') is None
+
+def test_truncated_entry_is_a_miss(tmp_path):
+    store = SteeringVectorStore(str(tmp_path))
+    store.save('key', make_vectors())
+
+    path = store.path('key')
+    with open(path, 'r+b') as file:
+        file.truncate(os.path.getsize(path) - 40)
+
+    assert store.load('key') is None
+    assert not os.path.exists(path) # dropped, so the vectors get computed and saved again
+
+def test_corrupt_header_is_a_miss(tmp_path):
+    store = SteeringVectorStore(str(tmp_path))
+    store.save('key', make_vectors())
+
+    path = store.path('key')
+    with open(path, 'r+b') as file:
+        file.seek(8)
+        file.write(b'{"sites": [{"site": 1}]}')
+
+    assert store.load('key') is None
+    assert not os.path.exists(path)
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import struct
+import warnings
+
+import numpy as np
+import torch
+
+# On-disk store for precomputed steering vectors (see precompute_steering in settings_classes.py)
+# Each entry is one file: an 8 byte header length, a JSON header describing every site's tensor, then the raw tensor data
+# Files are memory-mapped read-only when loaded, so the tensors on the CPU side are zero-copy and every worker process
+# reading the same entry shares the same pages from the OS instead of holding its own copy
+# Entries are written to a temporary file and renamed into place, so readers never see half written files
+
+default_store_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'steering_store')
+
+alignment = 64
+
+def make_key(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+class SteeringVectorStore:
+    def __init__(self, directory=default_store_dir, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.bin')
+
+    def load(self, key):
+        # Returns {site: tensor} backed by the memory-mapped file, or None if there's no entry
+        path = self.path(key)
+
+        try:
+            data = np.memmap(path, dtype=np.uint8, mode='r')
+        except (OSError, ValueError):
+            return None
+
+        try:
+            header_len = struct.unpack('<Q', bytes(data[:8]))[0]
+            header = json.loads(bytes(data[8:8 + header_len]).decode('utf-8'))
+
+            vectors = {}
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore') # torch warns about the read-only memmap, it's only ever read
+                for entry in header['sites']:
+                    dtype = np.dtype(entry['dtype'])
+                    count = int(np.prod(entry['shape'])) if entry['shape'] else 1
+                    array = data[entry['offset']:entry['offset'] + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+                    vectors[tuple(entry['site'])] = torch.from_numpy(array)
+        except (struct.error, KeyError, TypeError, ValueError, RuntimeError):
+            # Truncated or corrupt, drop the entry so it's a miss and the vectors get computed (and saved) again
+            vectors = None
+            data = None # unmapped first, Windows can't remove a mapped file
+            self.remove(path)
+            return None
+
+        try:
+            os.utime(path) # most recently used, for eviction
+        except OSError:
+            pass
+
+        return vectors
+
+    def save(self, key, vectors):
+        os.makedirs(self.directory, exist_ok=True)
+
+        arrays = [(site, tensor.detach().to('cpu', torch.float16).contiguous().numpy()) for site, tensor in vectors.items()]
+
+        relative_offsets = []
+        size = 0
+        for site, array in arrays:
+            relative_offsets.append(size)
+            size += array.nbytes
+            size += -size % alignment
+
+        def make_header(start):
+            sites = [{'site': list(site), 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': start + relative}
+                     for (site, array), relative in zip(arrays, relative_offsets)]
+            return json.dumps({'sites': sites}).encode('utf-8')
+
+        # The data starts after the header, but the header holds the offsets, so go until the start stops moving
+        start = 0
+        while True:
+            header = make_header(start)
+            data_start = 8 + len(header)
+            data_start += -data_start % alignment
+            if data_start == start: break
+            start = data_start
+
+        temp_path = self.path(key) + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(struct.pack('<Q', len(header)))
+            file.write(header)
+            file.write(b'\0' * (start - 8 - len(header)))
+            for site, array in arrays:
+                file.write(array.tobytes())
+                file.write(b'\0' * (-array.nbytes % alignment))
+
+        os.replace(temp_path, self.path(key))
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path) # other processes that already mapped it keep their mapping
+        except OSError:
+            pass
+
+    def evict(self):
+        # Removes least recently used entries until the store fits in max_bytes
+        try:
+            entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.bin')]
+            entries = [(os.stat(path), path) for path in entries]
+        except OSError:
+            return
+
+        total = sum(stat.st_size for stat, path in entries)
+        for stat, path in sorted(entries, key=lambda entry: entry[0].st_mtime):
+            if total <= self.max_bytes: break
+            self.remove(path)
+            total -= stat.st_size
+
+stores = {}
+
+def get_store(directory=None, max_bytes=256 * 1024 * 1024):
+    directory = directory or default_store_dir
+    store = stores.get(directory)
+    if store is None:
+        store = SteeringVectorStore(directory, max_bytes)
+        stores[directory] = store
+    store.max_bytes = max_bytes
+    return store